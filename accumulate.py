@@ -0,0 +1,258 @@
+"""Gradient accumulation and recomputation for the fully trainable backbones.
+
+AccumulatingModel trains on the full batch (BATCH_SIZE = 32) but runs it
+through the network in micro-batches of `micro_batch` images. The gradients of
+the micro-batches are summed and the optimizer steps once per batch, so the
+update is the same as for the whole batch, while only one micro-batch's
+activations are held at a time. BatchNormalization layers in training mode
+normalize over the micro-batch instead of the whole batch, which is the one
+difference left.
+
+With checkpoint_segments=K the network is also cut into about K consecutive
+segments at block boundaries, and the activations inside every segment but
+the last are recomputed during the backward pass (tf.recompute_grad) instead
+of being kept. This costs about one extra forward pass (and BatchNormalization
+moving averages see the recomputed segments a second time).
+
+PeakMemory logs the peak memory of every training step. The CLI compares
+micro-batch sizes and segment counts on random inputs:
+
+    python accumulate.py --model Xception NASNetLarge --micro-batch 32 8 4 --segments 0 4
+"""
+import argparse
+import csv
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from bottleneck_cache import _map_tensors, _tensor_key
+
+REPORT_FIELDS = ['name', 'batch_size', 'micro_batch', 'checkpoint_segments', 'train_step_ms', 'peak_step_mb',
+                 'peak_rss_mb']
+
+
+def live_tensors(model):
+    """For every cut position i, the keys of the tensors made before model.layers[i] and used from it on.
+
+    Position len(model.layers) holds the model output.
+    """
+    layers = model.layers
+    position = {layer.name: i for i, layer in enumerate(layers)}
+    last_use = {}
+    for i, layer in enumerate(layers):
+        if isinstance(layer, tf.keras.layers.InputLayer):
+            continue
+        node = layer._inbound_nodes[0]
+        for t in tf.nest.flatten((node.call_args, node.call_kwargs)):
+            if hasattr(t, '_keras_history'):
+                last_use[_tensor_key(t)] = i
+    last_use[_tensor_key(model.output)] = len(layers)
+    return [[key for key, last in last_use.items() if position[key[0]] < i <= last]
+            for i in range(len(layers) + 1)]
+
+
+def segment_model(model, segments, max_live=2):
+    """Cut `model` into about `segments` consecutive models sharing its layers.
+
+    Cuts go where at most `max_live` tensors cross (the output of a block, and
+    the previous one for NASNet's cells), as close to equal layer counts as
+    possible, and never after the first Dropout layer: its random mask would
+    differ when the segment is recomputed. Segment i takes the list of tensors
+    segment i - 1 returns, the first one takes the model input.
+    """
+    layers = model.layers
+    live = live_tensors(model)
+    first = sum(isinstance(layer, tf.keras.layers.InputLayer) for layer in layers)
+    stop = next((i for i, layer in enumerate(layers) if isinstance(layer, tf.keras.layers.Dropout)), len(layers))
+    candidates = [i for i in range(first + 1, stop) if len(live[i]) <= max_live]
+    cuts = set()
+    for k in range(1, segments):
+        target = first + (stop - first) * k // segments
+        if candidates:
+            cuts.add(min(candidates, key=lambda i: abs(i - target)))
+    bounds = [first] + sorted(cuts) + [len(layers)]
+
+    original = {}
+    for layer in layers:
+        for i, t in enumerate(tf.nest.flatten(layer.output)):
+            original[(layer.name, 0, i)] = t
+    models = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        inputs = [tf.keras.Input(shape=original[key].shape[1:], dtype=original[key].dtype) for key in live[start]]
+        tensors = dict(zip(live[start], inputs))
+        for layer in layers[start:end]:
+            node = layer._inbound_nodes[0]
+            out = layer(*_map_tensors(node.call_args, tensors), **_map_tensors(node.call_kwargs, tensors))
+            for i, t in enumerate(tf.nest.flatten(out)):
+                tensors[(layer.name, 0, i)] = t
+        models.append(tf.keras.Model(inputs, [tensors[key] for key in live[end]],
+                                     name='%s_segment%d' % (model.name, len(models))))
+    return models
+
+
+class AccumulatingModel(tf.keras.Model):
+    """A functional model whose train_step accumulates the gradients of micro-batches.
+
+    It shares the layers and weights of the model it wraps, so weights saved
+    from either load into the other.
+    """
+
+    def __init__(self, inputs, outputs, micro_batch=8, checkpoint_segments=0, **kwargs):
+        super().__init__(inputs=inputs, outputs=outputs, **kwargs)
+        self.micro_batch = micro_batch
+        self.checkpoint_segments = checkpoint_segments
+        segments = segment_model(self, checkpoint_segments) if checkpoint_segments > 1 else []
+        # plain functions, so that the segments are not tracked (and saved) as layers of this model
+        calls = [lambda *xs, segment=segment: segment(list(xs), training=True) for segment in segments]
+        self.segment_calls = [tf.recompute_grad(call) for call in calls[:-1]] + calls[-1:]
+
+    @classmethod
+    def wrap(cls, model, micro_batch=8, checkpoint_segments=0):
+        return cls(model.inputs, model.outputs, micro_batch, checkpoint_segments, name=model.name)
+
+    def compile(self, optimizer='rmsprop', loss=None, **kwargs):
+        super().compile(optimizer=optimizer, loss=loss, **kwargs)
+        self.micro_loss = tf.keras.losses.get(loss)
+
+    def _forward(self, x):
+        if not self.segment_calls:
+            return self(x, training=True)
+        outputs = [x]
+        for call in self.segment_calls:
+            outputs = tf.nest.flatten(call(*outputs))
+        return outputs[0]
+
+    def train_step(self, data):
+        x, y = data
+        if y.shape.rank == 1 and self.outputs[0].shape[-1] == 1:
+            y = y[:, None]  # as compile's loss container does for a (N, 1) sigmoid output
+        batch_size = tf.shape(x)[0]
+        variables = self.trainable_variables
+        steps = (batch_size + self.micro_batch - 1) // self.micro_batch
+
+        def micro_step(i, grads, predictions):
+            start = i * self.micro_batch
+            x_micro, y_micro = x[start:start + self.micro_batch], y[start:start + self.micro_batch]
+            # weighted by their share of the batch, the micro-batch losses add up to the batch loss
+            share = tf.cast(tf.shape(x_micro)[0], tf.float32) / tf.cast(batch_size, tf.float32)
+            with tf.GradientTape() as tape:
+                pred = self._forward(x_micro)
+                loss = tf.reduce_mean(self.micro_loss(y_micro, pred)) * share
+                if self.losses:
+                    loss += tf.add_n(self.losses) * share
+            micro_grads = tape.gradient(loss, variables, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            grads = [g + tf.convert_to_tensor(m) for g, m in zip(grads, micro_grads)]
+            return i + 1, grads, predictions.write(i, pred)
+
+        predictions = tf.TensorArray(self.outputs[0].dtype, size=steps, infer_shape=False)
+        _, grads, predictions = tf.while_loop(lambda i, *_: i < steps, micro_step,
+                                              (tf.constant(0), [tf.zeros_like(v) for v in variables], predictions))
+        self.optimizer.apply_gradients(zip(grads, variables))
+
+        # loss and metrics once over the whole batch, from the predictions already made
+        predictions = predictions.concat()
+        self.compiled_loss(y, predictions, regularization_losses=self.losses)
+        self.compiled_metrics.update_state(y, predictions)
+        return {m.name: m.result() for m in self.metrics}
+
+
+def _rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2. ** 20
+
+
+class PeakMemory(tf.keras.callbacks.Callback):
+    """Peak memory (MB) of every training step, also logged as peak_step_mb.
+
+    On a GPU this is the allocator's peak; on the CPU the process RSS, sampled
+    every `interval` seconds by a background thread.
+    """
+
+    def __init__(self, interval=0.002):
+        super().__init__()
+        self.interval = interval
+        self.steps = []
+        self.gpu = bool(tf.config.list_logical_devices('GPU'))
+        self._peak = 0.
+        self._running = False
+
+    def _sample(self):
+        while self._running:
+            self._peak = max(self._peak, _rss_mb())
+            time.sleep(self.interval)
+
+    def on_train_begin(self, logs=None):
+        if not self.gpu:
+            self._running = True
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.gpu:
+            tf.config.experimental.reset_memory_stats('GPU:0')
+        else:
+            self._peak = _rss_mb()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.gpu:
+            peak = tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2. ** 20
+        else:
+            peak = max(self._peak, _rss_mb())
+        self.steps.append(peak)
+        if logs is not None:
+            logs['peak_step_mb'] = peak
+
+    def on_train_end(self, logs=None):
+        if not self.gpu:
+            self._running = False
+            self._thread.join()
+
+
+def benchmark_accumulation(config, batch_size=32, steps=5):
+    """Train-step time and peak step memory of `config` on random inputs (weights=None)."""
+    from benchmark import peak_rss_mb
+    from sweep import IMG_SHAPE, build_model
+
+    model = build_model(config, weights=None)
+    rng = np.random.RandomState(0)
+    x = rng.rand(batch_size * (steps + 1), IMG_SHAPE, IMG_SHAPE, 3).astype(np.float32)
+    y = (rng.rand(len(x)) > 0.5).astype(np.float32)
+    memory = PeakMemory()
+    starts = []
+    timer = tf.keras.callbacks.LambdaCallback(on_train_batch_begin=lambda batch, logs: starts.append(time.perf_counter()))
+    model.fit(x, y, batch_size=batch_size, epochs=1, shuffle=False, callbacks=[memory, timer], verbose=0)
+    step_ms = (time.perf_counter() - starts[1]) / steps * 1000  # the first step also traces
+    return dict(name=config['name'], batch_size=batch_size, micro_batch=config.get('micro_batch') or batch_size,
+                checkpoint_segments=config.get('checkpoint_segments', 0), train_step_ms=round(step_ms, 1),
+                peak_step_mb=round(max(memory.steps[1:] or memory.steps), 1), peak_rss_mb=round(peak_rss_mb(), 1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--model', nargs='+', default=['Xception', 'NASNetLarge'], help='sweep experiment names')
+    parser.add_argument('--batch-size', type=int, default=32, help='effective batch size')
+    parser.add_argument('--micro-batch', type=int, nargs='+', default=[32, 8])
+    parser.add_argument('--segments', type=int, nargs='+', default=[0, 4], help='checkpoint segments, 0 for none')
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--report', default='accumulate_report.csv')
+    args = parser.parse_args()
+
+    from benchmark import in_subprocess
+    from sweep import EXPERIMENTS
+
+    rows = []
+    for name in args.model:
+        base = next(c for c in EXPERIMENTS if c['name'] == name)
+        for micro_batch in args.micro_batch:
+            for segments in args.segments:
+                config = dict(base, micro_batch=micro_batch, checkpoint_segments=segments)
+                # every run in its own process, so that its peak RSS is its own
+                rows.append(in_subprocess(benchmark_accumulation, config, args.batch_size, args.steps))
+                print(', '.join('%s=%s' % (k, rows[-1][k]) for k in REPORT_FIELDS))
+    with open(args.report, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
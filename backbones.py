@@ -0,0 +1,102 @@
+"""Registry of the ImageNet backbones, with offline weights and prebuilt models.
+
+backbone(name) returns a headless Keras application at the given input size.
+Only the module of the requested architecture is imported. The first build
+with weights='imagenet' stores the weights under weights/ (or uses a file
+staged there beforehand, so no download is ever needed) and saves the whole
+built model to cache/backbones/; later calls, in any process, just load that
+one file. Every call returns a fresh model with the ImageNet weights.
+
+    python backbones.py DenseNet121 Xception   # stage the files and time the builds
+"""
+import argparse
+import importlib
+import os
+import time
+
+import tensorflow as tf
+
+WEIGHTS_DIR = 'weights'
+ARTIFACT_DIR = os.path.join('cache', 'backbones')
+
+# name -> (module under tensorflow.keras.applications, constructor)
+BACKBONES = {
+    'DenseNet121': ('densenet', 'DenseNet121'),
+    'Xception': ('xception', 'Xception'),
+    'MobileNetV2': ('mobilenet_v2', 'MobileNetV2'),
+    'NASNetLarge': ('nasnet', 'NASNetLarge'),
+    'InceptionResNetV2': ('inception_resnet_v2', 'InceptionResNetV2'),
+    'VGG16': ('vgg16', 'VGG16'),
+    'VGG19': ('vgg19', 'VGG19'),
+    'InceptionV3': ('inception_v3', 'InceptionV3'),
+    'ResNet101V2': ('resnet_v2', 'ResNet101V2'),
+    'ResNet152V2': ('resnet_v2', 'ResNet152V2'),
+}
+
+
+def constructor(name):
+    """The Keras application function for `name`, importing only its module."""
+    if name not in BACKBONES:
+        raise KeyError('unknown backbone %r, expected one of %s' % (name, ', '.join(BACKBONES)))
+    module, function = BACKBONES[name]
+    return getattr(importlib.import_module('tensorflow.keras.applications.' + module), function)
+
+
+def weights_path(name, weights_dir=WEIGHTS_DIR):
+    return os.path.join(weights_dir, '%s_notop.h5' % name)
+
+
+def artifact_path(name, img_shape, artifact_dir=ARTIFACT_DIR):
+    return os.path.join(artifact_dir, '%s_%d.h5' % (name, img_shape))
+
+
+def _save_atomic(save, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # per process, so workers that build the same backbone at once do not clash;
+    # the extension picks the format
+    tmp = '%s.%d.tmp.h5' % (path[:-len('.h5')], os.getpid())
+    save(tmp)
+    os.replace(tmp, path)
+
+
+def build(name, img_shape=150, weights='imagenet'):
+    """Construct the headless backbone, preferring staged weights over a download."""
+    staged = weights_path(name)
+    use_staged = weights == 'imagenet' and os.path.exists(staged)
+    net = constructor(name)(include_top=False, weights=staged if use_staged else weights,
+                            input_tensor=tf.keras.Input(shape=(img_shape, img_shape, 3)))
+    if weights == 'imagenet' and not use_staged:
+        _save_atomic(net.save_weights, staged)
+    return net
+
+
+def backbone(name, img_shape=150, weights='imagenet'):
+    """A fresh headless `name` backbone taking (img_shape, img_shape, 3) inputs.
+
+    With ImageNet weights the built model is cached as an artifact and loaded
+    from there; weights=None builds a randomly initialized one.
+    """
+    if weights != 'imagenet':
+        return build(name, img_shape, weights)
+    path = artifact_path(name, img_shape)
+    if os.path.exists(path):
+        return tf.keras.models.load_model(path, compile=False)
+    net = build(name, img_shape, weights)
+    _save_atomic(lambda p: net.save(p, include_optimizer=False), path)
+    return net
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*', default=list(BACKBONES))
+    parser.add_argument('--img-shape', type=int, default=150)
+    args = parser.parse_args()
+
+    for name in args.names:
+        start = time.perf_counter()
+        build(name, args.img_shape)
+        built = time.perf_counter() - start
+        backbone(name, args.img_shape)  # makes sure the artifact exists
+        start = time.perf_counter()
+        backbone(name, args.img_shape)
+        print('%-18s build with staged weights %.1fs, load artifact %.1fs' % (name, built, time.perf_counter() - start))
@@ -0,0 +1,85 @@
+"""Whole-batch version of the ImageDataGenerator shift/flip augmentation.
+
+ImageDataGenerator transforms one image at a time in Python. BatchAugmenter
+draws the same random parameters (a uniform shift of up to a fraction of the
+height/width, a horizontal flip with probability 1/2) for a whole batch and
+applies them with a couple of vectorized gathers, using the same bilinear
+interpolation and 'nearest' fill as the Keras affine transform.
+"""
+import numpy as np
+
+
+class BatchAugmenter:
+    """Random shift/flip of a (batch, height, width, channels) float array.
+
+    With a seed, the transforms for a batch depend only on the seed and the
+    `key` passed in (e.g. (epoch, batch index)), so runs are reproducible
+    whatever order the Keras worker threads request the batches in.
+    """
+
+    def __init__(self, width_shift_range=0., height_shift_range=0., horizontal_flip=False, seed=None):
+        self.width_shift_range = width_shift_range
+        self.height_shift_range = height_shift_range
+        self.horizontal_flip = horizontal_flip
+        self.seed = seed
+
+    @classmethod
+    def from_datagen(cls, datagen, seed=None):
+        """Take the shift/flip settings of an ImageDataGenerator."""
+        unsupported = [name for name in ('rotation_range', 'shear_range', 'channel_shift_range', 'vertical_flip')
+                       if getattr(datagen, name)]
+        if list(datagen.zoom_range) != [1, 1]:
+            unsupported.append('zoom_range')
+        if unsupported:
+            raise ValueError('BatchAugmenter only supports shifts and horizontal flips, got %s' % unsupported)
+        if datagen.fill_mode != 'nearest':
+            raise ValueError("BatchAugmenter only supports fill_mode='nearest'")
+        return cls(datagen.width_shift_range, datagen.height_shift_range, datagen.horizontal_flip, seed)
+
+    def __call__(self, x, key=()):
+        if self.seed is None:
+            rng = np.random.default_rng()
+        else:
+            rng = np.random.default_rng((self.seed,) + tuple(key))
+        n, h, w = x.shape[:3]
+
+        if self.height_shift_range:
+            dy = rng.uniform(-self.height_shift_range, self.height_shift_range, n) * h
+            x = _shift(x, dy, axis=1)
+
+        flip = np.zeros(n, dtype=bool)
+        if self.horizontal_flip:
+            flip = rng.random(n) < 0.5
+        dx = np.zeros(n)
+        if self.width_shift_range:
+            dx = rng.uniform(-self.width_shift_range, self.width_shift_range, n) * w
+        if self.width_shift_range or flip.any():
+            x = _shift(x, dx, axis=2, flip=flip)
+        return x
+
+
+def _shift(x, shift, axis, flip=None):
+    """Shift every image along `axis` by its own (fractional) amount.
+
+    Source coordinates outside the image are clamped to the edge, which is the
+    'nearest' fill mode; `flip` mirrors the selected images along the same axis.
+    """
+    size = x.shape[axis]
+    src = np.arange(size)[None, :] + shift[:, None]
+    lo = np.floor(src)
+    frac = (src - lo).astype(x.dtype)
+    lo = lo.astype(np.int64)
+    i0 = np.clip(lo, 0, size - 1)
+    i1 = np.clip(lo + 1, 0, size - 1)
+    if flip is not None:
+        i0 = np.where(flip[:, None], size - 1 - i0, i0)
+        i1 = np.where(flip[:, None], size - 1 - i1, i1)
+
+    index_shape = [x.shape[0], 1, 1, 1]
+    index_shape[axis] = size
+    frac = frac.reshape(index_shape)
+    a = np.take_along_axis(x, i0.reshape(index_shape), axis=axis)
+    if not frac.any():
+        return a
+    b = np.take_along_axis(x, i1.reshape(index_shape), axis=axis)
+    return a + (b - a) * frac
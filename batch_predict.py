@@ -0,0 +1,193 @@
+"""Classify a large set of images with a trained model, streaming.
+
+Files come from a directory tree (walked in sorted order) or a file list, are
+decoded by a bounded thread pool and go through the model in large batches.
+Each prediction is appended to a CSV or JSONL file as soon as its batch is
+done, so memory stays constant whatever the number of files. The output is
+in input order: after a crash, re-running the same command skips as many
+inputs as there are complete lines in the output and carries on.
+
+    python batch_predict.py models/Xception.h5 new_images/ --out predictions.csv
+"""
+import argparse
+import collections
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_cache import IMAGE_EXTENSIONS, decode_image
+
+
+def iter_directory(directory):
+    """Image paths under `directory` in a stable order, one directory listed at a time."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for fname in sorted(files):
+            if fname.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, fname)
+
+
+def iter_file_list(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def completed_count(out_path):
+    """Number of complete records in `out_path`, dropping a partly written last line.
+
+    CSV records are counted with the csv module, so a quoted field holding a
+    newline (a path) still counts once.
+    """
+    if not os.path.exists(out_path):
+        return 0
+    with open(out_path, 'rb+') as f:
+        data_end = f.seek(0, os.SEEK_END)
+        # walk back to the last newline, a crash may have cut the final record
+        pos = data_end
+        while pos > 0:
+            f.seek(pos - 1)
+            if f.read(1) == b'\n':
+                break
+            pos -= 1
+        if pos != data_end:
+            f.truncate(pos)
+    with open(out_path, newline='') as f:
+        if out_path.endswith('.csv'):
+            records = sum(1 for _ in csv.reader(f)) - 1  # header
+        else:
+            records = sum(1 for _ in f)
+    return max(records, 0)
+
+
+def _decode(path, img_shape, draft=False):
+    try:
+        return decode_image(path, img_shape, draft), None
+    except Exception as e:  # unreadable or truncated files still get a record
+        return None, '%s: %s' % (type(e).__name__, e)
+
+
+def decoded_stream(paths, img_shape=150, workers=8, max_pending=256, draft=False):
+    """Yield (path, image, error) in input order with at most `max_pending` decodes in flight."""
+    with ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for path in paths:
+            pending.append((path, pool.submit(_decode, path, img_shape, draft)))
+            if len(pending) >= max_pending:
+                path, future = pending.popleft()
+                yield (path,) + future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield (path,) + future.result()
+
+
+def class_one_probability(out):
+    """Probability of class 1 from the output of a sigmoid head or a two-logit head."""
+    out = np.asarray(out, dtype=np.float64)
+    if out.shape[-1] == 1:
+        return out[:, 0]
+    out = np.exp(out - out.max(axis=1, keepdims=True))
+    return out[:, 1] / out.sum(axis=1)
+
+
+def probabilities(model, x):
+    """Probability of class 1 for a batch of uint8-range images."""
+    return class_one_probability(model.predict_on_batch(x * (1. / 255)))
+
+
+class PredictionWriter:
+    """Appends prediction records to a .csv or .jsonl file."""
+
+    FIELDS = ['path', 'probability', 'label', 'error']
+
+    def __init__(self, out_path):
+        self.jsonl = not out_path.endswith('.csv')
+        new = not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+        self.f = open(out_path, 'a', newline='')
+        if not self.jsonl:
+            self.writer = csv.DictWriter(self.f, fieldnames=self.FIELDS)
+            if new:
+                self.writer.writeheader()
+
+    def write(self, records):
+        for record in records:
+            if self.jsonl:
+                self.f.write(json.dumps(record) + '\n')
+            else:
+                # exception texts can span lines; a record stays on one
+                if record.get('error'):
+                    record = dict(record, error=' '.join(str(record['error']).splitlines()))
+                self.writer.writerow(record)
+        self.f.flush()
+
+    def close(self):
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+
+def predict_stream(model, paths, out_path, class_names=('men', 'women'), batch_size=256,
+                   img_shape=150, workers=8, threshold=0.5, draft=False):
+    """Predict every path not already in `out_path`; returns how many were processed."""
+    paths = itertools.islice(paths, completed_count(out_path), None)
+    writer = PredictionWriter(out_path)
+    done = 0
+    batch = []
+
+    def flush(batch):
+        images = [img for _, img, _ in batch if img is not None]
+        probs = iter(probabilities(model, np.stack(images).astype(np.float32)) if images else [])
+        records = []
+        for path, img, error in batch:
+            if img is None:
+                records.append(dict(path=path, probability='', label='', error=error))
+            else:
+                p = float(next(probs))
+                records.append(dict(path=path, probability=round(p, 6),
+                                    label=class_names[int(p >= threshold)], error=''))
+        writer.write(records)
+
+    try:
+        for item in decoded_stream(paths, img_shape, workers, max_pending=2 * batch_size, draft=draft):
+            batch.append(item)
+            if len(batch) == batch_size:
+                flush(batch)
+                done += len(batch)
+                batch = []
+        if batch:
+            flush(batch)
+            done += len(batch)
+    finally:
+        writer.close()
+    return done
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model', help='saved Keras model')
+    parser.add_argument('source', help='directory of images, or a text file with one path per line')
+    parser.add_argument('--out', default='predictions.csv', help='.csv or .jsonl output, appended to on resume')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=8, help='decode threads')
+    parser.add_argument('--img-shape', type=int, default=150)
+    parser.add_argument('--classes', nargs=2, default=['men', 'women'])
+    parser.add_argument('--draft', action='store_true', help='decode JPEGs at a reduced DCT scale')
+    parser.add_argument('--tta-views', type=int, default=1, help='test-time augmentation views per image')
+    args = parser.parse_args()
+
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(args.model, compile=False)
+    if args.tta_views > 1:
+        from tta import TTAModel
+
+        model = TTAModel(model, args.tta_views)
+    paths = iter_directory(args.source) if os.path.isdir(args.source) else iter_file_list(args.source)
+    n = predict_stream(model, paths, args.out, args.classes, args.batch_size, args.img_shape, args.workers,
+                       draft=args.draft)
+    print('Predicted', n, 'images into', args.out)
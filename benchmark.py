@@ -0,0 +1,211 @@
+"""Performance benchmarks: input pipelines, JPEG decode, train steps, inference latency, peak RSS.
+
+Runs on a fixed sample of the dataset (--data) or on synthetic 150x150 JPEGs
+(--synthetic N). Every measurement runs in its own process so that its peak
+RSS is its own. Results go to a JSON file stamped with the git commit, and
+--compare prints the change against an earlier result file.
+
+    python benchmark.py --synthetic 512 --out bench.json
+    python benchmark.py --data data --sample 1024 --out bench.json --compare bench_old.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sweep import BATCH_SIZE, EXPERIMENTS, IMG_SHAPE
+
+MODELS = [dict(name='SimpleCNN', backbone='SimpleCNN', trainable_layers=None)] + [
+    dict(name=c['name'], backbone=c['backbone'], trainable_layers=c['trainable_layers'], dropout=c['dropout'])
+    for c in EXPERIMENTS]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def make_synthetic_dataset(directory, n, img_shape=IMG_SHAPE, seed=0):
+    """Write n random JPEGs split over men/women class folders."""
+    from PIL import Image
+
+    rng = np.random.RandomState(seed)
+    for i in range(n):
+        class_dir = os.path.join(directory, ('men', 'women')[i % 2])
+        os.makedirs(class_dir, exist_ok=True)
+        pixels = rng.randint(0, 256, (img_shape, img_shape, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(class_dir, '%06d.jpg' % i), quality=90)
+
+
+def sample_dataset(source, directory, n, seed=0):
+    """Symlink a fixed random sample of n images of `source` into `directory`."""
+    from image_cache import list_images
+
+    paths, _, _ = list_images(source)
+    for i in sorted(np.random.RandomState(seed).choice(len(paths), min(n, len(paths)), replace=False)):
+        class_dir = os.path.join(directory, os.path.basename(os.path.dirname(paths[i])))
+        os.makedirs(class_dir, exist_ok=True)
+        os.symlink(os.path.abspath(paths[i]), os.path.join(class_dir, os.path.basename(paths[i])))
+
+
+def benchmark_decode(directory):
+    """Images/sec of decode_image with and without JPEG draft scaling, and how much the pixels differ."""
+    from image_cache import decode_image, list_images
+
+    paths = list_images(directory)[0]
+    for path in paths:  # both passes then read from the page cache
+        with open(path, 'rb') as f:
+            f.read()
+    results, decoded = {}, {}
+    for name, draft in (('pil_decode', False), ('draft_decode', True)):
+        start = time.perf_counter()
+        decoded[name] = np.stack([decode_image(p, IMG_SHAPE, draft) for p in paths])
+        results[name] = len(paths) / (time.perf_counter() - start)
+    diff = np.abs(decoded['pil_decode'].astype(np.int16) - decoded['draft_decode'])
+    mse = float((diff.astype(np.float64) ** 2).mean())
+    results['draft_speedup'] = results['draft_decode'] / results['pil_decode']
+    results['draft_mean_abs_diff'] = float(diff.mean())
+    results['draft_max_abs_diff'] = float(diff.max())
+    # None when the two decodes are identical (e.g. sources already at 150x150)
+    results['draft_psnr_db'] = 10 * np.log10(255. ** 2 / mse) if mse else None
+    return results
+
+
+def benchmark_input(directory, cache_dir):
+    """Images/sec of one epoch for each input pipeline over `directory`."""
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    from batch_augment import BatchAugmenter
+    from image_cache import CachedImageSequence, ingest_directory
+    from tf_pipeline import images_per_second, make_dataset
+
+    augmenter = BatchAugmenter(0.1, 0.1, horizontal_flip=True, seed=0)
+    datagen = ImageDataGenerator(rescale=1./255, width_shift_range=0.1, height_shift_range=0.1,
+                                 horizontal_flip=True, fill_mode='nearest')
+    generator = datagen.flow_from_directory(directory, batch_size=BATCH_SIZE,
+                                            target_size=(IMG_SHAPE, IMG_SHAPE), class_mode='binary')
+    steps = len(generator)
+    results = dict(image_data_generator=images_per_second(generator, steps))
+
+    start = time.perf_counter()
+    ingest_directory(directory, 'bench', cache_dir, shuffle=True)
+    results['cache_ingest'] = generator.samples / (time.perf_counter() - start)
+    results['cache'] = images_per_second(
+        CachedImageSequence('bench', BATCH_SIZE, shuffle=True, augment=augmenter, cache_dir=cache_dir), steps)
+
+    dataset = make_dataset(directory, BATCH_SIZE, augment=augmenter, seed=0)
+    results['tfdata_first_epoch'] = images_per_second(dataset, steps)
+    results['tfdata_cached_epoch'] = images_per_second(dataset, steps)
+    results.update(benchmark_decode(directory))
+    results = {k: v if v is None else round(v, 2 if k.startswith('draft_') else 1) for k, v in results.items()}
+    results['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return results
+
+
+def benchmark_model(config, batch_size=BATCH_SIZE, steps=10):
+    """Train-step time and inference latency of one model on random inputs.
+
+    Weights are not downloaded (weights=None); the trainable layers are the
+    same as in the experiment, which is what the step time depends on.
+    """
+    from export_tflite import latency_ms
+    from sweep import build_model, build_simple_cnn
+
+    model = build_simple_cnn() if config['backbone'] == 'SimpleCNN' else build_model(config, weights=None)
+    rng = np.random.RandomState(0)
+    x = rng.rand(batch_size, IMG_SHAPE, IMG_SHAPE, 3).astype(np.float32)
+    y = (rng.rand(batch_size) > 0.5).astype(np.float32)
+
+    for _ in range(2):
+        model.train_on_batch(x, y)
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        model.train_on_batch(x, y)
+        times.append(time.perf_counter() - start)
+    step_ms = float(np.median(times)) * 1000
+
+    batch_ms = latency_ms(model, x)
+    return dict(name=config['name'], backbone=config['backbone'], trainable_layers=config['trainable_layers'],
+                train_step_ms=round(step_ms, 1), train_images_per_sec=round(batch_size / step_ms * 1000, 1),
+                single_ms=round(latency_ms(model, x[:1]), 2), batch_ms=round(batch_ms, 2),
+                batch_per_image_ms=round(batch_ms / batch_size, 2), peak_rss_mb=round(peak_rss_mb(), 1))
+
+
+def in_subprocess(fn, *args):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(new, old):
+    """Print the relative change of every numeric result between two benchmark files."""
+    def flatten(results):
+        flat = {('input', k): v for k, v in results['input_pipeline'].items()}
+        for row in results['models']:
+            flat.update({(row['name'], k): v for k, v in row.items() if isinstance(v, (int, float))})
+        return flat
+
+    new_flat, old_flat = flatten(new), flatten(old)
+    for key in sorted(new_flat, key=str):
+        if key in old_flat and old_flat[key] and new_flat[key] is not None:
+            change = (new_flat[key] - old_flat[key]) / old_flat[key] * 100
+            print('%-28s %-22s %10s -> %10s  %+6.1f%%' % (key + (old_flat[key], new_flat[key], change)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic images to use')
+    parser.add_argument('--data', default='data', help='dataset to sample from when not synthetic')
+    parser.add_argument('--sample', type=int, default=1024, help='images sampled from <data>/train')
+    parser.add_argument('--models', nargs='*', help='model names to benchmark (default: all)')
+    parser.add_argument('--steps', type=int, default=10, help='timed train steps per model')
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench')
+    try:
+        data_dir = os.path.join(work_dir, 'images')
+        if args.synthetic:
+            make_synthetic_dataset(data_dir, args.synthetic)
+        else:
+            sample_dataset(os.path.join(args.data, 'train'), data_dir, args.sample)
+        input_results = in_subprocess(benchmark_input, data_dir, os.path.join(work_dir, 'cache'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print('input pipeline:', input_results)
+
+    model_results = []
+    for config in MODELS:
+        if args.models and config['name'] not in args.models:
+            continue
+        model_results.append(in_subprocess(benchmark_model, config, BATCH_SIZE, args.steps))
+        print(model_results[-1])
+
+    import tensorflow as tf
+
+    results = dict(commit=git_commit(), time=time.strftime('%Y-%m-%dT%H:%M:%S'), host=platform.node(),
+                   cpus=len(os.sched_getaffinity(0)), tensorflow=tf.__version__,
+                   data='synthetic %d' % args.synthetic if args.synthetic else '%s sample %d' % (args.data, args.sample),
+                   input_pipeline=input_results, models=model_results)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,241 @@
+"""Train frozen-backbone models on cached bottleneck activations.
+
+When only the last few layers of a backbone are trainable, the frozen prefix
+gives the same output for an image on every epoch. Here the prefix is run once
+per (backbone, freeze point, image), its activations are saved under
+cache/bottleneck/, and the epochs only train the trainable tail plus the
+Flatten/Dropout/Dense head on those tensors.
+
+Augmentation has to be decided up front: either cache a fixed number of
+augmented views of the training set (views > 1, each pass over an augmenting
+sequence gives new random transforms) or cache a single plain view.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import tensorflow as tf
+
+from manifest import fingerprint
+
+BOTTLENECK_DIR = os.path.join('cache', 'bottleneck')
+
+
+def _tensor_key(t):
+    layer, node_index, tensor_index = t._keras_history[:3]
+    return layer.name, node_index, tensor_index
+
+
+def _map_tensors(structure, tensors):
+    return tf.nest.map_structure(
+        lambda t: tensors[_tensor_key(t)] if hasattr(t, '_keras_history') else t, structure)
+
+
+def split_model(net, split):
+    """Split a functional model before `net.layers[split]` into (prefix, tail).
+
+    The prefix outputs every tensor made before the cut that the later layers
+    consume, which is more than one when skip connections cross the cut (e.g.
+    the DenseNet concatenations). The tail rebuilds `net.layers[split:]` on new
+    Inputs of those shapes and shares their weights, so training the tail
+    trains the original layers.
+    """
+    head = set(layer.name for layer in net.layers[:split])
+    tail_layers = net.layers[split:]
+
+    boundary = {}
+    if not tail_layers:
+        boundary[_tensor_key(net.output)] = net.output
+    for layer in tail_layers:
+        node = layer._inbound_nodes[0]
+        for t in tf.nest.flatten((node.call_args, node.call_kwargs)):
+            if hasattr(t, '_keras_history') and t._keras_history[0].name in head:
+                boundary.setdefault(_tensor_key(t), t)
+    boundary = list(boundary.items())
+
+    prefix = tf.keras.Model(net.input, [t for _, t in boundary], name=net.name + '_prefix')
+
+    inputs = [tf.keras.Input(shape=t.shape[1:], name='bottleneck_%d' % i)
+              for i, (_, t) in enumerate(boundary)]
+    tensors = {key: x for (key, _), x in zip(boundary, inputs)}
+    for layer in tail_layers:
+        node = layer._inbound_nodes[0]
+        args = _map_tensors(node.call_args, tensors)
+        kwargs = _map_tensors(node.call_kwargs, tensors)
+        out = layer(*args, **kwargs)
+        for i, t in enumerate(tf.nest.flatten(out)):
+            tensors[(layer.name, 0, i)] = t
+    tail_output = tensors[_tensor_key(net.output)]
+    return prefix, (inputs, tail_output)
+
+
+def cache_key(backbone, split, dataset, views=1, img_shape=150, draft=False):
+    return '%s_%d%s_split%d_%s_v%d' % (backbone, img_shape, '_draft' if draft else '', split, dataset, views)
+
+
+def decoded_draft(sequence, default=False):
+    """Whether `sequence` decodes its JPEGs at a reduced DCT scale; `default` if it does not tell."""
+    index = getattr(sequence, 'index', None)
+    if isinstance(index, dict) and 'draft' in index:
+        return bool(index['draft'])
+    if hasattr(sequence, 'draft'):
+        return bool(sequence.draft)
+    if hasattr(sequence, 'filepaths'):  # flow_from_directory never does
+        return False
+    return default
+
+
+def source_fingerprint(sequence):
+    """One hash of the images behind `sequence`, or None when it cannot tell which they are.
+
+    Content hashes of a cache index (see manifest.py) are used when there are
+    some; otherwise the path, size and mtime of every file (flow_from_directory)
+    or the name, offset and size of every zip member (ZipImageSequence).
+    """
+    index = getattr(sequence, 'index', None)
+    if isinstance(index, dict) and index.get('hashes') is not None:
+        return fingerprint(index['hashes'])
+    if getattr(sequence, 'filepaths', None) is not None:
+        stats = [(path, os.stat(path)) for path in sequence.filepaths]
+        return fingerprint(['%s %d %d' % (path, st.st_size, st.st_mtime_ns) for path, st in stats])
+    if getattr(sequence, 'members', None) is not None:
+        return fingerprint(['%s %d %d' % tuple(member[:3]) for member in sequence.members])
+    return None
+
+
+def _batches(sequence):
+    if hasattr(sequence, '__getitem__') and hasattr(sequence, '__len__'):
+        return (sequence[i] for i in range(len(sequence)))
+    return iter(sequence)
+
+
+def cache_features(prefix, sequence, key, views=1, dtype=np.float16, cache_dir=BOTTLENECK_DIR, samples=None,
+                   draft=False):
+    """Run `prefix` over `views` passes of `sequence` and save the activations.
+
+    `sequence` is a Sequence, generator or tf.data Dataset; `samples` is the
+    number of images in one pass and defaults to `sequence.samples`; `draft`
+    is used when the sequence does not tell how it was decoded.
+    Does nothing if the cache `key` is already complete and was made from the
+    same images (see source_fingerprint) at the same size and decoding. A
+    source without a fingerprint is always computed again.
+    """
+    meta = {'fingerprint': source_fingerprint(sequence),
+            'img_shape': tf.keras.backend.int_shape(prefix.input)[1], 'draft': decoded_draft(sequence, draft)}
+
+    out_dir = os.path.join(cache_dir, key)
+    meta_path = os.path.join(out_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            old = json.load(f)
+        if meta['fingerprint'] is not None and all(old.get(k) == v for k, v in meta.items()):
+            return out_dir
+        if meta['fingerprint'] is None:
+            print('Rebuilding %s: cannot tell whether its images changed' % key)
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    n = (samples or sequence.samples) * views
+    shapes = [t.shape[1:] for t in tf.nest.flatten(prefix.output)]
+    features = [np.lib.format.open_memmap(os.path.join(out_dir, 'features_%d.npy' % i), mode='w+',
+                                          dtype=dtype, shape=(n,) + tuple(s))
+                for i, s in enumerate(shapes)]
+    labels = np.zeros(n, dtype=np.float32)
+
+    row = 0
+    for view in range(views):
+        for x, y in _batches(sequence):
+            outputs = tf.nest.flatten(prefix.predict_on_batch(x))
+            for f, out in zip(features, outputs):
+                f[row:row + len(y)] = out
+            labels[row:row + len(y)] = y
+            row += len(y)
+        if hasattr(sequence, 'on_epoch_end'):
+            sequence.on_epoch_end()
+
+    for f in features:
+        f.flush()
+    np.save(os.path.join(out_dir, 'labels.npy'), labels[:row])
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(meta, samples=row, views=views, shapes=[list(s) for s in shapes]), f)
+    return out_dir
+
+
+class FeatureSequence(tf.keras.utils.Sequence):
+    """Serves ([bottleneck tensors], y) batches from a feature cache."""
+
+    def __init__(self, out_dir, batch_size=32, shuffle=False, seed=None):
+        super().__init__()
+        with open(os.path.join(out_dir, 'meta.json')) as f:
+            self.samples = json.load(f)['samples']
+        self.features = []
+        i = 0
+        while os.path.exists(os.path.join(out_dir, 'features_%d.npy' % i)):
+            self.features.append(np.load(os.path.join(out_dir, 'features_%d.npy' % i), mmap_mode='r'))
+            i += 1
+        self.labels = np.load(os.path.join(out_dir, 'labels.npy'))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.order = np.arange(self.samples)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (self.samples + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        # sorted rows keep the reads from the memory map mostly sequential
+        rows = np.sort(self.order[idx * self.batch_size:(idx + 1) * self.batch_size])
+        x = [f[rows].astype(np.float32) for f in self.features]
+        return x, self.labels[rows]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+
+def build_tail_model(tail, dropout=0.5):
+    """The notebook's Flatten -> Dropout -> Dense(1) head on top of the tail."""
+    inputs, x = tail
+    x = tf.keras.layers.Flatten()(x)
+    x = tf.keras.layers.Dropout(dropout)(x)
+    output_layer = tf.keras.layers.Dense(1, activation='sigmoid', name='sigmoid')(x)
+    return tf.keras.Model(inputs=inputs, outputs=output_layer)
+
+
+def fit_from_bottleneck(net, name, trainable_layers, train_sequence, val_sequence,
+                        epochs=10, dropout=0.5, views=1, batch_size=32, callbacks=None, train_samples=None,
+                        draft=False):
+    """Train `net` with its last `trainable_layers` layers trainable, from cached activations.
+
+    `train_sequence` should augment when views > 1 and be plain otherwise;
+    `val_sequence` is never augmented. `train_samples` is needed when the
+    training data has no .samples (a tf.data Dataset); `draft` tells whether
+    data that does not say so itself was draft-decoded. Returns (model,
+    history) where model is the tail + head, taking the cached tensors as
+    input.
+    """
+    split = len(net.layers) - trainable_layers
+    for layer in net.layers[:split]:
+        layer.trainable = False
+    prefix, tail = split_model(net, split)
+
+    img_shape = tf.keras.backend.int_shape(net.input)[1]
+    train_draft, val_draft = decoded_draft(train_sequence, draft), decoded_draft(val_sequence, draft)
+    train_key = cache_key(name, split, 'train', views, img_shape, train_draft)
+    val_key = cache_key(name, split, 'validation', 1, img_shape, val_draft)
+    train_dir = cache_features(prefix, train_sequence, train_key, views, samples=train_samples, draft=train_draft)
+    val_dir = cache_features(prefix, val_sequence, val_key, draft=val_draft)
+
+    model = build_tail_model(tail, dropout)
+    opt = tf.keras.optimizers.RMSprop(learning_rate=0.0001, decay=1e-6)
+    model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['accuracy'])
+
+    history = model.fit(
+        FeatureSequence(train_dir, batch_size, shuffle=True),
+        epochs=epochs,
+        callbacks=callbacks,
+        validation_data=FeatureSequence(val_dir, batch_size),
+    )
+    return model, history
@@ -0,0 +1,165 @@
+"""Resumable training and a registry of finished runs.
+
+fit_resumable wraps model.fit with an atomic checkpoint of the weights and
+optimizer state after every epoch. Re-running it with the same run directory
+resumes from the last complete epoch, including the EarlyStopping counters.
+Runs that already finished just get their final weights loaded back.
+
+The registry keys runs by a hash of their experiment config (everything but
+the display name), so an identical config re-uses its finished weights
+instead of training again.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import tensorflow as tf
+
+REGISTRY_DIR = 'registry'
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class EpochCheckpoint(tf.keras.callbacks.Callback):
+    """Checkpoints model, optimizer and EarlyStopping state at the end of every epoch.
+
+    A checkpoint only counts once state.json points at it; the pointer is
+    replaced atomically after the checkpoint files are written, so a crash
+    mid-save leaves the previous epoch as the resume point.
+    """
+
+    def __init__(self, run_dir, early_stopping=None, history=None, resume_state=None):
+        super().__init__()
+        self.run_dir = run_dir
+        self.early_stopping = early_stopping
+        self.history = history or {}
+        self.resume_state = resume_state
+
+    def on_train_begin(self, logs=None):
+        # EarlyStopping resets itself in on_train_begin, so its state comes back here
+        es, state = self.early_stopping, self.resume_state
+        if es is not None and state and state.get('early_stopping'):
+            es.wait = state['early_stopping']['wait']
+            es.best = state['early_stopping']['best']
+            best_weights = os.path.join(self.run_dir, state['checkpoint_dir'], 'best_weights.npz')
+            if os.path.exists(best_weights):
+                with np.load(best_weights) as f:
+                    es.best_weights = [f['arr_%d' % i] for i in range(len(f.files))]
+
+    def on_epoch_end(self, epoch, logs=None):
+        for k, v in (logs or {}).items():
+            self.history.setdefault(k, []).append(float(v))
+
+        checkpoint_dir = 'epoch-%d' % (epoch + 1)
+        path = os.path.join(self.run_dir, checkpoint_dir)
+        shutil.rmtree(path, ignore_errors=True)
+        tf.train.Checkpoint(model=self.model, optimizer=self.model.optimizer).write(os.path.join(path, 'ckpt'))
+
+        es_state = None
+        es = self.early_stopping
+        if es is not None:
+            es_state = dict(wait=es.wait, best=float(es.best))
+            if es.best_weights is not None:
+                np.savez(os.path.join(path, 'best_weights.npz'), *es.best_weights)
+
+        _write_json(os.path.join(self.run_dir, 'state.json'),
+                    dict(epoch=epoch + 1, checkpoint_dir=checkpoint_dir, history=self.history,
+                         early_stopping=es_state, stopped=bool(self.model.stop_training), complete=False))
+        for old in glob.glob(os.path.join(self.run_dir, 'epoch-*')):
+            if os.path.basename(old) != checkpoint_dir:
+                shutil.rmtree(old, ignore_errors=True)
+
+    def on_train_end(self, logs=None):
+        # after EarlyStopping(restore_best_weights=True) has put the best weights back
+        self.model.save_weights(os.path.join(self.run_dir, 'final.weights.h5'))
+        state = _read_json(os.path.join(self.run_dir, 'state.json')) or dict(history=self.history)
+        state['complete'] = True
+        _write_json(os.path.join(self.run_dir, 'state.json'), state)
+
+
+def fit_resumable(model, run_dir, x, epochs, callbacks=None, **fit_kwargs):
+    """model.fit that resumes from `run_dir` and returns a History covering all epochs.
+
+    A finished run asked for more epochs than it trained continues from its
+    last checkpoint, so a run can be extended budget by budget.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    callbacks = list(callbacks or [])
+    state = _read_json(os.path.join(run_dir, 'state.json'))
+    history = tf.keras.callbacks.History()
+
+    if state and state['complete'] and (state['stopped'] or state['epoch'] >= epochs):
+        model.load_weights(os.path.join(run_dir, 'final.weights.h5'))
+        history.history = state['history']
+        history.epoch = []
+        return history
+
+    initial_epoch = 0
+    if state:
+        checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+        checkpoint.restore(os.path.join(run_dir, state['checkpoint_dir'], 'ckpt')).expect_partial()
+        initial_epoch = state['epoch']
+        print('Resuming %s from epoch %d' % (run_dir, initial_epoch))
+
+    early_stopping = next((c for c in callbacks if isinstance(c, tf.keras.callbacks.EarlyStopping)), None)
+    checkpoint = EpochCheckpoint(run_dir, early_stopping, state['history'] if state else None, state)
+    if state and state['stopped']:
+        # early stopping had already ended the run, which crashed before on_train_end; an empty
+        # fit would not restore the best weights (EarlyStopping only does that inside an epoch)
+        checkpoint.set_model(model)
+        checkpoint.on_train_begin()
+        if early_stopping is not None and early_stopping.restore_best_weights and early_stopping.best_weights:
+            model.set_weights(early_stopping.best_weights)
+        checkpoint.on_train_end()
+        history.history = state['history']
+        history.epoch = []
+        return history
+    model.fit(x, epochs=epochs, initial_epoch=initial_epoch, callbacks=callbacks + [checkpoint], **fit_kwargs)
+    history.history = checkpoint.history
+    # like History.epoch, only the epochs that ran in this call
+    history.epoch = list(range(initial_epoch, len(checkpoint.history.get('loss', []))))
+    return history
+
+
+def config_key(config):
+    """Stable hash of an experiment config, ignoring its display name."""
+    settings = {k: v for k, v in config.items() if k != 'name'}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def run_dir(config, registry_dir=REGISTRY_DIR):
+    path = os.path.join(registry_dir, config_key(config))
+    os.makedirs(path, exist_ok=True)
+    if not os.path.exists(os.path.join(path, 'config.json')):
+        _write_json(os.path.join(path, 'config.json'), config)
+    return path
+
+
+def lookup(config, registry_dir=REGISTRY_DIR):
+    """(weights path, result) of a finished run of `config`, or None."""
+    path = os.path.join(registry_dir, config_key(config))
+    result = _read_json(os.path.join(path, 'result.json'))
+    if result is None:
+        return None
+    return os.path.join(path, 'final.weights.h5'), result
+
+
+def register(config, result, registry_dir=REGISTRY_DIR):
+    """Mark the run of `config` as finished with its `result` row."""
+    _write_json(os.path.join(run_dir(config, registry_dir), 'result.json'), result)
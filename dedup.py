@@ -0,0 +1,239 @@
+"""Near-duplicate and train/validation leakage detection with perceptual hashes.
+
+Every image gets a 64-bit DCT perceptual hash, computed with a few matrix
+products over whole chunks of the decoded image cache (no per-image Python).
+Near-duplicates are pairs within a Hamming radius, found with a multi-index
+hash: the 64 bits are split into m chunks, and by the pigeonhole principle two
+codes within radius r agree to within r // m bits on at least one chunk, so
+only the codes in a few sorted-bucket probes per chunk are ever compared.
+
+The output is a deduplicated manifest: every image with its hash, its
+duplicate cluster and whether to keep it. In a cluster that spans both splits
+one validation image is kept and the others dropped, so training never sees
+a copy of a validation image. kept_paths reads the kept paths of a split back,
+for manifest.refresh_image_cache(..., keep=...) to cache only those.
+
+    python dedup.py --radius 6 --out dedup_manifest.csv
+"""
+import argparse
+import csv
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_cache import decode_image, has_cache, list_images, load_cache
+
+HASH_SIZE = 8  # 8x8 lowest DCT frequencies -> 64 bits
+
+
+def _area_resize_matrix(size_in, size_out):
+    """Matrix averaging `size_in` samples down to `size_out` equal-width cells."""
+    edges = np.linspace(0, size_in, size_out + 1)
+    m = np.zeros((size_out, size_in))
+    for i in range(size_out):
+        for j in range(size_in):
+            m[i, j] = max(0., min(edges[i + 1], j + 1) - max(edges[i], j))
+    return m / m.sum(axis=1, keepdims=True)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    d = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2. / n)
+    d[0] /= np.sqrt(2)
+    return d
+
+
+def phash_projection(img_shape, resize=32):
+    """Resize to 32x32 and keep the 8x8 lowest DCT frequencies, as one (8, img_shape) matrix."""
+    return (_dct_matrix(resize)[:HASH_SIZE] @ _area_resize_matrix(img_shape, resize)).astype(np.float32)
+
+
+def phash(images, chunk_size=4096):
+    """uint64 perceptual hashes of a (N, H, W, 3) uint8 array (or memmap), chunk by chunk."""
+    m = phash_projection(images.shape[1])
+    gray_weights = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    codes = np.empty(len(images), dtype=np.uint64)
+    for start in range(0, len(images), chunk_size):
+        gray = images[start:start + chunk_size].astype(np.float32) @ gray_weights
+        coeffs = (m @ gray @ m.T).reshape(len(gray), -1)
+        # the DC term only carries brightness, leave it out of the median
+        bits = coeffs > np.median(coeffs[:, 1:], axis=1, keepdims=True)
+        codes[start:start + len(gray)] = np.packbits(bits, axis=1).view('>u8')[:, 0]
+    return codes
+
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(x):
+        return np.bitwise_count(x).astype(np.int64)
+else:
+    _POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+    def popcount(x):
+        return _POPCOUNT8[x.view(np.uint8).reshape(len(x), 8)].sum(axis=1)
+
+
+def _flip_masks(width, radius):
+    """All `width`-bit masks with at most `radius` bits set."""
+    masks = []
+    for r in range(radius + 1):
+        for bits in itertools.combinations(range(width), r):
+            masks.append(sum(1 << b for b in bits))
+    return np.array(masks, dtype=np.uint64)
+
+
+class MultiIndexHash:
+    """Hamming-radius search over uint64 codes with one sorted table per bit chunk."""
+
+    def __init__(self, codes, chunks=None):
+        self.codes = np.asarray(codes, dtype=np.uint64)
+        if chunks is None:
+            # about log2(N) bits per chunk keeps the buckets near one entry each
+            bits = max(8, int(np.ceil(np.log2(max(len(self.codes), 2)))))
+            chunks = max(2, 64 // bits)
+        self.chunks = chunks
+        widths = [64 // chunks + (i < 64 % chunks) for i in range(chunks)]
+        self.tables = []
+        shift = 0
+        for width in widths:
+            values = (self.codes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+            order = np.argsort(values, kind='stable')
+            self.tables.append((shift, width, order, values[order]))
+            shift += width
+
+    def _candidates(self, queries, radius):
+        """(query row, code index) pairs sharing a chunk within radius // chunks bits."""
+        rows, cols = [], []
+        for shift, width, order, values in self.tables:
+            q = (queries >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+            for flip in _flip_masks(width, radius // self.chunks):
+                probe = q ^ flip
+                lo = np.searchsorted(values, probe, 'left')
+                counts = np.searchsorted(values, probe, 'right') - lo
+                total = counts.sum()
+                if not total:
+                    continue
+                starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+                rows.append(np.repeat(np.arange(len(queries)), counts))
+                cols.append(order[starts + np.arange(total)])
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(rows), np.concatenate(cols)
+
+    def query(self, code, radius):
+        """(indices, distances) of all codes within `radius` of one code."""
+        _, cols = self._candidates(np.array([code], dtype=np.uint64), radius)
+        cols = np.unique(cols)
+        dist = popcount(self.codes[cols] ^ np.uint64(code))
+        keep = dist <= radius
+        return cols[keep], dist[keep]
+
+    def pairs(self, radius, block=16384):
+        """All (i, j, distance) with i < j and Hamming distance <= radius."""
+        n = len(self.codes)
+        found = []
+        for start in range(0, n, block):
+            rows, cols = self._candidates(self.codes[start:start + block], radius)
+            rows = rows + start
+            keep = cols > rows
+            rows, cols = rows[keep], cols[keep]
+            # a pair can come up in several chunks
+            pair_ids = np.unique(rows.astype(np.int64) * n + cols)
+            rows, cols = pair_ids // n, pair_ids % n
+            dist = popcount(self.codes[rows] ^ self.codes[cols])
+            keep = dist <= radius
+            found.append(np.stack([rows[keep], cols[keep], dist[keep]], axis=1))
+        return np.concatenate(found) if found else np.zeros((0, 3), dtype=np.int64)
+
+
+def clusters(n, pairs):
+    """Cluster id of every item given the duplicate pairs: the smallest index in its component."""
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs[:, :2]:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    # roots point at themselves, so pointer jumping flattens every chain
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+
+def hash_split(split, data_dir='data', chunk_size=4096, workers=8):
+    """(paths, labels, hashes) of a split, from the decoded cache when there is one.
+
+    Without a cache the images are decoded chunk by chunk, so memory stays
+    bounded by `chunk_size` whatever the size of the split.
+    """
+    if has_cache(split):
+        images, labels, index = load_cache(split)
+        return index['paths'], labels, phash(images, chunk_size)
+    paths, labels, _ = list_images('%s/%s' % (data_dir, split))
+    codes = np.empty(len(paths), dtype=np.uint64)
+    with ThreadPoolExecutor(workers) as pool:
+        for start in range(0, len(paths), chunk_size):
+            images = np.stack(list(pool.map(decode_image, paths[start:start + chunk_size])))
+            codes[start:start + len(images)] = phash(images, chunk_size)
+    return paths, labels, codes
+
+
+def deduplicate(splits=('validation', 'train'), radius=6, data_dir='data'):
+    """Rows of the deduplicated manifest, the number of duplicate pairs and of clusters leaking across splits."""
+    paths, split_of, labels, codes = [], [], [], []
+    for split in splits:
+        p, l, c = hash_split(split, data_dir)
+        paths += p
+        split_of += [split] * len(p)
+        labels.append(l)
+        codes.append(c)
+    labels, codes = np.concatenate(labels), np.concatenate(codes)
+
+    pairs = MultiIndexHash(codes).pairs(radius)
+    cluster = clusters(len(codes), pairs)
+    # splits are listed validation first, so a cluster's id (its smallest
+    # index) is a validation image whenever the cluster has one
+    keep = cluster == np.arange(len(codes))
+    split_arr = np.array(split_of)
+    leaking = len(np.unique(cluster[split_arr != split_arr[cluster]]))
+    rows = [dict(path=paths[i], split=split_of[i], label=int(labels[i]), phash='%016x' % codes[i],
+                 cluster=int(cluster[i]), keep=bool(keep[i]),
+                 duplicate_of='' if keep[i] else paths[cluster[i]])
+            for i in range(len(codes))]
+    return rows, len(pairs), leaking
+
+
+def write_manifest(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['path', 'split', 'label', 'phash', 'cluster', 'keep', 'duplicate_of'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def kept_paths(path, split):
+    """Paths of `split` that a deduplicated manifest keeps."""
+    with open(path, newline='') as f:
+        return [r['path'] for r in csv.DictReader(f) if r['split'] == split and r['keep'] == 'True']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--radius', type=int, default=6, help='max Hamming distance between duplicates')
+    parser.add_argument('--data', default='data')
+    parser.add_argument('--out', default='dedup_manifest.csv')
+    args = parser.parse_args()
+
+    rows, n_pairs, leaking = deduplicate(radius=args.radius, data_dir=args.data)
+    write_manifest(rows, args.out)
+    for split in ('train', 'validation'):
+        dropped = sum(1 for r in rows if r['split'] == split and not r['keep'])
+        print('%s: %d images, %d near-duplicates dropped' % (split, sum(r['split'] == split for r in rows), dropped))
+    print('%d duplicate pairs, %d clusters span train and validation' % (n_pairs, leaking))
@@ -0,0 +1,176 @@
+"""Distill the Xception model into the notebook's simple CNN.
+
+The teacher runs once over the decoded training cache and its logits are
+saved next to it (cache/teacher/), keyed by the teacher file and the cache
+contents. The student (sweep.build_simple_cnn) then trains on a mix of the
+hard labels and the teacher's temperature-softened predictions:
+
+    loss = alpha * CE(y, student) + (1 - alpha) * T^2 * KL(softmax(teacher / T) || softmax(student / T))
+
+The teacher has a single sigmoid output; its logit z becomes the two-class
+logits [0, z], which have the same probabilities.
+
+Teacher logits belong to the un-augmented images; with augmentation on, the
+student sees a shifted/flipped image with the soft label of the original.
+
+The report compares validation accuracy and CPU latency of the teacher, the
+simple CNN trained on hard labels only and the distilled student.
+
+    python distill.py models/Xception.h5 --epochs 30 --out models/SimpleCNN_distilled.h5
+"""
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from batch_augment import BatchAugmenter
+from export_tflite import REPORT_FIELDS, load_validation, report_row
+from image_cache import CACHE_DIR, CachedImageSequence, has_cache, ingest_directory
+from manifest import fingerprint
+from sweep import BATCH_SIZE, build_simple_cnn
+
+TEACHER_DIR = os.path.join(CACHE_DIR, 'teacher')
+
+
+def teacher_logits(teacher_path, name='train', batch_size=64, cache_dir=TEACHER_DIR):
+    """Logits of the teacher for every row of the decoded cache `name`, computed once."""
+    sequence = CachedImageSequence(name, batch_size)
+    st = os.stat(teacher_path)
+    hashes = sequence.index.get('hashes')
+    key = dict(teacher=os.path.abspath(teacher_path), size=st.st_size, mtime=st.st_mtime,
+               images=fingerprint(hashes) if hashes is not None else sequence.index['paths'])
+    base = os.path.join(cache_dir, '%s_%s' % (os.path.splitext(os.path.basename(teacher_path))[0], name))
+    if os.path.exists(base + '.json'):
+        with open(base + '.json') as f:
+            if json.load(f) == key:
+                return np.load(base + '.npy')
+
+    teacher = tf.keras.models.load_model(teacher_path, compile=False)
+    logits = np.zeros(sequence.samples, dtype=np.float32)
+    for i in range(len(sequence)):
+        x, _ = sequence[i]
+        p = np.asarray(teacher.predict_on_batch(x), dtype=np.float64)[:, 0]
+        p = np.clip(p, 1e-7, 1 - 1e-7)
+        logits[i * batch_size:i * batch_size + len(p)] = np.log(p / (1 - p))
+    tf.keras.backend.clear_session()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(base + '.npy', logits)
+    with open(base + '.json', 'w') as f:
+        json.dump(key, f)
+    return logits
+
+
+class DistillationSequence(CachedImageSequence):
+    """CachedImageSequence whose targets are (batch, 2): [label, teacher logit]."""
+
+    def __init__(self, name, logits, batch_size=32, **kwargs):
+        super().__init__(name, batch_size, **kwargs)
+        self.logits = logits
+
+    def __getitem__(self, idx):
+        x, y = super().__getitem__(idx)
+        return x, np.stack([y, self.logits[self.rows(idx)]], axis=1)
+
+
+class Distiller(tf.keras.Model):
+    """Trains `student` (two logits) on labels and teacher logits; validates on labels only."""
+
+    def __init__(self, student, alpha=0.5, temperature=4.):
+        super().__init__()
+        self.student = student
+        self.alpha = alpha
+        self.temperature = temperature
+        self.loss_tracker = tf.keras.metrics.Mean(name='loss')
+        self.accuracy = tf.keras.metrics.SparseCategoricalAccuracy(name='accuracy')
+        self.hard_loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True)
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.accuracy]
+
+    def call(self, x, training=False):
+        return self.student(x, training=training)
+
+    def train_step(self, data):
+        x, y = data
+        labels, z = y[:, 0], y[:, 1]
+        soft_targets = tf.nn.softmax(tf.stack([tf.zeros_like(z), z], axis=1) / self.temperature)
+        with tf.GradientTape() as tape:
+            logits = self.student(x, training=True)
+            soft_student = tf.nn.log_softmax(logits / self.temperature)
+            soft_loss = tf.reduce_mean(tf.reduce_sum(
+                soft_targets * (tf.math.log(soft_targets + 1e-12) - soft_student), axis=1))
+            loss = (self.alpha * self.hard_loss(labels, logits)
+                    + (1 - self.alpha) * self.temperature ** 2 * soft_loss)
+        grads = tape.gradient(loss, self.student.trainable_variables)
+        self.optimizer.apply_gradients(zip(grads, self.student.trainable_variables))
+        self.loss_tracker.update_state(loss)
+        self.accuracy.update_state(labels, logits)
+        return {m.name: m.result() for m in self.metrics}
+
+    def test_step(self, data):
+        x, labels = data
+        logits = self.student(x, training=False)
+        self.loss_tracker.update_state(self.hard_loss(labels, logits))
+        self.accuracy.update_state(labels, logits)
+        return {m.name: m.result() for m in self.metrics}
+
+
+def distill(teacher_path, epochs=30, alpha=0.5, temperature=4., augment=True, seed=0):
+    """Train the simple CNN against the teacher and return it."""
+    logits = teacher_logits(teacher_path)
+    augmenter = BatchAugmenter(0.1, 0.1, horizontal_flip=True, seed=seed) if augment else None
+    train = DistillationSequence('train', logits, BATCH_SIZE, shuffle=True, augment=augmenter, seed=seed)
+    distiller = Distiller(build_simple_cnn(), alpha, temperature)
+    distiller.compile(optimizer='adam')
+    distiller.fit(train, epochs=epochs, validation_data=CachedImageSequence('validation', BATCH_SIZE))
+    return distiller.student
+
+
+def train_baseline(epochs=30, augment=True, seed=0):
+    """The simple CNN on hard labels only, with the same data and epochs."""
+    augmenter = BatchAugmenter(0.1, 0.1, horizontal_flip=True, seed=seed) if augment else None
+    model = build_simple_cnn()
+    model.fit(CachedImageSequence('train', BATCH_SIZE, shuffle=True, augment=augmenter, seed=seed), epochs=epochs,
+              validation_data=CachedImageSequence('validation', BATCH_SIZE))
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('teacher', help='saved teacher model, e.g. models/Xception.h5')
+    parser.add_argument('--data', default='data')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--alpha', type=float, default=0.5, help='weight of the hard-label loss')
+    parser.add_argument('--temperature', type=float, default=4.)
+    parser.add_argument('--baseline', help='saved simple CNN trained on hard labels (default: train one)')
+    parser.add_argument('--out', default='models/SimpleCNN_distilled.h5')
+    parser.add_argument('--report', default='distill_report.csv')
+    args = parser.parse_args()
+
+    for split, shuffle in (('train', True), ('validation', False)):
+        if not has_cache(split):
+            ingest_directory(os.path.join(args.data, split), split, shuffle=shuffle)
+
+    student = distill(args.teacher, args.epochs, args.alpha, args.temperature)
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    student.save(args.out)
+    if args.baseline is None:
+        args.baseline = os.path.join(os.path.dirname(args.out), 'SimpleCNN.h5')
+        train_baseline(args.epochs).save(args.baseline)
+
+    images, labels = load_validation(args.data)
+    rows = []
+    for name, path in (('teacher', args.teacher), ('simple CNN', args.baseline), ('distilled', args.out)):
+        model = tf.keras.models.load_model(path, compile=False)
+        rows.append(report_row(name, os.path.basename(path), model, os.path.getsize(path), images, labels))
+    with open(args.report, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    for row in rows:
+        print(', '.join('%s=%s' % (k, row[k]) for k in REPORT_FIELDS))
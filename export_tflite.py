@@ -0,0 +1,137 @@
+"""Export a trained model to float16 and int8 TFLite and compare the versions.
+
+Every version (Keras float32, TFLite float16, TFLite int8) is evaluated on the
+validation set and timed on CPU for a single image and for a batch, so the
+cheapest model that stays within an accuracy budget can be picked. The int8
+calibration uses a sample of data/validation.
+
+    python export_tflite.py models/Xception.h5 models/NASNetLarge.h5
+"""
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from batch_predict import probabilities
+from image_cache import decode_image, has_cache, list_images, load_cache
+
+REPORT_FIELDS = ['model', 'version', 'size_mb', 'val_accuracy', 'single_ms', 'batch_ms', 'batch_per_image_ms']
+
+
+def load_validation(data_dir='data', img_shape=150):
+    """The whole validation set as uint8 images and float labels, from the cache when there is one."""
+    if has_cache('validation'):
+        images, labels, _ = load_cache('validation')
+        return np.asarray(images), labels
+    paths, labels, _ = list_images(os.path.join(data_dir, 'validation'))
+    return np.stack([decode_image(p, img_shape) for p in paths]), labels
+
+
+def convert(model, version, calibration_images=None):
+    """TFLite flatbuffer of `model` as 'float16' or 'int8'."""
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if version == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif version == 'int8':
+        def representative_dataset():
+            for img in calibration_images:
+                yield [img[None].astype(np.float32) * (1. / 255)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        raise ValueError('unknown version %r' % version)
+    return converter.convert()
+
+
+class TFLiteModel:
+    """Runs a TFLite model on float (x / 255) batches of any size."""
+
+    def __init__(self, model_content, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    def predict_on_batch(self, x):
+        if len(x) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input['index'], x.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(x)
+        self.interpreter.set_tensor(self.input['index'], x.astype(np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output['index'])
+
+
+def accuracy(model, images, labels, batch_size=32):
+    correct = 0
+    for i in range(0, len(images), batch_size):
+        probs = probabilities(model, images[i:i + batch_size].astype(np.float32))
+        correct += np.sum((probs >= 0.5) == (labels[i:i + batch_size] >= 0.5))
+    return correct / len(images)
+
+
+def latency_ms(model, x, runs=20, warmup=3):
+    """Median wall time of one predict_on_batch(x) call, in milliseconds."""
+    for _ in range(warmup):
+        model.predict_on_batch(x)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model.predict_on_batch(x)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+
+def report_row(name, version, model, size_bytes, images, labels, batch_size=32):
+    single = images[:1].astype(np.float32) * (1. / 255)
+    batch = images[:batch_size].astype(np.float32) * (1. / 255)
+    batch_ms = latency_ms(model, batch)
+    return dict(model=name, version=version, size_mb=round(size_bytes / 2**20, 2),
+                val_accuracy=round(float(accuracy(model, images, labels)), 4),
+                single_ms=round(latency_ms(model, single), 2), batch_ms=round(batch_ms, 2),
+                batch_per_image_ms=round(batch_ms / len(batch), 2))
+
+
+def export_and_report(model_path, out_dir='models', images=None, labels=None, calibration=200,
+                      num_threads=None, seed=0):
+    """Write <name>_float16.tflite and <name>_int8.tflite and return one report row per version."""
+    if images is None:
+        images, labels = load_validation()
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    model = tf.keras.models.load_model(model_path, compile=False)
+    rows = [report_row(name, 'keras float32', model, os.path.getsize(model_path), images, labels)]
+
+    sample = np.random.RandomState(seed).choice(len(images), min(calibration, len(images)), replace=False)
+    for version in ('float16', 'int8'):
+        content = convert(model, version, images[sample])
+        with open(os.path.join(out_dir, '%s_%s.tflite' % (name, version)), 'wb') as f:
+            f.write(content)
+        rows.append(report_row(name, 'tflite ' + version, TFLiteModel(content, num_threads),
+                               len(content), images, labels))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('models', nargs='+', help='saved Keras models')
+    parser.add_argument('--out', default='models', help='directory for the .tflite files')
+    parser.add_argument('--calibration', type=int, default=200, help='validation images used for int8 calibration')
+    parser.add_argument('--threads', type=int, default=None, help='TFLite interpreter threads')
+    parser.add_argument('--report', default='tflite_report.csv')
+    args = parser.parse_args()
+
+    images, labels = load_validation()
+    rows = []
+    for path in args.models:
+        rows += export_and_report(path, args.out, images, labels, args.calibration, args.threads)
+    with open(args.report, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    for row in rows:
+        print(', '.join('%s=%s' % (k, row[k]) for k in REPORT_FIELDS))
@@ -0,0 +1,143 @@
+"""Pooled features of several frozen backbones from a single pass over the images.
+
+Every decoded batch goes through all the requested backbones in the same
+forward call, so decoding and resizing cost the same for one architecture or
+ten. Each backbone's global-average-pooled features are written to
+``<out_dir>/<split>_<backbone>.npy`` (float16), next to ``<split>_labels.npy``.
+
+    python feature_fanout.py VGG16 InceptionV3 ResNet101V2 DenseNet121
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from backbones import backbone
+
+FEATURES_DIR = os.path.join('cache', 'features')
+
+
+def build_fanout_model(backbones, img_shape=150):
+    """One model with one pooled output per backbone, all fed by the same input."""
+    inputs = tf.keras.Input(shape=(img_shape, img_shape, 3))
+    outputs = []
+    for name in backbones:
+        net = backbone(name, img_shape)
+        net.trainable = False
+        outputs.append(tf.keras.layers.GlobalAveragePooling2D()(net(inputs)))
+    return tf.keras.Model(inputs, outputs)
+
+
+def feature_path(split, backbone, out_dir=FEATURES_DIR):
+    return os.path.join(out_dir, '%s_%s.npy' % (split, backbone))
+
+
+def extract_features(sequence, backbones, split, out_dir=FEATURES_DIR, dtype=np.float16):
+    """Write the pooled features of `backbones` for every image of `sequence`.
+
+    `sequence` must not shuffle or augment, so row i of every feature file is
+    image i of the split. Backbones whose features already exist are skipped;
+    for a cache that records content hashes (see manifest.py) only the images
+    whose hash is new are featurized again.
+    """
+    index = getattr(sequence, 'index', None)
+    if isinstance(index, dict) and index.get('hashes') is not None:
+        return update_features(sequence, backbones, split, index['hashes'], out_dir, dtype)
+
+    backbones = [b for b in backbones if not os.path.exists(feature_path(split, b, out_dir))]
+    if not backbones:
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    model = build_fanout_model(backbones, sequence[0][0].shape[1])
+
+    n = sequence.samples
+    features = [np.lib.format.open_memmap(feature_path(split, b, out_dir) + '.tmp', mode='w+', dtype=dtype,
+                                          shape=(n, out.shape[-1]))
+                for b, out in zip(backbones, model.outputs)]
+    labels = np.zeros(n, dtype=np.float32)
+    row = 0
+    for i in range(len(sequence)):
+        x, y = sequence[i]
+        for f, out in zip(features, tf.nest.flatten(model.predict_on_batch(x))):
+            f[row:row + len(y)] = out
+        labels[row:row + len(y)] = y
+        row += len(y)
+
+    np.save(os.path.join(out_dir, '%s_labels.npy' % split), labels)
+    for b, f in zip(backbones, features):
+        f.flush()
+        os.replace(feature_path(split, b, out_dir) + '.tmp', feature_path(split, b, out_dir))
+
+
+def _read_hashes(path):
+    if not os.path.exists(path + '.hashes.json'):
+        return None
+    with open(path + '.hashes.json') as f:
+        return json.load(f)
+
+
+def update_features(sequence, backbones, split, hashes, out_dir=FEATURES_DIR, dtype=np.float16):
+    """Incremental extract_features for a CachedImageSequence whose rows have content hashes."""
+    os.makedirs(out_dir, exist_ok=True)
+    previous, compute = {}, set()
+    for b in backbones:
+        old_hashes = _read_hashes(feature_path(split, b, out_dir))
+        if old_hashes == hashes:
+            continue
+        old_rows = {h: i for i, h in enumerate(old_hashes or [])}
+        previous[b] = old_rows
+        compute.update(i for i, h in enumerate(hashes) if h not in old_rows)
+    if not previous:
+        return
+
+    model = build_fanout_model(list(previous), sequence.images.shape[1])
+    n = len(hashes)
+    features = {}
+    for b, out in zip(previous, model.outputs):
+        path = feature_path(split, b, out_dir)
+        features[b] = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=(n, out.shape[-1]))
+        if previous[b]:
+            old = np.load(path, mmap_mode='r')
+            for i, h in enumerate(hashes):
+                if i not in compute:
+                    features[b][i] = old[previous[b][h]]
+
+    rows = sorted(compute)
+    for start in range(0, len(rows), sequence.batch_size):
+        batch = rows[start:start + sequence.batch_size]
+        x = sequence.images[batch].astype(np.float32) * sequence.rescale
+        for b, out in zip(previous, tf.nest.flatten(model.predict_on_batch(x))):
+            features[b][batch] = out
+
+    np.save(os.path.join(out_dir, '%s_labels.npy' % split), sequence.labels)
+    for b, f in features.items():
+        f.flush()
+        path = feature_path(split, b, out_dir)
+        # drop the old hashes first: a crash in between then means a full recompute, never misaligned rows
+        if os.path.exists(path + '.hashes.json'):
+            os.remove(path + '.hashes.json')
+        os.replace(path + '.tmp', path)
+        with open(path + '.hashes.json', 'w') as out:
+            json.dump(hashes, out)
+
+
+def load_features(split, backbone, out_dir=FEATURES_DIR):
+    return (np.load(feature_path(split, backbone, out_dir), mmap_mode='r'),
+            np.load(os.path.join(out_dir, '%s_labels.npy' % split)))
+
+
+if __name__ == '__main__':
+    from image_cache import CachedImageSequence
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('backbones', nargs='+')
+    parser.add_argument('--splits', nargs='*', default=['train', 'validation'])
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--out', default=FEATURES_DIR)
+    args = parser.parse_args()
+
+    for split in args.splits:
+        extract_features(CachedImageSequence(split, args.batch_size), args.backbones, split, args.out)
+        print('Wrote', split, 'features for', ', '.join(args.backbones))
@@ -0,0 +1,175 @@
+"""Decode the image folders once into memory-mapped uint8 arrays.
+
+A cached split is three files in the cache directory: ``<name>_images.npy``
+(N x 150 x 150 x 3 uint8), ``<name>_labels.npy`` and ``<name>_index.json``
+holding the source paths and class names, all in the same row order.
+
+    python image_cache.py data cache
+"""
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+CACHE_DIR = 'cache'
+IMG_SHAPE = 150
+
+# the formats flow_from_directory accepts
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+
+
+def list_images(directory):
+    """Files, labels and class names in the order flow_from_directory uses.
+
+    Classes are the sorted sub-directories and the label is the class position,
+    so 'men' is 0 and 'women' is 1 exactly as with class_mode='binary'.
+    """
+    class_names = sorted(d for d in os.listdir(directory)
+                         if os.path.isdir(os.path.join(directory, d)))
+    paths, labels = [], []
+    for label, name in enumerate(class_names):
+        for root, _, files in sorted(os.walk(os.path.join(directory, name))):
+            for fname in sorted(files):
+                if fname.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(root, fname))
+                    labels.append(label)
+    return paths, np.array(labels, dtype=np.float32), class_names
+
+
+def decode_image(path, img_shape=IMG_SHAPE, draft=False):
+    """Decode and resize one image the way flow_from_directory does.
+
+    With draft=True a JPEG is decoded directly at the smallest DCT scale
+    (1/2, 1/4 or 1/8) that keeps both sides at least `img_shape`, and only
+    that is resized; most of a large photo is then never decoded at all.
+    Other formats decode as before.
+    """
+    if not draft:
+        img = tf.keras.preprocessing.image.load_img(path, target_size=(img_shape, img_shape))
+        return np.asarray(img, dtype=np.uint8)
+    with Image.open(path) as img:
+        img.draft('RGB', (img_shape, img_shape))
+        img = img.convert('RGB')
+        if img.size != (img_shape, img_shape):
+            img = img.resize((img_shape, img_shape), Image.NEAREST)  # load_img's default interpolation
+        return np.asarray(img, dtype=np.uint8)
+
+
+def cache_paths(name, cache_dir=CACHE_DIR):
+    prefix = os.path.join(cache_dir, name)
+    return prefix + '_images.npy', prefix + '_labels.npy', prefix + '_index.json'
+
+
+def save_labels(path, labels):
+    # through a file object, np.save would append .npy to a .tmp name
+    with open(path, 'wb') as f:
+        np.save(f, labels)
+
+
+def ingest_directory(directory, name, cache_dir=CACHE_DIR, img_shape=IMG_SHAPE,
+                     shuffle=False, seed=0, workers=8, draft=False):
+    """Decode every image under `directory` once into the cache `name`.
+
+    With shuffle=True the rows are written in a random order, so that the
+    contiguous batches served by CachedImageSequence are already mixed.
+    """
+    paths, labels, class_names = list_images(directory)
+    if shuffle:
+        order = np.random.RandomState(seed).permutation(len(paths))
+        paths = [paths[i] for i in order]
+        labels = labels[order]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images_path, labels_path, index_path = cache_paths(name, cache_dir)
+    images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), img_shape, img_shape, 3))
+    # PIL releases the GIL while decoding, so threads are enough here
+    with ThreadPoolExecutor(workers) as pool:
+        for i, img in enumerate(pool.map(lambda p: decode_image(p, img_shape, draft), paths)):
+            images[i] = img
+    images.flush()
+    del images
+
+    save_labels(labels_path + '.tmp', labels)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'directory': directory, 'class_names': class_names,
+                   'img_shape': img_shape, 'draft': draft, 'paths': paths}, f)
+    # the index goes last, its presence marks a complete cache
+    os.replace(images_path + '.tmp', images_path)
+    os.replace(labels_path + '.tmp', labels_path)
+    os.replace(index_path + '.tmp', index_path)
+    return len(paths)
+
+
+def load_cache(name, cache_dir=CACHE_DIR):
+    """Return (images, labels, index) with the images memory-mapped read-only."""
+    images_path, labels_path, index_path = cache_paths(name, cache_dir)
+    with open(index_path) as f:
+        index = json.load(f)
+    return np.load(images_path, mmap_mode='r'), np.load(labels_path), index
+
+
+def has_cache(name, cache_dir=CACHE_DIR):
+    return os.path.exists(cache_paths(name, cache_dir)[2])
+
+
+class CachedImageSequence(tf.keras.utils.Sequence):
+    """Serves (x, y) batches from a cache, a drop-in for flow_from_directory.
+
+    Batches are read straight from the memory-mapped array, which the backbone
+    runs all share through the page cache. Shuffling draws a new permutation
+    of the images every epoch, as flow_from_directory does; each batch's rows
+    are read in sorted order so the reads stay mostly sequential.
+
+    `augment(x, key)` is applied to each rescaled batch, with key being
+    (epoch, batch index) so a seeded BatchAugmenter stays reproducible.
+    """
+
+    def __init__(self, name, batch_size=32, shuffle=False, rescale=1./255,
+                 augment=None, cache_dir=CACHE_DIR, seed=None):
+        super().__init__()
+        self.images, self.labels, self.index = load_cache(name, cache_dir)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rescale = rescale
+        self.augment = augment
+        self.class_indices = {c: i for i, c in enumerate(self.index['class_names'])}
+        self.samples = len(self.labels)
+        self.rng = np.random.RandomState(seed)
+        self.order = np.arange(self.samples)
+        self.epoch = 0
+        if shuffle:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return (self.samples + self.batch_size - 1) // self.batch_size
+
+    def rows(self, idx):
+        """Cache rows of batch `idx`, sorted."""
+        return np.sort(self.order[idx * self.batch_size:(idx + 1) * self.batch_size])
+
+    def __getitem__(self, idx):
+        rows = self.rows(idx)
+        x = self.images[rows].astype(np.float32)
+        if self.rescale:
+            x *= self.rescale
+        if self.augment is not None:
+            x = self.augment(x, (self.epoch, int(idx)))
+        return x, self.labels[rows]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+
+if __name__ == '__main__':
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else 'data'
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else CACHE_DIR
+    for split, shuffle in (('train', True), ('validation', False)):
+        n = ingest_directory(os.path.join(data_dir, split), split, cache_dir, shuffle=shuffle)
+        print('Cached', n, split, 'images')
@@ -8,14 +8,19 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 
-from keras.models import Sequential
-from keras.layers import Dense, Dropout
-from keras.optimizers import RMSprop
+from tensorflow.keras.models import Sequential
+from tensorflow.keras.layers import Dense, Dropout
+from tensorflow.keras.optimizers import RMSprop
 
 """## Loading Data"""
 
-!rm -rf data && mkdir data && wget http://info.iut-bm.univ-fcomte.fr/staff/couturie/images.zip  && unzip images.zip -d data/
-!ls data
+# read the images straight out of images.zip instead of extracting thousands of small files
+read_from_zip = False
+
+!rm -rf data && mkdir data && wget http://info.iut-bm.univ-fcomte.fr/staff/couturie/images.zip
+if not read_from_zip:
+  !unzip images.zip -d data/
+  !ls data
 
 TRAIN_DIR = 'data/train'
 VALIDATION_DIR = 'data/validation'
@@ -25,11 +30,24 @@ train_women_dir = 'data/train/women'  # directory with our training women pictur
 validation_men_dir = 'data/validation/men'  # directory with our validation men pictures
 validation_women_dir = 'data/validation/women'  # directory with our validation women pictures
 
-num_men_tr = len(os.listdir(train_men_dir))
-num_women_tr = len(os.listdir(train_women_dir))
+if read_from_zip:
+  # counts come from the archive's central directory, nothing is extracted
+  from zip_dataset import ZipIndex, ZipImageSequence
+  zip_index = ZipIndex('images.zip')
+  num_men_tr, num_women_tr = zip_index.class_counts('train')['men'], zip_index.class_counts('train')['women']
+  num_men_val, num_women_val = zip_index.class_counts('validation')['men'], zip_index.class_counts('validation')['women']
+else:
+  num_men_tr = len(os.listdir(train_men_dir))
+  num_women_tr = len(os.listdir(train_women_dir))
+
+  num_men_val = len(os.listdir(validation_men_dir))
+  num_women_val = len(os.listdir(validation_women_dir))
 
-num_men_val = len(os.listdir(validation_men_dir))
-num_women_val = len(os.listdir(validation_women_dir))
+def extract_for_tools():
+  # the command-line tools further down read the data/ tree; with read_from_zip
+  # it is extracted only when the first of them runs
+  if read_from_zip and not os.path.isdir(TRAIN_DIR):
+    !unzip -q images.zip -d data/
 
 total_train = num_men_tr + num_women_tr
 total_val = num_men_val + num_women_val
@@ -104,24 +122,111 @@ else:
 #                                                     target_size=(IMG_SHAPE,IMG_SHAPE),
 #                                                     class_mode='binary')
 
-train_generator = train_datagen.flow_from_directory(batch_size=BATCH_SIZE,
-                                                    directory=TRAIN_DIR,
-                                                    target_size=(IMG_SHAPE,IMG_SHAPE),
+val_datagen = ImageDataGenerator(rescale=1./255)
+
+if not read_from_zip:
+  train_generator = train_datagen.flow_from_directory(batch_size=BATCH_SIZE,
+                                                      directory=TRAIN_DIR,
+                                                      target_size=(IMG_SHAPE,IMG_SHAPE),
+                                                      class_mode='binary')
+
+  val_generator = val_datagen.flow_from_directory(batch_size=BATCH_SIZE,
+                                                    directory=VALIDATION_DIR,
+                                                    target_size=(IMG_SHAPE, IMG_SHAPE),
                                                     class_mode='binary')
 
-val_datagen = ImageDataGenerator(rescale=1./255)
+"""### Pre-decoded Image Cache
+
+The generators above decode and resize every JPEG again on every epoch. With `input_pipeline = 'cache'` each image is decoded once into a memory-mapped uint8 array under `cache/` and the batches are served straight from it; all the backbone runs below then share the same page cache.
+
+A manifest (`cache/manifest.sqlite`) records path, size, mtime, content hash and label of every image. When images are added or changed, only those are decoded again, and the feature caches further down recompute only the affected rows.
+"""
+
+input_pipeline = 'zip' if read_from_zip else 'cache'  # 'generator', 'cache', 'tfdata' or 'zip'
+AUGMENT_SEED = 0
+# decode JPEGs at the smallest 1/2, 1/4 or 1/8 DCT scale that is still >= IMG_SHAPE
+# (see "Performance Benchmarks" for the speedup and the pixel difference)
+DRAFT_DECODE = False
+
+from batch_augment import BatchAugmenter
+
+augment = None
+if data_augmentation:
+  # the train_datagen shifts and flips, applied to a whole batch at once
+  augment = BatchAugmenter.from_datagen(train_datagen, seed=AUGMENT_SEED)
+
+if input_pipeline == 'cache':
+  from image_cache import CachedImageSequence
+  from manifest import Manifest, refresh_image_cache
 
-val_generator = val_datagen.flow_from_directory(batch_size=BATCH_SIZE,
-                                                  directory=VALIDATION_DIR,
-                                                  target_size=(IMG_SHAPE, IMG_SHAPE),
-                                                  class_mode='binary')
+  # the manifest hashes only new or modified files, and only those get decoded again
+  manifest = Manifest()
+  changes = manifest.update('data')
+  print('Manifest: %d added, %d changed, %d removed' % (len(changes['added']), len(changes['changed']), len(changes['removed'])))
+  # training paths to cache, None for all of them (see "Near-Duplicates and Train/Validation Leakage" below)
+  train_keep = None
+  refresh_image_cache(manifest, 'train', shuffle=True, draft=DRAFT_DECODE, keep=train_keep)
+  refresh_image_cache(manifest, 'validation', draft=DRAFT_DECODE)
+
+  train_generator = CachedImageSequence('train', batch_size=BATCH_SIZE, shuffle=True, augment=augment)
+  val_generator = CachedImageSequence('validation', batch_size=BATCH_SIZE)
+  print('Serving', train_generator.samples, 'training and', val_generator.samples, 'validation images from cache')
+
+"""### tf.data Input Pipeline
+
+`workers=4` in the `model.fit` calls is ignored for generators by current Keras, so the generators above decode on one thread. With `input_pipeline = 'tfdata'` the same class directories are decoded and resized in parallel, cached after decoding, shuffled with a bounded buffer and prefetched; the labels are the same 0/1 floats as `class_mode='binary'`.
+"""
+
+from tf_pipeline import images_per_second, make_dataset
+
+if input_pipeline == 'tfdata':
+  train_generator = make_dataset(TRAIN_DIR, BATCH_SIZE, img_shape=IMG_SHAPE, shuffle=True, augment=augment, seed=AUGMENT_SEED, draft=DRAFT_DECODE)
+  val_generator = make_dataset(VALIDATION_DIR, BATCH_SIZE, img_shape=IMG_SHAPE, shuffle=False, draft=DRAFT_DECODE)
+
+"""### Reading From images.zip
+
+With `read_from_zip = True` nothing is extracted for training (only the command-line tools further down, which read `data/`, extract it when they first run): the archive's central directory is indexed once (`images.zip.index.json`) and a pool of reader threads reads and decodes the members straight from the zip.
+"""
+
+if input_pipeline == 'zip':
+  train_generator = ZipImageSequence(zip_index, 'train', BATCH_SIZE, IMG_SHAPE, shuffle=True, augment=augment, seed=AUGMENT_SEED, draft=DRAFT_DECODE)
+  val_generator = ZipImageSequence(zip_index, 'validation', BATCH_SIZE, IMG_SHAPE, draft=DRAFT_DECODE)
+
+"""### Validation Set in Memory
+
+The validation images are never augmented, but every `model.fit` below would decode and rescale all of them at the end of every epoch, and `model.evaluate` once more. With `validation_in_memory = True` they are read once into a contiguous uint8 array (rescaled per batch), so validation only costs the forward pass.
+"""
+
+validation_in_memory = True
+
+if validation_in_memory:
+  from tensor_cache import TensorSequence
+
+  val_generator = TensorSequence.from_source(val_generator, dtype=np.uint8)
+  print('Validation set in memory: %.0f MB' % (val_generator.images.nbytes / 2**20))
+
+"""### Input Pipeline Throughput"""
+
+if input_pipeline == 'zip':
+  print('images.zip: %.0f images/sec' % images_per_second(train_generator, len(train_generator)))
+else:
+  keras_generator = train_datagen.flow_from_directory(batch_size=BATCH_SIZE,
+                                                      directory=TRAIN_DIR,
+                                                      target_size=(IMG_SHAPE,IMG_SHAPE),
+                                                      class_mode='binary')
+  steps = len(keras_generator)  # one epoch
+  tfdata_pipeline = make_dataset(TRAIN_DIR, BATCH_SIZE, img_shape=IMG_SHAPE, shuffle=True, augment=augment, seed=AUGMENT_SEED, draft=DRAFT_DECODE)
+
+  print('ImageDataGenerator: %.0f images/sec' % images_per_second(keras_generator, steps))
+  # the first pass decodes and fills the cache, later passes read from it
+  print('tf.data first epoch: %.0f images/sec' % images_per_second(tfdata_pipeline, steps))
+  print('tf.data cached epoch: %.0f images/sec' % images_per_second(tfdata_pipeline, steps))
 
 """## Simple Convolutional Neural Network"""
 
-import keras
-from keras.layers import Dense, Dropout, Activation, Flatten, Input
-from keras.models import Model
-from keras.layers import Input
+from tensorflow import keras
+from tensorflow.keras.layers import Dense, Dropout, Activation, Flatten, Input
+from tensorflow.keras.models import Model
 
 model = tf.keras.models.Sequential([
     tf.keras.layers.Conv2D(32, (3,3), activation='relu', input_shape=(150, 150, 3)),
@@ -190,6 +295,12 @@ plt.show()
 
 """
 
+# start again from fresh weights instead of continuing the run above
+model = tf.keras.models.clone_model(model)
+model.compile(optimizer='adam',
+              loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+              metrics=['accuracy'])
+
 callback = tf.keras.callbacks.EarlyStopping(monitor='val_accuracy', mode='max', patience=10, restore_best_weights=True)
 epochs=30
 history = model.fit(
@@ -226,14 +337,38 @@ plt.legend(loc='upper right')
 plt.title('Training and Validation Loss')
 plt.show()
 
+"""### Input Wait vs. Compute
+
+`StepProfiler` can be attached to any of the `model.fit` calls: wrap the training generator with `profiler.wrap(...)`, pass `steps_per_epoch` and add the profiler to the callbacks. It splits every step into time blocked on the input and time in the forward/backward pass, and reports throughput and the memory high-water mark per epoch. `trace_steps` records a TensorFlow profiler trace for that step range (or create a `PROFILE_NOW` file during training to trace the next steps).
+"""
+
+from profiling import StepProfiler
+
+# a throwaway copy with fresh weights, so the trained model above is left as it is
+profiled_model = tf.keras.models.clone_model(model)
+profiled_model.compile(optimizer='adam',
+                       loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                       metrics=['accuracy'])
+
+profiler = StepProfiler(trace_steps=(10, 15))
+profiled_model.fit(
+    profiler.wrap(train_generator),
+    steps_per_epoch=len(train_generator),
+    epochs=3,
+    callbacks=[profiler],
+    validation_data=val_generator
+)
+profiler.print_summary()
+profiler.save('profile_simple_cnn.json')
+
 """## Densenet121
 
 ### Train All Layers
 """
 
-from tensorflow.keras.applications import DenseNet121
+from backbones import backbone
 
-net= DenseNet121(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('DenseNet121')
 
 for layer in net.layers[:]:
     layer.trainable = True
@@ -273,9 +408,7 @@ print('Test accuracy:', score[1])
 
 """
 
-from tensorflow.keras.applications import DenseNet121
-
-net= DenseNet121(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('DenseNet121')
 
 for layer in net.layers[:]:
     layer.trainable = False
@@ -314,9 +447,7 @@ print('Test accuracy:', score[1])
 
 """
 
-from tensorflow.keras.applications import DenseNet121
-
-net= DenseNet121(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('DenseNet121')
 
 for layer in net.layers[:-5]:
     layer.trainable = False
@@ -349,9 +480,9 @@ print('Test accuracy:', score[1])
 
 """## Xception (Our Highest Accuracy Model)"""
 
-from tensorflow.keras.applications import Xception
+from checkpointing import fit_resumable
 
-net= Xception(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('Xception')
 
 for layer in net.layers[:]:
     layer.trainable = True
@@ -373,7 +504,10 @@ model.compile(loss='binary_crossentropy',
 epochs=50
 callback = tf.keras.callbacks.EarlyStopping(monitor='val_accuracy', mode='max', patience=10, restore_best_weights=True)
 
-history = model.fit(
+# checkpoint every epoch, a re-run resumes from the last complete one
+history = fit_resumable(
+    model,
+    'checkpoints/Xception',
     train_generator,
     epochs=epochs,
     callbacks = [callback],
@@ -385,13 +519,14 @@ score = model.evaluate(val_generator,verbose=2)
 print('Test loss:', score[0])
 print('Test accuracy:', score[1])
 
+os.makedirs('models', exist_ok=True)
+model.save('models/Xception.h5')
+
 """## MobileNetV2 
 
 """
 
-from tensorflow.keras.applications import MobileNetV2
-
-net= MobileNetV2(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('MobileNetV2')
 
 for layer in net.layers[:-5]:
     layer.trainable = False
@@ -425,9 +560,7 @@ print('Test accuracy:', score[1])
 
 """## NASNetLarge"""
 
-from tensorflow.keras.applications import NASNetLarge
-
-net= NASNetLarge(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('NASNetLarge')
 
 for layer in net.layers[:]:
     layer.trainable = True
@@ -438,37 +571,48 @@ x = Dropout(0.5)(x)
 output_layer = Dense(1, activation='sigmoid', name='sigmoid')(x)
 model = Model(inputs=net.input, outputs=output_layer)
 
+from accumulate import AccumulatingModel, PeakMemory
+
+# still one update per batch of 32, computed in micro-batches of 8 with the
+# backbone's activations recomputed in 4 segments, to fit in the node's RAM
+trainer = AccumulatingModel.wrap(model, micro_batch=8, checkpoint_segments=4)
+
 # initiate RMSprop optimizer
 opt = keras.optimizers.RMSprop(lr=0.0001, decay=1e-6)
 
 # Let's train the model using RMSprop
-model.compile(loss='binary_crossentropy',
-              optimizer=opt,
-              metrics=['accuracy'])
+trainer.compile(loss='binary_crossentropy',
+                optimizer=opt,
+                metrics=['accuracy'])
 
 epochs=50
 
 callback = tf.keras.callbacks.EarlyStopping(monitor='val_accuracy', mode='max', patience=40, restore_best_weights='True')
+memory = PeakMemory()
 
-history = model.fit(
+history = fit_resumable(
+    trainer,
+    'checkpoints/NASNetLarge_accumulated',
     train_generator,
     epochs=epochs,
-    callbacks=[callback],
+    callbacks=[callback, memory],
     validation_data=val_generator,
     workers=4
 )
+if memory.steps:  # empty when the run had already finished
+  print('Peak memory per step: %.0f MB' % max(memory.steps))
 
-score = model.evaluate(val_generator,verbose=2)
+score = trainer.evaluate(val_generator,verbose=2)
 print('Test loss:', score[0])
 print('Test accuracy:', score[1])
 
+model.save('models/NASNetLarge.h5')
+
 """## InceptionResNetV2
 
 """
 
-from tensorflow.keras.applications import InceptionResNetV2
-
-net= InceptionResNetV2(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('InceptionResNetV2')
 
 for layer in net.layers[:-7]:
     layer.trainable = False
@@ -504,9 +648,7 @@ print('Test accuracy:', score[1])
 
 """## VGG16"""
 
-from tensorflow.keras.applications import VGG16
-
-net= VGG16(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('VGG16')
 
 for layer in net.layers[:-5]:
     layer.trainable = False
@@ -542,9 +684,7 @@ print('Test accuracy:', score[1])
 
 """
 
-from tensorflow.keras.applications import VGG19
-
-net= VGG19(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('VGG19')
 
 for layer in net.layers[:-5]:
     layer.trainable = False
@@ -578,9 +718,7 @@ print('Test accuracy:', score[1])
 
 """## InceptionV3 """
 
-from tensorflow.keras.applications import InceptionV3
-
-net= InceptionV3(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('InceptionV3')
 
 for layer in net.layers[:-5]:
     layer.trainable = False
@@ -618,9 +756,7 @@ print('Test accuracy:', score[1])
 
 """
 
-from tensorflow.keras.applications import ResNet101V2
-
-net= ResNet101V2(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('ResNet101V2')
 
 for layer in net.layers[:-5]:
     layer.trainable = False
@@ -676,9 +812,7 @@ plt.show()
 
 """## ResNet152V2 """
 
-from tensorflow.keras.applications import ResNet152V2
-
-net= ResNet152V2(include_top=False, weights='imagenet', input_tensor=Input(shape=(150,150,3))) 
+net = backbone('ResNet152V2')
 
 for layer in net.layers[:-5]:
     layer.trainable = False
@@ -710,6 +844,8 @@ score = model.evaluate(val_generator,verbose=2)
 print('Test loss:', score[0])
 print('Test accuracy:', score[1])
 
+model.save('models/ResNet152V2.h5')
+
 acc = history.history['accuracy']
 val_acc = history.history['val_accuracy']
 
@@ -731,3 +867,251 @@ plt.plot(epochs_range, val_loss, label='Validation Loss')
 plt.legend(loc='upper right')
 plt.title('Training and Validation Loss')
 plt.show()
+
+"""## Frozen Backbones From Cached Bottleneck Features
+
+The frozen sections above run the whole frozen backbone again on every image in every epoch. Here the frozen prefix runs once per (backbone, freeze point, image), its activations are cached under `cache/bottleneck/`, and the epochs only train the trainable tail and the Flatten/Dropout/Dense head.
+
+With `bottleneck_views = 1` the cached runs use no augmentation; a larger value caches that many augmented passes over the training set.
+"""
+
+from bottleneck_cache import fit_from_bottleneck
+
+bottleneck_views = 1
+
+if input_pipeline == 'cache':
+  plain_train = CachedImageSequence('train', batch_size=BATCH_SIZE)
+  augmented_train = CachedImageSequence('train', batch_size=BATCH_SIZE, augment=augment)
+elif input_pipeline == 'zip':
+  plain_train = ZipImageSequence(zip_index, 'train', BATCH_SIZE, IMG_SHAPE)
+  augmented_train = ZipImageSequence(zip_index, 'train', BATCH_SIZE, IMG_SHAPE, augment=augment)
+else:
+  plain_train = ImageDataGenerator(rescale=1./255).flow_from_directory(batch_size=BATCH_SIZE,
+                                                                     directory=TRAIN_DIR,
+                                                                     target_size=(IMG_SHAPE,IMG_SHAPE),
+                                                                     class_mode='binary')
+  augmented_train = train_generator
+
+# (backbone, trainable last layers, dropout, epochs) as in the sections above
+frozen_runs = [
+    ('DenseNet121', 0, 0.5, 20),
+    ('DenseNet121', 5, 0.5, 10),
+    ('MobileNetV2', 5, 0.5, 10),
+    ('InceptionResNetV2', 7, 0.5, 50),
+    ('VGG16', 5, 0.5, 10),
+    ('VGG19', 5, 0.5, 10),
+    ('InceptionV3', 5, 0.5, 10),
+    ('ResNet101V2', 5, 0.5, 10),
+    ('ResNet152V2', 5, 0.5, 10),
+]
+
+for name, trainable_layers, dropout, epochs in frozen_runs:
+  net = backbone(name)
+  model, history = fit_from_bottleneck(net, name, trainable_layers,
+                                       augmented_train if bottleneck_views > 1 else plain_train,
+                                       val_generator,
+                                       epochs=epochs,
+                                       dropout=dropout,
+                                       views=bottleneck_views,
+                                       batch_size=BATCH_SIZE,
+                                       train_samples=plain_train.samples,
+                                       # for the datasets and in-memory copies that do not tell
+                                       draft=DRAFT_DECODE and input_pipeline != 'generator')
+  print(name, 'last', trainable_layers, 'layers trainable - validation accuracy:', history.history['val_accuracy'][-1])
+
+"""## Backbone Sweep
+
+The sections above train one backbone after another in this process. `sweep.py` declares each of them as a config (backbone, trainable layers, dropout, epochs, early stopping) and trains them concurrently in worker processes, each pinned to its own share of the CPUs, then writes a table of accuracy, wall time and images/sec to `sweep_results.csv`.
+"""
+
+extract_for_tools()
+!python sweep.py --workers 3
+
+"""## Pooled Features From Several Backbones in One Pass
+
+Comparing frozen backbones on the same 150x150 inputs used to decode the dataset once per backbone. Here every decoded batch goes through all the listed backbones in one forward call and each backbone's pooled features are written to `cache/features/`.
+"""
+
+from feature_fanout import extract_features
+
+fanout_backbones = ['VGG16', 'InceptionV3', 'ResNet101V2', 'DenseNet121']
+
+for split, directory in (('train', TRAIN_DIR), ('validation', VALIDATION_DIR)):
+  if input_pipeline == 'cache':
+    split_sequence = CachedImageSequence(split, batch_size=BATCH_SIZE)
+  elif input_pipeline == 'zip':
+    split_sequence = ZipImageSequence(zip_index, split, BATCH_SIZE, IMG_SHAPE)
+  else:
+    split_sequence = ImageDataGenerator(rescale=1./255).flow_from_directory(batch_size=BATCH_SIZE,
+                                                                          directory=directory,
+                                                                          target_size=(IMG_SHAPE,IMG_SHAPE),
+                                                                          class_mode='binary',
+                                                                          shuffle=False)
+  extract_features(split_sequence, fanout_backbones, split)
+
+"""## Batch Prediction
+
+`batch_predict.py` runs a saved model over a directory tree (or a file with one path per line), decoding in a bounded thread pool and predicting in large batches. Predictions are appended to CSV/JSONL as they are made; re-running the same command after a crash skips the files already written.
+"""
+
+extract_for_tools()
+!python batch_predict.py models/Xception.h5 data/validation --out predictions.csv
+!head predictions.csv
+
+"""## Local Inference Server
+
+`serve.py` serves a saved model on localhost and merges concurrent single-image requests into micro-batches (at most `--max-batch-size` images, waiting at most `--max-wait-ms` after the first one). `load_generator.py` sends concurrent requests and prints client-side latency percentiles next to the server's `/metrics`.
+"""
+
+from serve import serve
+from load_generator import load_images, run_load
+
+server = serve(model=tf.keras.models.load_model('models/Xception.h5', compile=False), port=8000, max_batch_size=32, max_wait_ms=5)
+
+extract_for_tools()
+sample_images = load_images(VALIDATION_DIR)
+for concurrency in (1, 8, 32):
+  print(concurrency, 'concurrent clients:', run_load('http://127.0.0.1:8000/predict', sample_images, concurrency=concurrency, requests=500))
+
+server.shutdown()
+
+"""## Float16 / Int8 TFLite Export
+
+The float32 Keras models of the big backbones are too slow for serving. `export_tflite.py` converts a saved model to float16 and int8 TFLite (int8 calibrated on a sample of `data/validation`), re-evaluates every version on the validation set and times single-image and batched CPU inference.
+"""
+
+extract_for_tools()
+!python export_tflite.py models/Xception.h5 models/NASNetLarge.h5 models/ResNet152V2.h5 --report tflite_report.csv
+
+"""## Performance Benchmarks
+
+`benchmark.py` measures input pipeline images/sec (ImageDataGenerator, decoded cache, tf.data), the JPEG decode speedup of `DRAFT_DECODE` and its pixel difference from the full decode (mean/max absolute difference, PSNR), train-step time for every architecture and freeze depth above, single-image and batched inference latency and peak RSS, on a fixed sample of the dataset or synthetic images. The JSON output records the git commit so runs can be compared with `--compare`.
+"""
+
+extract_for_tools()
+!python benchmark.py --data data --sample 1024 --out bench.json
+
+"""## Near-Duplicates and Train/Validation Leakage
+
+`dedup.py` hashes every image (64-bit DCT perceptual hash, computed over the decoded cache) and finds all pairs within a small Hamming distance with a multi-index hash. `dedup_manifest.csv` lists every image with its duplicate cluster and whether to keep it; clusters that reach into the validation set keep a validation image, so the training set keeps no copy of it. With the cache pipeline, the training cache is then rebuilt from the kept images only (`refresh_image_cache(..., keep=kept_paths(...))`, which decodes nothing new), and the sections after this one train on it.
+"""
+
+extract_for_tools()
+!python dedup.py --radius 6 --out dedup_manifest.csv
+
+import pandas as pd
+
+dedup = pd.read_csv('dedup_manifest.csv')
+print(dedup.groupby('split')['keep'].value_counts().unstack())
+print(dedup[~dedup['keep']].head())
+
+# the models below train on the cache without the dropped duplicates
+if input_pipeline == 'cache':
+  from dedup import kept_paths
+
+  train_keep = kept_paths('dedup_manifest.csv', 'train')
+  refresh_image_cache(manifest, 'train', shuffle=True, draft=DRAFT_DECODE, keep=train_keep)
+  train_generator = CachedImageSequence('train', batch_size=BATCH_SIZE, shuffle=True, augment=augment)
+  print('Training on', train_generator.samples, 'deduplicated images')
+
+"""## Hyperband Search
+
+The experiments above fix the freeze depth, dropout, learning rate and epochs by hand and train every variant to the end. `search.py` runs Hyperband over those choices instead: many random configurations get a few epochs, and only the best third of each rung is trained on, up to `--max-epochs`. Promoted runs continue from their checkpoints, the search state is kept in `search/hyperband.json` so an interrupted search resumes, and `--budget-hours` caps the CPU-hours it may spend.
+"""
+
+extract_for_tools()
+!python search.py --max-epochs 27 --eta 3 --budget-hours 48 --workers 3
+
+"""## Progressive-Resolution Training
+
+Every model above trains at 150x150 from the first epoch. `progressive.py` runs the early epochs on smaller images instead (here 96, then 128, then 150): at each stage the model is rebuilt at the new input size, the weights are carried over (the Flatten -> Dense kernel is resampled to the new feature map), and an EarlyStopping callback keeps counting across the stages. The images are decoded at each stage's size by the same input pipeline as above (for the cache, one decoded cache per size), so the early stages also decode fewer pixels. Below, MobileNetV2 gets the same 10 epochs as in its section above, at a fraction of the cost.
+"""
+
+import time
+from progressive import fit_progressive, schedule
+from sweep import EXPERIMENTS, build_model
+
+mobilenet_config = next(c for c in EXPERIMENTS if c['name'] == 'MobileNetV2')
+print(schedule(mobilenet_config['epochs']))
+
+def data_at(split, size):
+  # the batches of `split` decoded at size x size by the selected input pipeline
+  train = split == 'train'
+  if size == IMG_SHAPE:
+    return train_generator if train else val_generator
+  if input_pipeline == 'cache':
+    name = '%s_%d' % (split, size)
+    refresh_image_cache(manifest, split, name=name, img_shape=size, shuffle=train, draft=DRAFT_DECODE,
+                        keep=train_keep if train else None)
+    return CachedImageSequence(name, batch_size=BATCH_SIZE, shuffle=train, augment=augment if train else None)
+  if input_pipeline == 'tfdata':
+    return make_dataset(TRAIN_DIR if train else VALIDATION_DIR, BATCH_SIZE, img_shape=size, shuffle=train,
+                        augment=augment if train else None, seed=AUGMENT_SEED, draft=DRAFT_DECODE)
+  if input_pipeline == 'zip':
+    return ZipImageSequence(zip_index, split, BATCH_SIZE, size, shuffle=train, augment=augment if train else None,
+                            seed=AUGMENT_SEED, draft=DRAFT_DECODE)
+  datagen = train_datagen if train else val_datagen
+  return datagen.flow_from_directory(batch_size=BATCH_SIZE, directory=TRAIN_DIR if train else VALIDATION_DIR,
+                                     shuffle=train, target_size=(size, size), class_mode='binary')
+
+start = time.perf_counter()
+history, model = fit_progressive(lambda size: build_model(mobilenet_config, img_shape=size),
+                                 schedule(mobilenet_config['epochs']),
+                                 lambda size: data_at('train', size), lambda size: data_at('validation', size),
+                                 callbacks=[tf.keras.callbacks.EarlyStopping(patience=3)])
+print('Progressive training took %.0fs' % (time.perf_counter() - start))
+
+score = model.evaluate(val_generator, verbose=0)
+print('Test loss:', score[0])
+print('Test accuracy:', score[1])
+
+"""## Distilling Xception Into the Simple CNN
+
+Xception is the most accurate model above but far too heavy to serve; the simple CNN from the start of the notebook is cheap but less accurate. `distill.py` computes Xception's logits for the training set once (cached under `cache/teacher/`), trains the simple CNN on a mix of the hard labels and Xception's softened predictions, and reports validation accuracy and CPU latency of Xception, the simple CNN trained on labels only, and the distilled CNN.
+"""
+
+extract_for_tools()
+!python distill.py models/Xception.h5 --epochs 30 --out models/SimpleCNN_distilled.h5
+!cat distill_report.csv
+
+"""## Test-Time Augmentation
+
+The evaluations above score one view of every validation image. `tta.py` wraps a model so that every batch goes through it once as K stacked views (the image, its mirror image and randomly shifted/flipped copies, as in the training ImageDataGenerator) and the K probabilities are averaged. The report shows the accuracy gained for every K against the added latency; `batch_predict.py --tta-views K` predicts the same way.
+"""
+
+extract_for_tools()
+!python tta.py models/Xception.h5 models/SimpleCNN_distilled.h5 --views 1 2 4 8
+!cat tta_report.csv
+
+"""## Embedding Index and k-NN Classification
+
+`knn_index.py` exports the backbone embeddings of a trained model (the tensor its Flatten head reads, average-pooled and normalized) for the whole training set as one float16 matrix, and indexes them twice: exactly, with blocked matrix multiplies, and approximately, with an IVF-PQ index (coarse k-means lists, residuals stored as 16 one-byte codes). Both classify validation images by a vote of their nearest training images and find similar images; new labelled images are added with `index.add(vectors, labels)` and count immediately, without retraining.
+"""
+
+extract_for_tools()
+!python knn_index.py models/Xception.h5 --k 10
+
+from knn_index import EMBEDDINGS_DIR, IVFPQIndex, load_embeddings
+
+ivfpq = IVFPQIndex.load(os.path.join(EMBEDDINGS_DIR, 'Xception_ivfpq.npz'))
+val_embeddings, val_labels = load_embeddings(os.path.join(EMBEDDINGS_DIR, 'Xception_validation.npy'))
+ids, similarities = ivfpq.search(val_embeddings[:1], k=5)
+print('Most similar training images:', ids[0], similarities[0])
+
+"""## Sharded Records and Multi-Worker Training
+
+`records.py` writes every split once as GZIP-compressed TFRecord shards of decoded pixels, each shard mixing both classes and of the same size, with an `index.json` of per-shard label counts and checksums. `multiworker.py` trains on them with synchronous data parallelism: several local worker processes, each on its own CPUs and reading its own shards, kept in step by a MultiWorkerMirroredStrategy. The report shows how images/sec scales with the number of workers at a fixed global batch.
+"""
+
+extract_for_tools()
+!python records.py data records --shards 16 --verify
+!python multiworker.py --model SimpleCNN --workers 1 2 4 --epochs 3
+!cat multiworker_scaling.csv
+
+"""## Memory-Bounded Training of the Large Backbones
+
+NASNetLarge and Xception train with every layer trainable. `accumulate.py` keeps the batch of 32 but runs it in smaller micro-batches and adds up their gradients before the single optimizer step, so the updates stay the same. Optionally the backbone is cut into segments at block boundaries whose activations are recomputed in the backward pass instead of kept. The report gives the train-step time and the peak memory per step for each setting; `sweep.py --micro-batch 8 --checkpoint-segments 4` trains the fully trainable configs this way.
+"""
+
+!python accumulate.py --model Xception NASNetLarge --micro-batch 32 8 4 --segments 0 4
+!cat accumulate_report.csv
@@ -0,0 +1,85 @@
+"""Load generator for serve.py: concurrent single-image requests against localhost.
+
+    python load_generator.py data/validation --concurrency 32 --requests 2000
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+from batch_predict import iter_directory
+
+
+def post_image(url, data):
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run_load(url, images, concurrency=16, requests=1000):
+    """Send `requests` POSTs from `concurrency` threads; returns client-side latency stats."""
+    if not images:
+        raise ValueError('no images to send')
+    lock = threading.Lock()
+    payloads = itertools.cycle(images)
+    latencies, errors = [], [0]
+    remaining = [requests]
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+                data = next(payloads)
+            start = time.perf_counter()
+            try:
+                post_image(url, data)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    result = dict(requests=len(latencies), errors=errors[0], throughput_rps=round(len(latencies) / elapsed, 2))
+    # no percentiles when every request failed
+    if latencies:
+        ms = np.array(latencies) * 1000
+        for p in (50, 95, 99):
+            result['p%d_ms' % p] = round(float(np.percentile(ms, p)), 2)
+    return result
+
+
+def load_images(directory, limit=200):
+    images = []
+    for path in itertools.islice(iter_directory(directory), limit):
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('images', help='directory of images to send')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    client = run_load(args.url + '/predict', load_images(args.images), args.concurrency, args.requests)
+    print('client:', json.dumps(client))
+    with urllib.request.urlopen(args.url + '/metrics') as response:
+        print('server:', response.read().decode())
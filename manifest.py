@@ -0,0 +1,153 @@
+"""Persistent dataset manifest with content hashes, for incremental cache updates.
+
+The manifest (an SQLite file) records path, split, label, size, mtime and
+SHA-1 of every image. An update only hashes files whose size or mtime changed
+and reports what was added, changed or removed. Derived caches are keyed by
+content hash, so after an update only the new or changed images are decoded
+again (refresh_image_cache) or featurized again (feature_fanout, which reads
+the hashes from the cache index); bottleneck caches carry a fingerprint of
+the hashes and are rebuilt when it changes.
+
+    python manifest.py data
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from image_cache import (CACHE_DIR, IMG_SHAPE, cache_paths, decode_image, has_cache, list_images, load_cache,
+                         save_labels)
+
+MANIFEST_PATH = os.path.join(CACHE_DIR, 'manifest.sqlite')
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint(hashes):
+    """One hash for an ordered list of content hashes."""
+    return hashlib.sha1('\n'.join(hashes).encode()).hexdigest()
+
+
+class Manifest:
+
+    def __init__(self, path=MANIFEST_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, split TEXT, label INTEGER, '
+                        'class_name TEXT, size INTEGER, mtime_ns INTEGER, sha1 TEXT)')
+
+    def update(self, data_dir, splits=('train', 'validation'), workers=8):
+        """Bring the manifest in line with `data_dir`; returns {'added': [...], 'changed': [...], 'removed': [...]}."""
+        # only the scanned splits can have lost files, the others are left as they are
+        known = {row[0]: row[1:] for row in self.db.execute(
+            'SELECT path, size, mtime_ns, sha1 FROM images WHERE split IN (%s)' % ', '.join('?' * len(splits)),
+            tuple(splits))}
+        seen, to_hash = set(), []
+        for split in splits:
+            paths, labels, class_names = list_images(os.path.join(data_dir, split))
+            for path, label in zip(paths, labels):
+                st = os.stat(path)
+                seen.add(path)
+                old = known.get(path)
+                if old is None or old[0] != st.st_size or old[1] != st.st_mtime_ns:
+                    to_hash.append((path, split, int(label), class_names[int(label)], st.st_size, st.st_mtime_ns))
+
+        with ThreadPoolExecutor(workers) as pool:
+            hashes = list(pool.map(file_sha1, [entry[0] for entry in to_hash]))
+
+        changes = dict(added=[], changed=[], removed=sorted(set(known) - seen))
+        with self.db:
+            for entry, sha1 in zip(to_hash, hashes):
+                path = entry[0]
+                if path not in known:
+                    changes['added'].append(path)
+                elif known[path][2] != sha1:
+                    changes['changed'].append(path)
+                self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)', entry + (sha1,))
+            self.db.executemany('DELETE FROM images WHERE path = ?', [(p,) for p in changes['removed']])
+        return changes
+
+    def entries(self, split):
+        """(paths, labels, hashes, class_names) of a split, in flow_from_directory order."""
+        rows = self.db.execute('SELECT path, label, sha1, class_name FROM images WHERE split = ? '
+                               'ORDER BY label, path', (split,)).fetchall()
+        class_names = sorted(set(r[3] for r in rows))
+        return ([r[0] for r in rows], np.array([r[1] for r in rows], dtype=np.float32), [r[2] for r in rows],
+                class_names)
+
+    def class_counts(self, split):
+        return dict(self.db.execute('SELECT class_name, COUNT(*) FROM images WHERE split = ? GROUP BY class_name',
+                                    (split,)).fetchall())
+
+
+def refresh_image_cache(manifest, split, name=None, cache_dir=CACHE_DIR, img_shape=IMG_SHAPE,
+                        shuffle=False, workers=8, draft=False, keep=None):
+    """Rebuild the decoded cache of `split`, decoding only images whose content is new.
+
+    Rows are keyed by content hash: unchanged images are copied over from the
+    previous cache. With shuffle=True rows are ordered by hash, a fixed
+    pseudo-random order that new images simply slot into. `keep` limits the
+    cache to those paths, e.g. dedup.kept_paths of a deduplicated manifest.
+    Returns the number of images that had to be decoded.
+    """
+    name = name or split
+    paths, labels, hashes, class_names = manifest.entries(split)
+    if keep is not None:
+        keep = set(keep)
+        rows = [i for i, path in enumerate(paths) if path in keep]
+        paths, labels, hashes = [paths[i] for i in rows], labels[rows], [hashes[i] for i in rows]
+    order = np.argsort(hashes, kind='stable') if shuffle else np.arange(len(paths))
+    paths, labels, hashes = [paths[i] for i in order], labels[order], [hashes[i] for i in order]
+
+    old_rows = {}
+    if has_cache(name, cache_dir):
+        old_images, _, old_index = load_cache(name, cache_dir)
+        if old_index.get('img_shape') == img_shape and old_index.get('draft', False) == draft:
+            old_rows = {h: i for i, h in enumerate(old_index.get('hashes', []))}
+    if old_rows and old_index['hashes'] == hashes:
+        return 0
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images_path, labels_path, index_path = cache_paths(name, cache_dir)
+    images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(len(paths), img_shape, img_shape, 3))
+    missing = []
+    for i, h in enumerate(hashes):
+        if h in old_rows:
+            images[i] = old_images[old_rows[h]]
+        else:
+            missing.append(i)
+    with ThreadPoolExecutor(workers) as pool:
+        for i, img in zip(missing, pool.map(lambda i: decode_image(paths[i], img_shape, draft), missing)):
+            images[i] = img
+    images.flush()
+    del images
+
+    save_labels(labels_path + '.tmp', labels)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'directory': os.path.dirname(os.path.dirname(paths[0])) if paths else None,
+                   'class_names': class_names, 'img_shape': img_shape, 'draft': draft, 'paths': paths,
+                   'hashes': hashes}, f)
+    os.replace(images_path + '.tmp', images_path)
+    os.replace(labels_path + '.tmp', labels_path)
+    os.replace(index_path + '.tmp', index_path)
+    return len(missing)
+
+
+if __name__ == '__main__':
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else 'data'
+    manifest = Manifest()
+    changes = manifest.update(data_dir)
+    print('added %d, changed %d, removed %d' % tuple(len(changes[k]) for k in ('added', 'changed', 'removed')))
+    for split, shuffle in (('train', True), ('validation', False)):
+        print(split, manifest.class_counts(split), '- decoded', refresh_image_cache(manifest, split, shuffle=shuffle))
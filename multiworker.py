@@ -0,0 +1,177 @@
+"""Synchronous data-parallel training across local worker processes.
+
+run_cluster starts `workers` processes on this machine and joins them into one
+cluster of localhost workers through TF_CONFIG. Each process is pinned to its
+own slice of the CPUs (as in sweep.py) and builds the model under a
+MultiWorkerMirroredStrategy, whose all-reduce keeps the replicas identical
+after every step. Each worker reads only its own shards of the records written
+by records.py, and the global batch is split evenly across the workers.
+
+scaling_report runs the same training for several worker counts at a fixed
+global batch and reports images/sec, the speedup over the first count and the
+scaling efficiency.
+
+    python records.py data records --shards 16
+    python multiworker.py --model SimpleCNN --workers 1 2 4
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import tempfile
+import time
+
+from benchmark import MODELS
+from records import RECORDS_DIR
+from sweep import partition_cpus
+
+SCALING_FIELDS = ['model', 'workers', 'global_batch', 'steps_per_epoch', 'images_per_sec', 'speedup', 'efficiency']
+
+
+def free_ports(n):
+    """n localhost ports that are free right now."""
+    socks = [socket.socket() for _ in range(n)]
+    try:
+        for s in socks:
+            s.bind(('localhost', 0))
+        return [s.getsockname()[1] for s in socks]
+    finally:
+        for s in socks:
+            s.close()
+
+
+def _train_worker(task, cluster, cpus, config, records_dir, global_batch, epochs, validate, model_path, results):
+    """One worker of the cluster; the chief (task 0) puts the run's result on `results`."""
+    os.sched_setaffinity(0, cpus)
+    os.environ['OMP_NUM_THREADS'] = str(len(cpus))
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': {'worker': cluster}, 'task': {'type': 'worker', 'index': task}})
+
+    import numpy as np
+    import tensorflow as tf
+
+    from records import load_index, make_record_dataset, worker_shards
+    from sweep import build_model, build_simple_cnn
+
+    tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    num_workers = len(cluster)
+    per_worker_batch = global_batch // num_workers
+
+    def distributed(split):
+        def dataset_fn(context):
+            return make_record_dataset(split, records_dir, context.get_per_replica_batch_size(global_batch),
+                                       seed=task, worker=context.input_pipeline_id,
+                                       num_workers=context.num_input_pipelines, repeat=True)
+
+        # every worker must run the same number of steps, so the epoch ends
+        # when the worker with the fewest records has seen all of them
+        index = load_index(split, records_dir)
+        steps = min(sum(entry['records'] for entry in worker_shards(index, w, num_workers))
+                    for w in range(num_workers)) // per_worker_batch
+        return strategy.distribute_datasets_from_function(dataset_fn), steps
+
+    train_data, steps = distributed('train')
+    fit_kwargs = {}
+    if validate:
+        fit_kwargs['validation_data'], fit_kwargs['validation_steps'] = distributed('validation')
+
+    with strategy.scope():
+        model = build_simple_cnn() if config['backbone'] == 'SimpleCNN' else build_model(config)
+
+    epoch_times = []
+    timer = tf.keras.callbacks.LambdaCallback(
+        on_epoch_begin=lambda epoch, logs: epoch_times.append(time.perf_counter()),
+        on_epoch_end=lambda epoch, logs: epoch_times.append(time.perf_counter() - epoch_times.pop()))
+    history = model.fit(train_data, epochs=epochs, steps_per_epoch=steps, callbacks=[timer],
+                        verbose=2 if task == 0 else 0, **fit_kwargs)
+
+    if model_path:
+        # every worker takes part in saving; only the chief's copy is kept
+        if task == 0:
+            model.save(model_path)
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                model.save(os.path.join(tmp, os.path.basename(model_path)))
+
+    if task == 0:
+        # the first epoch also traces the step and sets up the collectives
+        timed = epoch_times[1:] or epoch_times
+        results.put(dict(model=config['name'], workers=num_workers, global_batch=global_batch,
+                         steps_per_epoch=steps,
+                         images_per_sec=round(steps * global_batch / float(np.median(timed)), 1),
+                         history={k: [round(v, 4) for v in vs] for k, vs in history.history.items()}))
+
+
+def run_cluster(workers, config, records_dir=RECORDS_DIR, global_batch=64, epochs=3, validate=True,
+                model_path=None):
+    """Train `config` on a cluster of `workers` localhost processes and return the chief's result."""
+    groups = partition_cpus(workers)
+    if len(groups) < workers:
+        raise ValueError('%d workers need at least as many CPUs, %d are available' % (workers, len(groups)))
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    cluster = ['localhost:%d' % port for port in free_ports(workers)]
+    procs = [ctx.Process(target=_train_worker, args=(task, cluster, cpus, config, records_dir, global_batch,
+                                                     epochs, validate, model_path, results))
+             for task, cpus in enumerate(groups)]
+    for p in procs:
+        p.start()
+    try:
+        while True:
+            try:
+                result = results.get(timeout=5)
+                break
+            except queue.Empty:
+                failed = [task for task, p in enumerate(procs) if p.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError('worker(s) %s of %d failed' % (failed, workers))
+        for p in procs:
+            p.join()
+        return result
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+
+
+def scaling_report(config, worker_counts=(1, 2, 4), records_dir=RECORDS_DIR, global_batch=64, epochs=3):
+    """Throughput rows for every worker count, relative to the first one."""
+    rows = []
+    for workers in worker_counts:
+        row = run_cluster(workers, config, records_dir, global_batch, epochs, validate=False)
+        del row['history']
+        base = rows[0] if rows else row
+        row['speedup'] = round(row['images_per_sec'] / base['images_per_sec'], 2)
+        row['efficiency'] = round(row['speedup'] * base['workers'] / workers, 2)
+        rows.append(row)
+        print(', '.join('%s=%s' % (k, row[k]) for k in SCALING_FIELDS))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--model', default='SimpleCNN', help='a model name from benchmark.MODELS')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--records', default=RECORDS_DIR)
+    parser.add_argument('--batch-size', type=int, default=64, help='global batch, split across the workers')
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--save', help='train once on the largest worker count with validation and save the model')
+    parser.add_argument('--report', default='multiworker_scaling.csv')
+    args = parser.parse_args()
+
+    config = next(c for c in MODELS if c['name'] == args.model)
+    if args.save:
+        result = run_cluster(max(args.workers), config, args.records, args.batch_size, args.epochs,
+                             model_path=args.save)
+        print(json.dumps(result, indent=1))
+    else:
+        rows = scaling_report(config, args.workers, args.records, args.batch_size, args.epochs)
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SCALING_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
@@ -0,0 +1,148 @@
+"""Training-step profiler: time waiting for input versus time computing.
+
+StepProfiler is a Keras callback. Its `wrap(source)` turns the training
+generator / Sequence / dataset into a timed stream that records when every
+batch became ready. A step that starts before its batch is ready was blocked
+on input for the difference; the rest of the step is forward/backward compute.
+Prefetched batches count as no wait.
+
+Per epoch it also reports throughput and the RSS high-water mark, and it can
+record a TensorFlow profiler trace for a step range, or for the next steps
+whenever the trigger file appears.
+
+    profiler = StepProfiler(trace_steps=(20, 25))
+    history = model.fit(profiler.wrap(train_generator), steps_per_epoch=len(train_generator),
+                        epochs=epochs, callbacks=[callback, profiler], validation_data=val_generator)
+    profiler.print_summary()
+    profiler.save('profile.json')   # later: python profiling.py profile.json
+"""
+import collections
+import json
+import os
+import resource
+import sys
+import time
+
+import tensorflow as tf
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+class StepProfiler(tf.keras.callbacks.Callback):
+
+    def __init__(self, trace_steps=None, trace_dir='logs/profile', trigger_file='PROFILE_NOW',
+                 trigger_steps=5):
+        super().__init__()
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.trigger_file = trigger_file
+        self.trigger_steps = trigger_steps
+        self.ready = collections.deque()
+        self.wrapped = False
+        self.global_step = 0
+        self.tracing_until = None
+        self.epochs = []
+
+    def wrap(self, source):
+        """Endless generator over `source` that time-stamps every batch it hands out."""
+        self.wrapped = True
+
+        def timed():
+            while True:
+                if hasattr(source, '__getitem__') and hasattr(source, '__len__'):
+                    batches = (source[i] for i in range(len(source)))
+                else:
+                    batches = iter(source)
+                for batch in batches:
+                    self.ready.append((time.perf_counter(), len(batch[0])))
+                    yield batch
+                if hasattr(source, 'on_epoch_end'):
+                    source.on_epoch_end()
+
+        return timed()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = dict(epoch=epoch, steps=0, images=0, input_wait_s=0., compute_s=0., rss_hwm_mb=0.,
+                          start=time.perf_counter())
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_begin = time.perf_counter()
+        if self.trace_steps and self.global_step == self.trace_steps[0]:
+            self._start_trace(self.trace_steps[1])
+        elif self.trigger_file and self.tracing_until is None and os.path.exists(self.trigger_file):
+            os.remove(self.trigger_file)
+            self._start_trace(self.global_step + self.trigger_steps)
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.perf_counter()
+        begin = self.step_begin
+        images = 0
+        if self.wrapped and self.ready:
+            ready, images = self.ready.popleft()
+            self.epoch['input_wait_s'] += max(0., ready - begin)
+            begin = max(begin, ready)
+        self.epoch['compute_s'] += end - begin
+        self.epoch['steps'] += 1
+        self.epoch['images'] += images
+        self.epoch['rss_hwm_mb'] = max(self.epoch['rss_hwm_mb'], current_rss_mb())
+
+        self.global_step += 1
+        if self.tracing_until is not None and self.global_step >= self.tracing_until:
+            tf.profiler.experimental.stop()
+            self.tracing_until = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        e = self.epoch
+        elapsed = time.perf_counter() - e.pop('start')
+        e['train_s'] = round(e['input_wait_s'] + e['compute_s'], 3)
+        e['input_fraction'] = round(e['input_wait_s'] / e['train_s'], 3) if e['train_s'] else 0.
+        e['images_per_sec'] = round(e['images'] / e['train_s'], 1) if e['images'] else None
+        e['epoch_s'] = round(elapsed, 3)  # including validation
+        e['input_wait_s'] = round(e['input_wait_s'], 3)
+        e['compute_s'] = round(e['compute_s'], 3)
+        e['rss_hwm_mb'] = round(e['rss_hwm_mb'], 1)
+        self.epochs.append(e)
+
+    def on_train_end(self, logs=None):
+        if self.tracing_until is not None:
+            tf.profiler.experimental.stop()
+            self.tracing_until = None
+
+    def _start_trace(self, until_step):
+        tf.profiler.experimental.start(self.trace_dir)
+        self.tracing_until = until_step
+        print('Profiling steps %d-%d into %s' % (self.global_step, until_step, self.trace_dir))
+
+    def summary(self):
+        return dict(epochs=self.epochs, peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                    input_wait_s=round(sum(e['input_wait_s'] for e in self.epochs), 3),
+                    compute_s=round(sum(e['compute_s'] for e in self.epochs), 3))
+
+    def print_summary(self):
+        print_summary(self.summary())
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def print_summary(summary):
+    fields = ['epoch', 'steps', 'input_wait_s', 'compute_s', 'input_fraction', 'images_per_sec', 'epoch_s',
+              'rss_hwm_mb']
+    print(' '.join('%14s' % f for f in fields))
+    for e in summary['epochs']:
+        print(' '.join('%14s' % e[f] for f in fields))
+    total = summary['input_wait_s'] + summary['compute_s']
+    print('input wait %.1fs (%.0f%%), compute %.1fs, peak RSS %.0f MB'
+          % (summary['input_wait_s'], 100 * summary['input_wait_s'] / total if total else 0,
+             summary['compute_s'], summary['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            print(path)
+            print_summary(json.load(f))
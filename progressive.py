@@ -0,0 +1,183 @@
+"""Progressive-resolution training: early epochs on smaller images.
+
+A convolution costs in proportion to the number of pixels, so an epoch at 96x96
+is about 2.4x cheaper than one at 150x150. fit_progressive trains through a
+schedule of stages such as 96 -> 128 -> 150. For every stage the model is
+built again at that input size and the weights of the previous stage are
+carried over.
+
+The training and validation data are best given as functions of the size
+that decode the images at that size, e.g. a decoded cache per size
+(refresh_image_cache(..., img_shape=size)), make_dataset(..., img_shape=size)
+or flow_from_directory(target_size=(size, size)); the early stages then also
+decode fewer pixels. A Sequence, generator or tf.data Dataset given directly
+is still decoded at its own size and resized batch by batch, which saves
+only the model's share of the cost.
+
+All backbone weights (convolutions, batch norm) do not depend on the input
+size and are copied as they are. The Flatten -> Dense head does: its kernel
+has one row per feature-map position, so it is resampled to the new feature
+map. The optimizer starts fresh at every stage.
+
+    history, model = fit_progressive(lambda size: build_model(config, img_shape=size),
+                                     schedule(20), train_generator, val_generator)
+"""
+import tensorflow as tf
+
+STAGE_SIZES = (96, 128, 150)
+
+
+def schedule(epochs, sizes=STAGE_SIZES, fractions=(0.25, 0.25, 0.5)):
+    """[(img_shape, epochs)] splitting `epochs` over `sizes`; the last stage gets the rest."""
+    stages, used = [], 0
+    for size, fraction in zip(sizes[:-1], fractions[:-1]):
+        n = int(epochs * fraction)
+        if n:
+            stages.append((size, n))
+            used += n
+    stages.append((sizes[-1], max(1, epochs - used)))
+    return stages
+
+
+class ResizedSequence(tf.keras.utils.Sequence):
+    """Batches of another Sequence (or DirectoryIterator) resized to `img_shape` x `img_shape`.
+
+    The wrapped sequence needs .samples, .class_indices and .batch_size.
+    """
+
+    def __init__(self, sequence, img_shape):
+        super().__init__()
+        self.sequence = sequence
+        self.img_shape = img_shape
+        self.samples = sequence.samples
+        self.class_indices = sequence.class_indices
+        self.batch_size = sequence.batch_size
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, idx):
+        x, y = self.sequence[idx]
+        if x.shape[1:3] != (self.img_shape, self.img_shape):
+            x = tf.image.resize(x, (self.img_shape, self.img_shape), method='area').numpy()
+        return x, y
+
+    def on_epoch_end(self):
+        if hasattr(self.sequence, 'on_epoch_end'):
+            self.sequence.on_epoch_end()
+
+
+def at_size(source, img_shape):
+    """`source` giving img_shape x img_shape batches: built at that size when it is a
+    function of the size, otherwise resized batch by batch."""
+    if source is None:
+        return None
+    if isinstance(source, tf.data.Dataset):
+        if tuple(source.element_spec[0].shape[1:3]) == (img_shape, img_shape):
+            return source
+        return source.map(lambda x, y: (tf.image.resize(x, (img_shape, img_shape), method='area'), y),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    if callable(source):
+        return source(img_shape)
+    return ResizedSequence(source, img_shape)
+
+
+class _KeepEarlyStopping(tf.keras.callbacks.Callback):
+    """Puts EarlyStopping's counters back after it resets them at the start of a stage."""
+
+    def __init__(self, early_stopping):
+        super().__init__()
+        self.early_stopping = early_stopping
+        self.state = None
+
+    def on_train_begin(self, logs=None):
+        if self.state is not None:
+            self.early_stopping.wait, self.early_stopping.best = self.state
+
+    def on_train_end(self, logs=None):
+        self.state = self.early_stopping.wait, self.early_stopping.best
+        # weights of another input size cannot be restored into the next stage's model
+        self.early_stopping.best_weights = None
+
+
+def _resample_dense_kernel(kernel, old_map, new_map):
+    """Resize a Dense kernel over a flattened (h, w, c) map to a map of another size."""
+    h, w, c = old_map
+    units = kernel.shape[-1]
+    resized = tf.image.resize(kernel.reshape(h, w, c * units), new_map[:2], method='bilinear').numpy()
+    # keep the response to a constant map: the sum over positions scales with the area
+    resized *= (h * w) / float(new_map[0] * new_map[1])
+    return resized.reshape(-1, units)
+
+
+def transfer_weights(old, new):
+    """Copy `old`'s weights into the same architecture `new` built at another input size.
+
+    Layers are matched by position. Weights of the same shape are copied; a
+    Dense kernel behind a Flatten whose feature map changed size is
+    resampled. Returns the names of the layers that could not be carried over.
+    """
+    skipped = []
+    for old_layer, new_layer in zip(old.layers, new.layers):
+        old_weights, new_weights = old_layer.get_weights(), new_layer.get_weights()
+        if not old_weights:
+            continue
+        if all(a.shape == b.shape for a, b in zip(old_weights, new_weights)):
+            new_layer.set_weights(old_weights)
+            continue
+        flatten_in = _flatten_input_shape(old_layer), _flatten_input_shape(new_layer)
+        if isinstance(new_layer, tf.keras.layers.Dense) and None not in flatten_in:
+            kernel = _resample_dense_kernel(old_weights[0], *flatten_in)
+            new_layer.set_weights([kernel] + old_weights[1:])
+        else:
+            skipped.append(new_layer.name)
+    return skipped
+
+
+def _flatten_input_shape(layer):
+    """(h, w, c) feeding the Flatten right before `layer`, or None."""
+    inbound = layer._inbound_nodes[0].inbound_layers
+    if isinstance(inbound, list):
+        inbound = inbound[0] if len(inbound) == 1 else None
+    # a Dropout between Flatten and Dense leaves the feature order alone
+    while isinstance(inbound, tf.keras.layers.Dropout):
+        inbound = inbound._inbound_nodes[0].inbound_layers
+    if not isinstance(inbound, tf.keras.layers.Flatten):
+        return None
+    shape = inbound.input_shape
+    return tuple(shape[1:]) if len(shape) == 4 else None
+
+
+def fit_progressive(build, stages, train, val=None, callbacks=None, **fit_kwargs):
+    """Train through `stages` [(img_shape, epochs)] and return (history, final model).
+
+    `build(img_shape)` returns a compiled model for that input size; `train`
+    and `val` are functions of the size or data resized per batch (see
+    at_size). Epochs are numbered across stages, and the History holds every
+    stage's logs plus an 'img_shape' entry per epoch. Callbacks are shared by
+    all stages; an EarlyStopping keeps counting across them, but with
+    restore_best_weights it can only restore weights of the current stage.
+    """
+    callbacks = list(callbacks or [])
+    callbacks += [_KeepEarlyStopping(c) for c in callbacks if isinstance(c, tf.keras.callbacks.EarlyStopping)]
+    history = tf.keras.callbacks.History()
+    history.history, history.epoch = {}, []
+    model, epoch = None, 0
+    for img_shape, epochs in stages:
+        new_model = build(img_shape)
+        if model is not None:
+            skipped = transfer_weights(model, new_model)
+            if skipped:
+                print('Re-initialized at %d: %s' % (img_shape, ', '.join(skipped)))
+        model = new_model
+        print('Stage %dx%d: epochs %d-%d' % (img_shape, img_shape, epoch + 1, epoch + epochs))
+        stage = model.fit(at_size(train, img_shape), epochs=epoch + epochs, initial_epoch=epoch, callbacks=callbacks,
+                          validation_data=at_size(val, img_shape), **fit_kwargs)
+        for k, v in stage.history.items():
+            history.history.setdefault(k, []).extend(v)
+        history.history.setdefault('img_shape', []).extend([img_shape] * len(stage.epoch))
+        history.epoch += stage.epoch
+        epoch += epochs
+        if model.stop_training:
+            break
+    return history, model
@@ -0,0 +1,154 @@
+"""Write the image folders as sharded, compressed TFRecord files.
+
+A split becomes ``<out_dir>/<split>/<split>-00003-of-00016.tfrecord.gz`` and
+so on, plus ``index.json`` with every shard's record count, per-class label
+counts, size and SHA-1. Records hold the decoded uint8 pixels (GZIP
+compressed), so readers never decode a JPEG. The images are shuffled once and
+dealt round-robin, so every shard mixes the classes and all shards are the
+same size to within one record. TFRecord checksums every record (CRC32C) and
+verify() checks whole shards against the index.
+
+make_record_dataset reads the shards of one worker out of several: shard i
+belongs to worker i % num_workers, so workers never read the same image.
+
+    python records.py data records --shard-mb 64 --verify
+"""
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from checkpointing import _read_json, _write_json
+from image_cache import IMG_SHAPE, decode_image, list_images
+from manifest import file_sha1
+
+RECORDS_DIR = 'records'
+SHARD_NAME = '%s-%05d-of-%05d.tfrecord.gz'
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def index_path(split, out_dir=RECORDS_DIR):
+    return os.path.join(out_dir, split, 'index.json')
+
+
+def load_index(split, out_dir=RECORDS_DIR):
+    index = _read_json(index_path(split, out_dir))
+    if index is None:
+        raise FileNotFoundError('no records for %r in %s, run records.py first' % (split, out_dir))
+    return index
+
+
+def _example(image, label):
+    return tf.train.Example(features=tf.train.Features(feature={
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+    })).SerializeToString()
+
+
+def write_shards(directory, split, out_dir=RECORDS_DIR, img_shape=IMG_SHAPE, shard_mb=64, shards=None,
+                 seed=0, workers=8, draft=False):
+    """Decode every image under `directory` once into the shards of `split`; returns the index.
+
+    The number of shards is `shards`, or enough to keep each one under
+    `shard_mb` of uncompressed pixels.
+    """
+    paths, labels, class_names = list_images(directory)
+    order = np.random.RandomState(seed).permutation(len(paths))
+    if shards is None:
+        total_bytes = len(paths) * img_shape * img_shape * 3
+        shards = max(1, -(-total_bytes // (shard_mb << 20)))
+
+    split_dir = os.path.join(out_dir, split)
+    os.makedirs(split_dir, exist_ok=True)
+    options = tf.io.TFRecordOptions(compression_type='GZIP')
+    entries = []
+    # PIL releases the GIL while decoding, so threads are enough here
+    with ThreadPoolExecutor(workers) as pool:
+        for shard in range(shards):
+            rows = order[shard::shards]
+            name = SHARD_NAME % (split, shard, shards)
+            path = os.path.join(split_dir, name)
+            with tf.io.TFRecordWriter(path + '.tmp', options) as writer:
+                for i, img in zip(rows, pool.map(lambda i: decode_image(paths[i], img_shape, draft), rows)):
+                    writer.write(_example(img, labels[i]))
+            os.replace(path + '.tmp', path)
+            label_counts = np.bincount(labels[rows].astype(np.int64), minlength=len(class_names))
+            entries.append(dict(file=name, records=len(rows), label_counts=label_counts.tolist(),
+                                bytes=os.path.getsize(path), sha1=file_sha1(path)))
+
+    index = dict(directory=directory, split=split, class_names=class_names, img_shape=img_shape, draft=draft,
+                 compression='GZIP', records=len(paths), shards=entries)
+    # the index goes last, its presence marks a complete conversion
+    _write_json(index_path(split, out_dir), index)
+    return index
+
+
+def verify(split, out_dir=RECORDS_DIR):
+    """Names of the shards of `split` that are missing or differ from the index."""
+    bad = []
+    for entry in load_index(split, out_dir)['shards']:
+        path = os.path.join(out_dir, split, entry['file'])
+        if not os.path.exists(path) or os.path.getsize(path) != entry['bytes'] or file_sha1(path) != entry['sha1']:
+            bad.append(entry['file'])
+    return bad
+
+
+def worker_shards(index, worker=0, num_workers=1):
+    """Index entries of the shards read by `worker`; disjoint across the workers."""
+    if len(index['shards']) < num_workers:
+        raise ValueError('%d shards cannot be split across %d workers, write at least as many shards'
+                         % (len(index['shards']), num_workers))
+    return index['shards'][worker::num_workers]
+
+
+def parse_batch(serialized, img_shape):
+    """(x / 255, float label) from a batch of serialized records, as class_mode='binary' yields."""
+    features = tf.io.parse_example(serialized, {'image': tf.io.FixedLenFeature([], tf.string),
+                                                'label': tf.io.FixedLenFeature([], tf.int64)})
+    x = tf.reshape(tf.io.decode_raw(features['image'], tf.uint8), (-1, img_shape, img_shape, 3))
+    return tf.cast(x, tf.float32) * (1. / 255), tf.cast(features['label'], tf.float32)
+
+
+def make_record_dataset(split, out_dir=RECORDS_DIR, batch_size=32, shuffle=True, shuffle_buffer=1024, seed=None,
+                        worker=0, num_workers=1, repeat=False):
+    """Batched (x, y) dataset over the shards of `split` that belong to `worker`."""
+    index = load_index(split, out_dir)
+    files = [os.path.join(out_dir, split, entry['file']) for entry in worker_shards(index, worker, num_workers)]
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle:
+        ds = ds.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=index['compression']),
+                       cycle_length=min(len(files), 4), num_parallel_calls=AUTOTUNE, deterministic=not shuffle)
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    if repeat:
+        ds = ds.repeat()
+    ds = ds.batch(batch_size)
+    ds = ds.map(lambda serialized: parse_batch(serialized, index['img_shape']), num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('data', nargs='?', default='data')
+    parser.add_argument('out', nargs='?', default=RECORDS_DIR)
+    parser.add_argument('--splits', nargs='+', default=['train', 'validation'])
+    parser.add_argument('--shard-mb', type=int, default=64, help='uncompressed pixels per shard')
+    parser.add_argument('--shards', type=int, help='exact number of shards per split (overrides --shard-mb)')
+    parser.add_argument('--draft', action='store_true', help='decode JPEGs at a reduced DCT scale')
+    parser.add_argument('--verify', action='store_true', help='re-hash the shards after writing')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        index = write_shards(os.path.join(args.data, split), split, args.out, shard_mb=args.shard_mb,
+                             shards=args.shards, draft=args.draft)
+        size_mb = sum(entry['bytes'] for entry in index['shards']) / 2. ** 20
+        print('%s: %d images in %d shards, %.1f MB' % (split, index['records'], len(index['shards']), size_mb))
+        for entry in index['shards']:
+            counts = ', '.join('%s=%d' % c for c in zip(index['class_names'], entry['label_counts']))
+            print('  %s  %d records (%s)  %.1f MB' % (entry['file'], entry['records'], counts, entry['bytes'] / 2. ** 20))
+        if args.verify:
+            bad = verify(split, args.out)
+            print('  verify: %s' % ('ok' if not bad else 'FAILED ' + ', '.join(bad)))
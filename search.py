@@ -0,0 +1,188 @@
+"""Hyperband search over backbone, freeze depth, dropout and learning rate.
+
+Instead of training every guess for its full epoch count, each Hyperband
+bracket starts many random configurations on a few epochs and, rung by rung,
+gives eta times more epochs to the best 1/eta of them (successive halving).
+Brackets differ in how aggressive that is, from many short starts down to a
+few runs at the full budget.
+
+A configuration keeps one run directory across rungs, so being promoted
+continues its training from the last checkpoint (checkpointing.fit_resumable)
+rather than starting over. Every finished (configuration, rung) is recorded in
+the search's state file and the whole search resumes where it stopped.
+`--budget-hours` caps the CPU-hours spent training (wall time times the CPUs
+of the worker); once it is spent no new rung starts and the best result so
+far is reported.
+
+    python search.py --max-epochs 27 --eta 3 --budget-hours 48 --workers 3
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from checkpointing import _read_json, _write_json
+from sweep import _pin_worker, build_model, make_generators, partition_cpus
+
+SEARCH_DIR = 'search'
+
+SPACE = dict(
+    backbone=['DenseNet121', 'Xception', 'MobileNetV2', 'InceptionResNetV2', 'VGG16', 'VGG19', 'InceptionV3',
+              'ResNet101V2', 'ResNet152V2'],
+    trainable_layers=[0, 3, 5, 7, 10, None],
+    dropout=[0.2, 0.3, 0.5],
+    learning_rate=[3e-5, 1e-4, 3e-4, 1e-3],
+)
+
+
+def sample_config(rng):
+    """A random configuration of SPACE in the sweep.EXPERIMENTS format (without epochs)."""
+    config = {k: rng.choice(v) for k, v in SPACE.items()}
+    trainable = 'all' if config['trainable_layers'] is None else 'last %d' % config['trainable_layers']
+    config['name'] = '%s %s dropout %g lr %g' % (config['backbone'], trainable, config['dropout'],
+                                                  config['learning_rate'])
+    config['early_stopping'] = None
+    return config
+
+
+def brackets(max_epochs, eta):
+    """Hyperband brackets as (number of configurations, epochs of the first rung), most aggressive first."""
+    s_max = int(math.log(max_epochs, eta) + 1e-9)
+    return [(int(math.ceil((s_max + 1) / (s + 1) * eta ** s)), max_epochs / eta ** s)
+            for s in range(s_max, -1, -1)]
+
+
+def train_trial(config, epochs, data_dir='data'):
+    """Train `config` up to `epochs` epochs in total, continuing from its checkpoint."""
+    import tensorflow as tf
+
+    from checkpointing import fit_resumable, run_dir
+
+    start = time.perf_counter()
+    train_generator, val_generator = make_generators(data_dir, config.get('augment', True))
+    model = build_model(config)
+    history = fit_resumable(model, run_dir(config), train_generator, epochs,
+                            validation_data=val_generator, verbose=2)
+    tf.keras.backend.clear_session()
+    return dict(epochs=epochs, val_accuracy=round(history.history['val_accuracy'][-1], 4),
+                val_loss=round(history.history['val_loss'][-1], 4),
+                cpu_hours=(time.perf_counter() - start) * len(os.sched_getaffinity(0)) / 3600)
+
+
+class Hyperband:
+    """A resumable Hyperband search whose state lives in one JSON file."""
+
+    def __init__(self, name='hyperband', max_epochs=27, eta=3, budget_hours=None, seed=0, search_dir=SEARCH_DIR):
+        os.makedirs(search_dir, exist_ok=True)
+        self.path = os.path.join(search_dir, name + '.json')
+        self.state = _read_json(self.path) or dict(max_epochs=max_epochs, eta=eta, seed=seed, brackets=[],
+                                                   cpu_hours=0.)
+        # a resumed search keeps the settings it was started with
+        self.max_epochs, self.eta = self.state['max_epochs'], self.state['eta']
+        self.budget_hours = budget_hours
+        self.rng = random.Random(self.state['seed'])
+        if not self.state['brackets']:
+            # configurations are distinct, as each one owns a run directory
+            seen = set()
+            for n, _ in brackets(self.max_epochs, self.eta):
+                trials = []
+                while len(trials) < n:
+                    config = sample_config(self.rng)
+                    if config['name'] not in seen:
+                        seen.add(config['name'])
+                        trials.append(dict(config=config, rungs={}))
+                self.state['brackets'].append(dict(trials=trials))
+            self._save()
+
+    def _save(self):
+        _write_json(self.path, self.state)
+
+    def over_budget(self):
+        return self.budget_hours is not None and self.state['cpu_hours'] >= self.budget_hours
+
+    def run(self, train, data_dir='data'):
+        """Run every bracket and return best().
+
+        `train(trials, data_dir)` gets a list of (config, epochs) and yields
+        (position in that list, result) as the runs finish.
+        """
+        for b, (bracket, (n, first_epochs)) in enumerate(zip(self.state['brackets'],
+                                                              brackets(self.max_epochs, self.eta))):
+            alive = list(range(n))
+            s = len(brackets(self.max_epochs, self.eta)) - 1 - b
+            for rung in range(s + 1):
+                epochs = max(1, int(round(first_epochs * self.eta ** rung)))
+                todo = [i for i in alive if str(epochs) not in bracket['trials'][i]['rungs']]
+                if todo and self.over_budget():
+                    print('CPU-hour budget spent')
+                    return self.best()
+                print('Bracket %d rung %d: %d configurations at %d epochs' % (b, rung, len(alive), epochs))
+                for i, result in train([(bracket['trials'][i]['config'], epochs) for i in todo], data_dir):
+                    trial = bracket['trials'][todo[i]]
+                    trial['rungs'][str(epochs)] = result
+                    self.state['cpu_hours'] += result['cpu_hours']
+                    self._save()
+                    print('  %-60s %.4f' % (trial['config']['name'], result['val_accuracy']))
+                alive.sort(key=lambda i: -bracket['trials'][i]['rungs'][str(epochs)]['val_accuracy'])
+                alive = alive[:max(1, len(alive) // self.eta)]
+        return self.best()
+
+    def best(self):
+        """(config, result) with the best validation accuracy among the longest-trained runs."""
+        results = [(t['config'], t['rungs'][max(t['rungs'], key=int)])
+                   for bracket in self.state['brackets'] for t in bracket['trials'] if t['rungs']]
+        if not results:
+            return None
+        return max(results, key=lambda r: (r[1]['epochs'], r[1]['val_accuracy']))
+
+
+def train_serially(trials, data_dir='data'):
+    for i, (config, epochs) in enumerate(trials):
+        yield i, train_trial(config, epochs, data_dir)
+
+
+def pool_trainer(workers, inter_op_threads=2):
+    """A `train` for Hyperband.run that runs each rung in pinned worker processes, as sweep.run_sweep does."""
+    ctx = multiprocessing.get_context('spawn')
+    cpu_groups = ctx.Queue()
+    groups = partition_cpus(workers)
+    for group in groups:
+        cpu_groups.put(group)
+    pool = ProcessPoolExecutor(len(groups), mp_context=ctx, initializer=_pin_worker,
+                               initargs=(cpu_groups, inter_op_threads))
+
+    def train(trials, data_dir='data'):
+        futures = {pool.submit(train_trial, config, epochs, data_dir): i for i, (config, epochs) in enumerate(trials)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    return pool, train
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--name', default='hyperband', help='search to start or resume')
+    parser.add_argument('--max-epochs', type=int, default=27, help='epochs of a fully trained configuration')
+    parser.add_argument('--eta', type=int, default=3, help='keep the best 1/eta at every rung')
+    parser.add_argument('--budget-hours', type=float, help='CPU-hours to spend on training')
+    parser.add_argument('--workers', type=int, default=1, help='concurrent training processes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data', default='data')
+    args = parser.parse_args()
+
+    search = Hyperband(args.name, args.max_epochs, args.eta, args.budget_hours, args.seed)
+    if args.workers > 1:
+        pool, train = pool_trainer(args.workers)
+        with pool:
+            best = search.run(train, args.data)
+    else:
+        best = search.run(train_serially, args.data)
+    print('%.1f CPU-hours spent' % search.state['cpu_hours'])
+    if best is not None:
+        config, result = best
+        print('Best: %s after %d epochs, val_accuracy %.4f' % (config['name'], result['epochs'],
+                                                                result['val_accuracy']))
+        print(dict(config, epochs=result['epochs']))
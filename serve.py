@@ -0,0 +1,180 @@
+"""Local HTTP inference server with dynamic micro-batching.
+
+Concurrent requests are merged into one model call: the batcher takes the first
+waiting request, then keeps collecting until it has `max_batch_size` images or
+`max_wait_ms` has passed since the first one. Decoding happens in the request
+threads, only the forward pass is batched.
+
+    python serve.py models/Xception.h5 --port 8000 --max-batch-size 32 --max-wait-ms 5
+
+    POST /predict   body: the raw image file    -> {"probability": ..., "label": ...}
+    GET  /metrics   p50/p95/p99 latency, throughput and mean batch size
+"""
+import argparse
+import collections
+import io
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from batch_predict import probabilities
+from image_cache import decode_image
+
+
+class LatencyStats:
+    """Latency percentiles over the last `window` requests, and overall throughput."""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.requests = 0
+        self.start = time.perf_counter()
+
+    def add_request(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.requests += 1
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batch_sizes.append(size)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = list(self.batch_sizes)
+            requests = self.requests
+        elapsed = time.perf_counter() - self.start
+        summary = dict(requests=requests, throughput_rps=round(requests / elapsed, 2),
+                       mean_batch_size=round(float(np.mean(batch_sizes)), 2) if batch_sizes else 0)
+        if len(latencies):
+            for p in (50, 95, 99):
+                summary['p%d_ms' % p] = round(float(np.percentile(latencies, p)), 2)
+        return summary
+
+
+class MicroBatcher:
+    """Runs the model on batches of concurrently submitted images in one background thread."""
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5., stats=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.stats = stats
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def predict(self, image):
+        """Probability of class 1 for one uint8 image, blocking until its batch has run."""
+        done = threading.Event()
+        slot = {'image': image, 'done': done}
+        self.requests.put(slot)
+        done.wait()
+        if 'error' in slot:
+            raise slot['error']
+        return slot['probability']
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                x = np.stack([slot['image'] for slot in batch]).astype(np.float32)
+                for slot, p in zip(batch, probabilities(self.model, x)):
+                    slot['probability'] = float(p)
+            except Exception as e:
+                for slot in batch:
+                    slot['error'] = e
+            if self.stats is not None:
+                self.stats.add_batch(len(batch))
+            for slot in batch:
+                slot['done'].set()
+
+
+def make_handler(batcher, stats, class_names=('men', 'women'), img_shape=150, draft=False):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, stats.summary())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'not found'})
+                return
+            start = time.perf_counter()
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                image = decode_image(io.BytesIO(body), img_shape, draft)
+            except Exception as e:
+                self._reply(400, {'error': 'cannot decode image: %s' % e})
+                return
+            try:
+                p = batcher.predict(image)
+            except Exception as e:
+                self._reply(500, {'error': 'prediction failed: %s' % e})
+                return
+            latency = time.perf_counter() - start
+            stats.add_request(latency)
+            self._reply(200, {'probability': round(p, 6), 'label': class_names[int(p >= 0.5)],
+                              'latency_ms': round(latency * 1000, 2)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(model, host='127.0.0.1', port=8000, max_batch_size=32, max_wait_ms=5., class_names=('men', 'women'),
+          draft=False):
+    """Start the server in a background thread and return it (call .shutdown() to stop)."""
+    stats = LatencyStats()
+    batcher = MicroBatcher(model, max_batch_size, max_wait_ms, stats)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, stats, class_names, draft=draft))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model', help='saved Keras model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.)
+    parser.add_argument('--draft', action='store_true', help='decode JPEGs at a reduced DCT scale')
+    args = parser.parse_args()
+
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(args.model, compile=False)
+    server = serve(model, args.host, args.port, args.max_batch_size, args.max_wait_ms, draft=args.draft)
+    print('Serving %s on http://%s:%d' % (args.model, args.host, args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,299 @@
+"""Run the notebook's backbone experiments as a parallel sweep.
+
+Every experiment is a config in EXPERIMENTS. The runner trains them in a pool
+of worker processes; each worker is pinned to its own slice of the CPUs and
+sets its TensorFlow intra-/inter-op threads to match, so concurrent runs do not
+oversubscribe the cores. The final table (accuracy, wall time, images/sec) is
+printed and written to CSV.
+
+    python sweep.py --workers 3
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+IMG_SHAPE = 150
+BATCH_SIZE = 32
+
+# trainable_layers is how many of the last backbone layers stay trainable
+# (None: all of them); early_stopping holds the EarlyStopping arguments
+EXPERIMENTS = [
+    dict(name='DenseNet121 train all', backbone='DenseNet121', trainable_layers=None, dropout=0.5, epochs=20,
+         early_stopping=dict(monitor='val_loss', patience=5, mode='min')),
+    dict(name='DenseNet121 freeze all', backbone='DenseNet121', trainable_layers=0, dropout=0.5, epochs=20,
+         early_stopping=None),
+    dict(name='DenseNet121 last 5', backbone='DenseNet121', trainable_layers=5, dropout=0.5, epochs=10,
+         early_stopping=None),
+    dict(name='Xception', backbone='Xception', trainable_layers=None, dropout=0.3, epochs=50,
+         early_stopping=dict(monitor='val_accuracy', mode='max', patience=10, restore_best_weights=True)),
+    dict(name='MobileNetV2', backbone='MobileNetV2', trainable_layers=5, dropout=0.5, epochs=10,
+         early_stopping=None),
+    dict(name='NASNetLarge', backbone='NASNetLarge', trainable_layers=None, dropout=0.5, epochs=50,
+         early_stopping=dict(monitor='val_accuracy', mode='max', patience=40, restore_best_weights=True)),
+    dict(name='InceptionResNetV2', backbone='InceptionResNetV2', trainable_layers=7, dropout=0.5, epochs=50,
+         early_stopping=dict(monitor='val_accuracy', mode='max', patience=40, restore_best_weights=True)),
+    dict(name='VGG16', backbone='VGG16', trainable_layers=5, dropout=0.5, epochs=10,
+         early_stopping=None),
+    dict(name='VGG19', backbone='VGG19', trainable_layers=5, dropout=0.5, epochs=10,
+         early_stopping=None),
+    dict(name='InceptionV3', backbone='InceptionV3', trainable_layers=5, dropout=0.5, epochs=10,
+         early_stopping=dict(monitor='val_accuracy', mode='max', patience=40, restore_best_weights=True)),
+    dict(name='ResNet101V2', backbone='ResNet101V2', trainable_layers=5, dropout=0.5, epochs=10,
+         early_stopping=None),
+    dict(name='ResNet152V2', backbone='ResNet152V2', trainable_layers=5, dropout=0.5, epochs=10,
+         early_stopping=None),
+]
+
+RESULT_FIELDS = ['name', 'backbone', 'trainable_layers', 'dropout', 'epochs_run', 'val_accuracy', 'val_loss',
+                 'wall_time_s', 'train_images_per_sec', 'error']
+
+
+def build_simple_cnn():
+    """The notebook's "Simple Convolutional Neural Network" (two-logit output)."""
+    import tensorflow as tf
+
+    model = tf.keras.models.Sequential([
+        tf.keras.layers.Conv2D(32, (3, 3), activation='relu', input_shape=(IMG_SHAPE, IMG_SHAPE, 3)),
+        tf.keras.layers.MaxPooling2D(2, 2),
+        tf.keras.layers.Conv2D(64, (3, 3), activation='relu'),
+        tf.keras.layers.MaxPooling2D(2, 2),
+        tf.keras.layers.Conv2D(128, (3, 3), activation='relu'),
+        tf.keras.layers.MaxPooling2D(2, 2),
+        tf.keras.layers.Conv2D(128, (3, 3), activation='relu'),
+        tf.keras.layers.MaxPooling2D(2, 2),
+        tf.keras.layers.Dropout(0.5),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(512, activation='relu'),
+        tf.keras.layers.Dense(2)
+    ])
+    model.compile(optimizer='adam',
+                  loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+                  metrics=['accuracy'])
+    return model
+
+
+def build_model(config, weights='imagenet', img_shape=IMG_SHAPE):
+    """Backbone + Flatten -> Dropout -> Dense(1, sigmoid), compiled as in the notebook.
+
+    A config with `micro_batch` trains through accumulate.AccumulatingModel,
+    optionally with `checkpoint_segments`.
+    """
+    import tensorflow as tf
+
+    from backbones import backbone
+
+    net = backbone(config['backbone'], img_shape, weights)
+    trainable_layers = config['trainable_layers']
+    if trainable_layers is not None:
+        for layer in net.layers[:len(net.layers) - trainable_layers]:
+            layer.trainable = False
+
+    x = tf.keras.layers.Flatten()(net.output)
+    x = tf.keras.layers.Dropout(config['dropout'])(x)
+    output_layer = tf.keras.layers.Dense(1, activation='sigmoid', name='sigmoid')(x)
+    model = tf.keras.Model(inputs=net.input, outputs=output_layer)
+
+    if config.get('micro_batch'):
+        from accumulate import AccumulatingModel
+
+        model = AccumulatingModel.wrap(model, config['micro_batch'], config.get('checkpoint_segments', 0))
+
+    opt = tf.keras.optimizers.RMSprop(learning_rate=config.get('learning_rate', 0.0001), decay=1e-6)
+    model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['accuracy'])
+    return model
+
+
+def make_generators(data_dir='data', augment=True, seed=0, validation=None):
+    """Train/validation batches from the decoded image cache, or the Keras generators without one.
+
+    `validation` is the spec of a shared in-memory validation set
+    (tensor_cache.TensorSequence), used instead of reading it again.
+    """
+    from batch_augment import BatchAugmenter
+    from image_cache import CachedImageSequence, has_cache
+
+    val_tensors = None
+    if validation is not None:
+        from tensor_cache import TensorSequence
+
+        val_tensors = TensorSequence.attach(validation, BATCH_SIZE)
+
+    if has_cache('train') and has_cache('validation'):
+        augmenter = BatchAugmenter(0.1, 0.1, horizontal_flip=True, seed=seed) if augment else None
+        return (CachedImageSequence('train', BATCH_SIZE, shuffle=True, augment=augmenter, seed=seed),
+                val_tensors or CachedImageSequence('validation', BATCH_SIZE))
+
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    val_generator = val_tensors or make_validation(data_dir)
+    if augment:
+        train_datagen = ImageDataGenerator(rescale=1./255, width_shift_range=0.1, height_shift_range=0.1,
+                                           horizontal_flip=True, fill_mode='nearest')
+    else:
+        train_datagen = ImageDataGenerator(rescale=1./255)
+    return (train_datagen.flow_from_directory(os.path.join(data_dir, 'train'), batch_size=BATCH_SIZE,
+                                              target_size=(IMG_SHAPE, IMG_SHAPE), class_mode='binary'),
+            val_generator)
+
+
+def make_validation(data_dir='data'):
+    """The validation batches of make_generators alone, without scanning the training set."""
+    from image_cache import CachedImageSequence, has_cache
+
+    if has_cache('train') and has_cache('validation'):
+        return CachedImageSequence('validation', BATCH_SIZE)
+
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    return ImageDataGenerator(rescale=1./255).flow_from_directory(
+        os.path.join(data_dir, 'validation'), batch_size=BATCH_SIZE, target_size=(IMG_SHAPE, IMG_SHAPE),
+        class_mode='binary')
+
+
+def load_trained_model(config):
+    """The finished model of `config` from the registry, or None if it was never trained."""
+    from checkpointing import lookup
+
+    found = lookup(config)
+    if found is None:
+        return None
+    model = build_model(config, weights=None)
+    model.load_weights(found[0])
+    return model
+
+
+def run_experiment(config, data_dir='data', validation=None):
+    """Train and evaluate one config, returning its row of the results table.
+
+    Training checkpoints every epoch into the registry and resumes from there;
+    a config that already finished is not trained again.
+    """
+    from checkpointing import fit_resumable, lookup, register, run_dir
+
+    found = lookup(config)
+    if found is not None:
+        return dict(found[1], name=config['name'])
+
+    import tensorflow as tf
+
+    start = time.perf_counter()
+    train_generator, val_generator = make_generators(data_dir, config.get('augment', True), validation=validation)
+    model = build_model(config)
+
+    callbacks = []
+    if config['early_stopping']:
+        callbacks.append(tf.keras.callbacks.EarlyStopping(**config['early_stopping']))
+
+    # training time of the epochs run here, from the start of an epoch to its
+    # last training batch, so validation and checkpointing are left out
+    stamps, train_times = {}, []
+    timer = tf.keras.callbacks.LambdaCallback(
+        on_epoch_begin=lambda epoch, logs: stamps.update(start=time.perf_counter()),
+        on_batch_end=lambda batch, logs: stamps.update(end=time.perf_counter()),
+        on_epoch_end=lambda epoch, logs: train_times.append(stamps['end'] - stamps['start']))
+    history = fit_resumable(model, run_dir(config), train_generator, config['epochs'], callbacks + [timer],
+                            validation_data=val_generator, verbose=2)
+    epochs_run = len(history.history['loss'])
+
+    score = model.evaluate(val_generator, verbose=0)
+    tf.keras.backend.clear_session()
+    images_per_sec = train_generator.samples * len(train_times) / sum(train_times) if train_times else ''
+    result = dict(name=config['name'], backbone=config['backbone'], trainable_layers=config['trainable_layers'],
+                  dropout=config['dropout'], epochs_run=epochs_run, val_accuracy=round(score[1], 4),
+                  val_loss=round(score[0], 4), wall_time_s=round(time.perf_counter() - start, 1),
+                  train_images_per_sec=round(images_per_sec, 1) if images_per_sec else '')
+    register(config, result)
+    return result
+
+
+def _pin_worker(cpu_groups, inter_op_threads):
+    """Pool initializer: take a CPU slice and size the TensorFlow thread pools to it."""
+    cpus = cpu_groups.get()
+    os.sched_setaffinity(0, cpus)
+    os.environ['OMP_NUM_THREADS'] = str(len(cpus))
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def partition_cpus(workers):
+    """Disjoint CPU slices, one per worker and at most one worker per CPU."""
+    cpus = sorted(os.sched_getaffinity(0))
+    workers = min(workers, len(cpus))
+    per_worker = len(cpus) // workers
+    return [cpus[i * per_worker:(i + 1) * per_worker] for i in range(workers)]
+
+
+def run_sweep(configs, workers=2, inter_op_threads=2, data_dir='data'):
+    """Run `configs` concurrently and return the result rows in config order.
+
+    The validation set is decoded once into shared memory and every worker
+    validates from that copy.
+    """
+    from tensor_cache import TensorSequence
+
+    ctx = multiprocessing.get_context('spawn')
+    cpu_groups = ctx.Queue()
+    groups = partition_cpus(workers)
+    for group in groups:
+        cpu_groups.put(group)
+
+    # longest runs first, so one of them does not start last and set the total time
+    order = sorted(range(len(configs)), key=lambda i: -configs[i]['epochs'])
+    rows = [None] * len(configs)
+    val_tensors = TensorSequence.from_source(make_validation(data_dir), shared=True)
+    try:
+        with ProcessPoolExecutor(len(groups), mp_context=ctx, initializer=_pin_worker,
+                                 initargs=(cpu_groups, inter_op_threads)) as pool:
+            futures = {pool.submit(run_experiment, configs[i], data_dir, val_tensors.spec): i for i in order}
+            for future in as_completed(futures):
+                config = configs[futures[future]]
+                try:
+                    rows[futures[future]] = future.result()
+                    print('Finished', config['name'])
+                except Exception as e:
+                    # one failed config (out of memory, unknown backbone) leaves the others running
+                    rows[futures[future]] = dict(name=config['name'], backbone=config['backbone'],
+                                                 trainable_layers=config['trainable_layers'],
+                                                 dropout=config['dropout'], error='%s: %s' % (type(e).__name__, e))
+                    print('Failed', config['name'], rows[futures[future]]['error'])
+    finally:
+        val_tensors.close(unlink=True)
+    return rows
+
+
+def write_results(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    widths = [max(len(field), *(len(str(row.get(field, ''))) for row in rows)) for field in RESULT_FIELDS]
+    print('  '.join(field.ljust(w) for field, w in zip(RESULT_FIELDS, widths)))
+    for row in rows:
+        print('  '.join(str(row.get(field, '')).ljust(w) for field, w in zip(RESULT_FIELDS, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=2, help='concurrent training processes')
+    parser.add_argument('--inter-op-threads', type=int, default=2)
+    parser.add_argument('--only', nargs='*', help='experiment names to run (default: all)')
+    parser.add_argument('--data', default='data')
+    parser.add_argument('--out', default='sweep_results.csv')
+    parser.add_argument('--micro-batch', type=int, help='accumulate gradients over micro-batches of this size '
+                                                        'for the fully trainable backbones')
+    parser.add_argument('--checkpoint-segments', type=int, default=0, help='with --micro-batch, recompute the '
+                                                                           'activations of this many segments')
+    args = parser.parse_args()
+
+    configs = [c for c in EXPERIMENTS if not args.only or c['name'] in args.only]
+    if args.micro_batch:
+        configs = [dict(c, micro_batch=args.micro_batch, checkpoint_segments=args.checkpoint_segments)
+                   if c['trainable_layers'] is None else c for c in configs]
+    write_results(run_sweep(configs, args.workers, args.inter_op_threads, args.data), args.out)
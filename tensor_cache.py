@@ -0,0 +1,140 @@
+"""Hold the validation set in memory as one contiguous array.
+
+The validation set is never augmented, yet the generators decode and rescale
+all of it again at the end of every epoch and once more for evaluate.
+TensorSequence reads any batch source (generator, Sequence or tf.data) once
+into a uint8 array (a quarter of the float32 size, rescaled per batch) or a
+float16 one, after which validation costs only the forward pass.
+
+With shared=True the array lives in a multiprocessing.shared_memory block that
+other processes attach to from its `spec`, so the sweep's workers all read one
+copy:
+
+    val_tensors = TensorSequence.from_source(val_generator, shared=True)
+    ...  # in a worker process
+    val_generator = TensorSequence.attach(val_tensors.spec)
+"""
+import itertools
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import tensorflow as tf
+
+
+def _open_shared(name):
+    """Attach to an existing block without letting this process unlink it at exit."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13 registers attached blocks with the resource tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class TensorSequence(tf.keras.utils.Sequence):
+    """(x, y) batches served from in-memory images and labels."""
+
+    def __init__(self, images, labels, batch_size=32, rescale=None, class_indices=None, shm=None, spec=None,
+                 index=None):
+        super().__init__()
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+        self.rescale = rescale
+        self.class_indices = class_indices or {}
+        self.samples = len(labels)
+        self.shm = shm
+        self.spec = spec
+        # the source cache's index, so feature caches keep fingerprinting the images (see manifest.py)
+        self.index = index
+
+    @classmethod
+    def from_source(cls, source, dtype=np.uint8, batch_size=None, shared=False):
+        """Read every batch of `source` once; images must be rescaled to [0, 1].
+
+        uint8 stores round(x * 255), which is exact for images that were
+        rescaled by 1/255; float16 stores x itself.
+        """
+        dtype = np.dtype(dtype)
+        if hasattr(source, '__getitem__') and hasattr(source, '__len__'):
+            batches = (source[i] for i in range(len(source)))
+        else:
+            batches = iter(source)
+        batches = ((np.round(np.asarray(x) * 255).astype(np.uint8) if dtype == np.uint8 else np.asarray(x, dtype),
+                    np.asarray(y, dtype=np.float32)) for x, y in batches)
+        # with a known size every batch goes straight into the array; otherwise
+        # the converted batches are held once and copied over
+        n = getattr(source, 'samples', None)
+        if n is None:
+            batches = list(batches)
+            n = sum(len(x) for x, _ in batches)
+        batches = iter(batches)
+        first = next(batches)
+        images_shape = (n,) + first[0].shape[1:]
+        batch_size = batch_size or getattr(source, 'batch_size', None) or len(first[0])
+        rescale = 1. / 255 if dtype == np.uint8 else None
+        class_indices = getattr(source, 'class_indices', None)
+        index = getattr(source, 'index', None)
+
+        shm = spec = None
+        if shared:
+            images_bytes = int(np.prod(images_shape)) * dtype.itemsize
+            shm = shared_memory.SharedMemory(create=True, size=images_bytes + 4 * n)
+            spec = dict(name=shm.name, shape=images_shape, dtype=dtype.str, batch_size=batch_size, rescale=rescale,
+                        class_indices=class_indices, index=index)
+            images, labels = cls._views(shm, spec)
+        else:
+            images = np.empty(images_shape, dtype=dtype)
+            labels = np.empty(n, dtype=np.float32)
+        try:
+            row = 0
+            for x, y in itertools.chain([first], batches):
+                if row + len(x) > n:
+                    raise ValueError('the source yields more than its %d samples' % n)
+                images[row:row + len(x)] = x
+                labels[row:row + len(x)] = y
+                row += len(x)
+            if row != n:
+                raise ValueError('the source yields %d of its %d samples' % (row, n))
+        except Exception:
+            if shm is not None:
+                images = labels = None
+                shm.close()
+                shm.unlink()
+            raise
+        return cls(images, labels, batch_size, rescale, class_indices, shm, spec, index)
+
+    @staticmethod
+    def _views(shm, spec):
+        images = np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=shm.buf)
+        labels = np.ndarray((spec['shape'][0],), dtype=np.float32, buffer=shm.buf, offset=images.nbytes)
+        return images, labels
+
+    @classmethod
+    def attach(cls, spec, batch_size=None):
+        """The sequence shared by another process, from its `spec`."""
+        shm = _open_shared(spec['name'])
+        images, labels = cls._views(shm, spec)
+        return cls(images, labels, batch_size or spec['batch_size'], spec['rescale'], spec['class_indices'],
+                   shm, spec, spec.get('index'))
+
+    def __len__(self):
+        return (self.samples + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        x = self.images[idx * self.batch_size:(idx + 1) * self.batch_size].astype(np.float32)
+        if self.rescale:
+            x *= self.rescale
+        return x, self.labels[idx * self.batch_size:(idx + 1) * self.batch_size]
+
+    def close(self, unlink=False):
+        """Release the shared block; the creating process passes unlink=True once everyone is done."""
+        if self.shm is not None:
+            self.images = self.labels = None
+            self.shm.close()
+            if unlink:
+                # attaching may have unregistered the block from the resource tracker this process
+                # shares (see _open_shared), which would then complain about the unlink
+                resource_tracker.register(self.shm._name, 'shared_memory')
+                self.shm.unlink()
+            self.shm = None
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from accumulate import AccumulatingModel  # noqa: E402
+
+
+def mlp(weights=None):
+    inputs = tf.keras.Input(shape=(6,))
+    x = tf.keras.layers.Dense(8, activation='relu')(inputs)
+    x = tf.keras.layers.Dense(8, activation='relu')(x)
+    x = tf.keras.layers.Dense(8, activation='relu')(x)
+    model = tf.keras.Model(inputs, tf.keras.layers.Dense(1, activation='sigmoid')(x))
+    if weights is not None:
+        model.set_weights(weights)
+    return model
+
+
+@pytest.mark.parametrize('checkpoint_segments', [0, 2])
+def test_micro_batch_step_matches_the_full_batch_step(checkpoint_segments):
+    tf.keras.utils.set_random_seed(0)
+    rng = np.random.RandomState(0)
+    x = rng.rand(16, 6).astype(np.float32)
+    y = (rng.rand(16) > 0.5).astype(np.float32)
+
+    full = mlp()
+    initial = full.get_weights()
+    full.compile(optimizer=tf.keras.optimizers.SGD(0.5), loss='binary_crossentropy')
+    full_loss = full.train_on_batch(x, y)
+
+    accumulating = AccumulatingModel.wrap(mlp(initial), micro_batch=4, checkpoint_segments=checkpoint_segments)
+    if checkpoint_segments:
+        assert len(accumulating.segment_calls) == checkpoint_segments
+    accumulating.compile(optimizer=tf.keras.optimizers.SGD(0.5), loss='binary_crossentropy')
+    micro_loss = accumulating.train_on_batch(x, y)
+
+    assert micro_loss == pytest.approx(full_loss, rel=1e-5)
+    assert any(not np.allclose(b, before) for b, before in zip(full.get_weights(), initial))
+    for a, b in zip(accumulating.get_weights(), full.get_weights()):
+        np.testing.assert_allclose(a, b, rtol=1e-4, atol=1e-6)
+
+
+def test_uneven_last_micro_batch_is_weighted_by_its_share():
+    tf.keras.utils.set_random_seed(1)
+    rng = np.random.RandomState(1)
+    x = rng.rand(10, 6).astype(np.float32)
+    y = (rng.rand(10) > 0.5).astype(np.float32)
+
+    full = mlp()
+    initial = full.get_weights()
+    full.compile(optimizer=tf.keras.optimizers.SGD(0.5), loss='binary_crossentropy')
+    full.train_on_batch(x, y)
+
+    accumulating = AccumulatingModel.wrap(mlp(initial), micro_batch=4)  # 4 + 4 + 2
+    accumulating.compile(optimizer=tf.keras.optimizers.SGD(0.5), loss='binary_crossentropy')
+    accumulating.train_on_batch(x, y)
+    for a, b in zip(accumulating.get_weights(), full.get_weights()):
+        np.testing.assert_allclose(a, b, rtol=1e-4, atol=1e-6)
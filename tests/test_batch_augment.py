@@ -0,0 +1,37 @@
+import numpy as np
+
+from batch_augment import BatchAugmenter, _shift
+
+
+def images(n=2, h=5, w=7):
+    return np.arange(n * h * w * 3, dtype=np.float32).reshape(n, h, w, 3)
+
+
+def test_integer_shift_fills_with_the_nearest_edge():
+    x = images()
+    out = _shift(x, np.array([1., -2.]), axis=2)
+    np.testing.assert_array_equal(out[0, :, :-1], x[0, :, 1:])
+    np.testing.assert_array_equal(out[0, :, -1], x[0, :, -1])
+    np.testing.assert_array_equal(out[1, :, 2:], x[1, :, :-2])
+    np.testing.assert_array_equal(out[1, :, :2], np.repeat(x[1, :, :1], 2, axis=1))
+
+
+def test_fractional_shift_interpolates_between_neighbours():
+    x = images(n=1)
+    out = _shift(x, np.array([0.5]), axis=1)
+    np.testing.assert_allclose(out[0, :-1], (x[0, :-1] + x[0, 1:]) / 2)
+
+
+def test_flip_without_shift_mirrors():
+    x = images()
+    out = _shift(x, np.zeros(2), axis=2, flip=np.array([True, False]))
+    np.testing.assert_array_equal(out[0], x[0, :, ::-1])
+    np.testing.assert_array_equal(out[1], x[1])
+
+
+def test_seeded_transforms_depend_only_on_the_key():
+    augment = BatchAugmenter(0.2, 0.2, horizontal_flip=True, seed=0)
+    x = np.random.RandomState(0).rand(8, 12, 12, 3).astype(np.float32)
+    np.testing.assert_array_equal(augment(x, (1, 3)), augment(x, (1, 3)))
+    assert not np.array_equal(augment(x, (1, 3)), augment(x, (2, 3)))
+    assert augment(x, (1, 3)).shape == x.shape
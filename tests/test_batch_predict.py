@@ -0,0 +1,71 @@
+import csv
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+from PIL import Image  # noqa: E402
+
+from batch_predict import PredictionWriter, completed_count, iter_directory, predict_stream  # noqa: E402
+
+
+def test_completed_count_of_a_missing_file(tmp_path):
+    assert completed_count(str(tmp_path / 'out.jsonl')) == 0
+
+
+def test_completed_count_drops_a_partial_last_record(tmp_path):
+    path = str(tmp_path / 'out.jsonl')
+    with open(path, 'w') as f:
+        f.write('{"path": "a"}\n{"path": "b"}\n{"path": "c"}\n{"pa')
+    assert completed_count(path) == 3
+    with open(path) as f:
+        assert f.read().endswith('"c"}\n')
+
+
+def test_completed_count_skips_the_csv_header(tmp_path):
+    path = str(tmp_path / 'out.csv')
+    with open(path, 'w') as f:
+        f.write('path,probability,label,error\n')
+    assert completed_count(path) == 0
+    with open(path, 'a') as f:
+        f.write('a,0.1,men,\nb,0.9,women,\nc,0.')
+    assert completed_count(path) == 2
+
+
+class ConstantModel:
+    def predict_on_batch(self, x):
+        return np.full((len(x), 1), 0.75)
+
+
+def test_predict_stream_resumes_without_duplicates(tmp_path):
+    for i in range(5):
+        Image.fromarray(np.full((20, 20, 3), 50 * i, dtype=np.uint8)).save(str(tmp_path / ('%d.jpg' % i)))
+    with open(str(tmp_path / '5.jpg'), 'wb') as f:
+        f.write(b'not an image')
+    paths = list(iter_directory(str(tmp_path)))
+    out = str(tmp_path / 'predictions.jsonl')
+
+    assert predict_stream(ConstantModel(), paths[:3], out, batch_size=2, img_shape=16, draft=True) == 3
+    with open(out, 'a') as f:
+        f.write('{"path": "trunc')  # a crash in the middle of a record
+    assert predict_stream(ConstantModel(), paths, out, batch_size=2, img_shape=16, draft=True) == 3
+
+    with open(out) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['path'] for r in records] == paths
+    assert [r['label'] for r in records[:5]] == ['women'] * 5
+    assert records[5]['error'] and records[5]['probability'] == ''
+
+
+def test_multi_line_errors_and_paths_count_as_one_record(tmp_path):
+    path = str(tmp_path / 'out.csv')
+    writer = PredictionWriter(path)
+    writer.write([dict(path='a.jpg', probability='', label='', error='OSError: broken\ndata stream\n'),
+                  dict(path='odd\nname.jpg', probability=0.9, label='women', error='')])
+    writer.close()
+    assert completed_count(path) == 2
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert rows[0]['error'] == 'OSError: broken data stream'
+    assert rows[1]['path'] == 'odd\nname.jpg'
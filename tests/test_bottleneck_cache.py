@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from bottleneck_cache import source_fingerprint, split_model  # noqa: E402
+
+
+def test_prefix_and_tail_reproduce_the_model_across_a_skip_connection():
+    tf.keras.utils.set_random_seed(0)
+    inputs = tf.keras.Input(shape=(6,))
+    a = tf.keras.layers.Dense(8, activation='relu')(inputs)
+    b = tf.keras.layers.Dense(8, activation='relu')(a)
+    c = tf.keras.layers.Dense(8)(b)
+    x = tf.keras.layers.Add()([a, c])  # `a` crosses the cut before `c`
+    net = tf.keras.Model(inputs, tf.keras.layers.Dense(1)(x))
+
+    split = net.layers.index(c._keras_history[0])
+    prefix, (tail_inputs, tail_output) = split_model(net, split)
+    tail = tf.keras.Model(tail_inputs, tail_output)
+    assert len(prefix.outputs) == 2
+
+    x = np.random.RandomState(0).rand(5, 6).astype(np.float32)
+    np.testing.assert_allclose(tail(prefix(x)).numpy(), net(x).numpy(), rtol=1e-5, atol=1e-6)
+    # the tail shares the original layers' weights
+    assert set(map(id, tail.trainable_weights)) <= set(map(id, net.trainable_weights))
+
+
+class Files:
+    def __init__(self, filepaths):
+        self.filepaths = filepaths
+
+
+def test_fingerprint_follows_the_files(tmp_path):
+    paths = [str(tmp_path / ('%d.jpg' % i)) for i in range(3)]
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write(b'image')
+    before = source_fingerprint(Files(paths))
+    assert before == source_fingerprint(Files(list(paths)))
+    with open(paths[1], 'wb') as f:
+        f.write(b'another image')
+    assert source_fingerprint(Files(paths)) != before
+    assert source_fingerprint(Files(paths[:2])) != source_fingerprint(Files(paths))
+    assert source_fingerprint(object()) is None
+
+    class Cached:
+        index = {'hashes': ['a', 'b']}
+    assert source_fingerprint(Cached()) is not None
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from checkpointing import _read_json, fit_resumable  # noqa: E402
+
+
+def tiny_model():
+    model = tf.keras.Sequential([tf.keras.Input(shape=(4,)), tf.keras.layers.Dense(1)])
+    model.compile(optimizer=tf.keras.optimizers.SGD(0.1), loss='mse')
+    return model
+
+
+class CrashAtTrainEnd(tf.keras.callbacks.Callback):
+    def on_train_end(self, logs=None):
+        raise RuntimeError('crash')
+
+
+def test_stopped_run_that_crashed_before_train_end_restores_the_best_weights(tmp_path):
+    rng = np.random.RandomState(0)
+    x = rng.rand(64, 4).astype(np.float32)
+    y = x.sum(1, keepdims=True)
+    run_dir = str(tmp_path / 'run')
+
+    # the loss keeps falling, so with mode='max' the first epoch stays best and the second one stops
+    def early_stopping():
+        return tf.keras.callbacks.EarlyStopping(monitor='loss', mode='max', patience=1, restore_best_weights=True)
+
+    tf.keras.utils.set_random_seed(0)
+    model = tiny_model()
+    after_epoch = []
+    record = tf.keras.callbacks.LambdaCallback(on_epoch_end=lambda epoch, logs: after_epoch.append(model.get_weights()))
+    with pytest.raises(RuntimeError):
+        fit_resumable(model, run_dir, x, 10, [early_stopping(), record, CrashAtTrainEnd()], y=y, verbose=0)
+    state = _read_json(str(tmp_path / 'run' / 'state.json'))
+    assert state['stopped'] and not state['complete'] and state['epoch'] == 2
+
+    resumed = tiny_model()
+    history = fit_resumable(resumed, run_dir, x, 10, [early_stopping()], y=y, verbose=0)
+    assert history.epoch == [] and len(history.history['loss']) == 2
+    for w, best in zip(resumed.get_weights(), after_epoch[0]):
+        np.testing.assert_allclose(w, best)
+    assert _read_json(str(tmp_path / 'run' / 'state.json'))['complete']
+
+    # a finished run just loads its final weights, the best ones
+    loaded = tiny_model()
+    fit_resumable(loaded, run_dir, x, 10, [early_stopping()], y=y, verbose=0)
+    for w, best in zip(loaded.get_weights(), after_epoch[0]):
+        np.testing.assert_allclose(w, best)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from dedup import MultiIndexHash, clusters, phash, popcount  # noqa: E402
+
+
+def brute_force_pairs(codes, radius):
+    found = set()
+    for i in range(len(codes)):
+        dist = popcount(codes[i + 1:] ^ codes[i])
+        for j in np.flatnonzero(dist <= radius):
+            found.add((i, i + 1 + int(j), int(dist[j])))
+    return found
+
+
+def test_pairs_match_brute_force():
+    rng = np.random.default_rng(0)
+    codes = rng.integers(0, 2 ** 63, 400, dtype=np.uint64)
+    # near-duplicates: copies of some codes with a few bits flipped
+    for i in range(0, 400, 10):
+        flips = rng.choice(64, rng.integers(0, 8), replace=False)
+        codes[i + 1] = codes[i] ^ np.uint64(sum(1 << int(b) for b in flips))
+    for radius in (0, 3, 6):
+        pairs = MultiIndexHash(codes).pairs(radius, block=64)
+        assert set(map(tuple, pairs.tolist())) == brute_force_pairs(codes, radius)
+
+
+def test_query_finds_codes_within_radius():
+    codes = np.array([0, 0b111, 0b1111, 2 ** 63], dtype=np.uint64)
+    ids, dist = MultiIndexHash(codes, chunks=4).query(0, 3)
+    assert sorted(zip(ids.tolist(), dist.tolist())) == [(0, 0), (1, 3), (3, 1)]
+
+
+def test_clusters_are_connected_components_named_by_smallest_index():
+    pairs = np.array([[3, 5, 1], [0, 3, 2], [1, 2, 0], [6, 7, 4]])
+    assert clusters(8, pairs).tolist() == [0, 1, 1, 0, 4, 0, 6, 6]
+    assert clusters(3, np.zeros((0, 3), dtype=np.int64)).tolist() == [0, 1, 2]
+
+
+def test_phash_is_stable_under_small_changes():
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, (2, 64, 64, 3), dtype=np.uint8)
+    noisy = np.clip(images.astype(np.int16) + rng.integers(-3, 4, images.shape), 0, 255).astype(np.uint8)
+    codes, noisy_codes = phash(images), phash(noisy)
+    assert popcount(codes ^ noisy_codes).max() <= 6
+    assert popcount(codes[:1] ^ codes[1:]) > 6
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+from PIL import Image  # noqa: E402
+
+from image_cache import CachedImageSequence, ingest_directory, load_cache  # noqa: E402
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    # every image is one flat gray level: 10..50 for 'men', 110..150 for 'women'
+    for label, class_name in enumerate(('men', 'women')):
+        os.makedirs(str(tmp_path / 'train' / class_name))
+        for i in range(10):
+            value = 10 + 100 * label + 4 * i
+            Image.fromarray(np.full((20, 20, 3), value, dtype=np.uint8)).save(
+                str(tmp_path / 'train' / class_name / ('%d.png' % i)))
+    ingest_directory(str(tmp_path / 'train'), 'train', str(tmp_path / 'cache'), img_shape=8, shuffle=True, draft=True)
+    return str(tmp_path / 'cache')
+
+
+def epoch_batches(sequence):
+    batches = []
+    for idx in range(len(sequence)):
+        x, y = sequence[idx]
+        levels = np.round(x.reshape(len(x), -1).mean(1) * 255).astype(int)
+        # labels stay with their images
+        np.testing.assert_array_equal(y, (levels > 100).astype(np.float32))
+        batches.append(frozenset(levels.tolist()))
+    sequence.on_epoch_end()
+    return batches
+
+
+def test_every_epoch_reshuffles_samples_across_batches(cache_dir):
+    sequence = CachedImageSequence('train', batch_size=6, shuffle=True, cache_dir=cache_dir, seed=0)
+    first, second = epoch_batches(sequence), epoch_batches(sequence)
+    assert set().union(*first) == set().union(*second) and len(set().union(*first)) == 20
+    assert sum(len(b) for b in first) == sum(len(b) for b in second) == 20
+    # not just the same batches in another order
+    assert set(first) != set(second)
+
+
+def test_without_shuffle_batches_follow_the_cache(cache_dir):
+    sequence = CachedImageSequence('train', batch_size=6, cache_dir=cache_dir)
+    images, labels, _ = load_cache('train', cache_dir)
+    assert epoch_batches(sequence) == epoch_batches(sequence)
+    x, y = sequence[0]
+    np.testing.assert_allclose(x, images[:6] / 255., atol=1e-6)
+    np.testing.assert_array_equal(y, labels[:6])
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from knn_index import ExactIndex, IVFPQIndex  # noqa: E402
+
+
+def clustered_vectors(n=3000, d=32, centers=20, seed=0):
+    rng = np.random.default_rng(seed)
+    means = rng.normal(size=(centers, d))
+    return (means[rng.integers(0, centers, n)] + 0.3 * rng.normal(size=(n, d))).astype(np.float32)
+
+
+@pytest.fixture(scope='module')
+def data():
+    vectors = clustered_vectors()
+    labels = (np.arange(len(vectors)) % 2).astype(np.float32)
+    index = IVFPQIndex(m=8, nprobe=8)
+    index.train(vectors)
+    index.add(vectors, labels)
+    return vectors, labels, index
+
+
+def recall_at(k, found, truth):
+    return np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+
+
+def test_nlist_is_sized_from_the_number_of_vectors(data):
+    vectors, _, index = data
+    assert index.nlist == int(4 * np.sqrt(len(vectors)))
+    assert index.ntotal == len(vectors)
+
+
+def test_recall_against_exact_search(data):
+    vectors, labels, index = data
+    queries = clustered_vectors(n=50, seed=1)
+    truth, _ = ExactIndex(vectors, labels).search(queries, 10)
+    found, sims = index.search(queries, 10)
+    assert recall_at(10, found, truth) >= 0.6
+    assert np.all(np.diff(sims, axis=1) <= 0)  # best first
+    exhaustive, _ = index.search(queries, 10, nprobe=index.nlist)
+    assert recall_at(10, exhaustive, truth) >= recall_at(10, found, truth)
+
+
+def test_chunked_search_matches_one_chunk(data):
+    _, _, index = data
+    queries = clustered_vectors(n=37, seed=2)
+    ids, sims = index.search(queries, 5, chunk_size=256)
+    chunked_ids, chunked_sims = index.search(queries, 5, chunk_size=8)
+    np.testing.assert_array_equal(ids, chunked_ids)
+    np.testing.assert_allclose(sims, chunked_sims, rtol=1e-6)
+
+
+def test_short_results_are_padded():
+    vectors = clustered_vectors(n=300, d=16)
+    index = IVFPQIndex(nlist=30, m=4, nprobe=1)
+    index.train(vectors)
+    index.add(vectors, np.zeros(len(vectors)))
+    ids, sims = index.search(vectors[:3], k=len(vectors))
+    assert np.all((ids == -1) == np.isneginf(sims))
+    assert np.all((ids >= 0).sum(1) < len(vectors))
+
+
+def test_save_and_load_round_trip(data, tmp_path):
+    _, labels, index = data
+    path = str(tmp_path / 'ivfpq.npz')
+    index.save(path)
+    loaded = IVFPQIndex.load(path)
+    queries = clustered_vectors(n=20, seed=3)
+    for a, b in zip(index.search(queries, 10), loaded.search(queries, 10)):
+        np.testing.assert_array_equal(a, b)
+    np.testing.assert_array_equal(loaded.labels, labels)
+    assert (loaded.nlist, loaded.m, loaded.nprobe) == (index.nlist, index.m, index.nprobe)
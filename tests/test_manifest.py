@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+from PIL import Image  # noqa: E402
+
+from image_cache import load_cache  # noqa: E402
+from manifest import Manifest, refresh_image_cache  # noqa: E402
+
+
+def write_image(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(np.full((24, 24, 3), value, dtype=np.uint8)).save(path)
+
+
+@pytest.fixture
+def data(tmp_path):
+    for c, class_name in enumerate(('men', 'women')):
+        for i in range(3):
+            write_image(str(tmp_path / 'data' / 'train' / class_name / ('%d.jpg' % i)), 40 * i + 100 * c)
+    return tmp_path
+
+
+def test_update_reports_only_what_changed(data):
+    manifest = Manifest(str(data / 'manifest.sqlite'))
+    changes = manifest.update(str(data / 'data'), splits=('train',))
+    assert len(changes['added']) == 6 and not changes['changed'] and not changes['removed']
+    assert manifest.update(str(data / 'data'), splits=('train',)) == dict(added=[], changed=[], removed=[])
+
+    train = data / 'data' / 'train'
+    write_image(str(train / 'men' / '0.jpg'), 250)
+    os.remove(str(train / 'women' / '2.jpg'))
+    write_image(str(train / 'women' / '3.jpg'), 7)
+    changes = manifest.update(str(data / 'data'), splits=('train',))
+    assert changes == dict(added=[str(train / 'women' / '3.jpg')], changed=[str(train / 'men' / '0.jpg')],
+                           removed=[str(train / 'women' / '2.jpg')])
+    paths, labels, _, class_names = manifest.entries('train')
+    assert class_names == ['men', 'women']
+    assert labels.tolist() == [0, 0, 0, 1, 1, 1]
+
+
+def test_refresh_decodes_only_new_content(data):
+    manifest = Manifest(str(data / 'manifest.sqlite'))
+    manifest.update(str(data / 'data'), splits=('train',))
+    cache_dir = str(data / 'cache')
+    kwargs = dict(cache_dir=cache_dir, img_shape=16, shuffle=True, draft=True)
+    assert refresh_image_cache(manifest, 'train', **kwargs) == 6
+    assert refresh_image_cache(manifest, 'train', **kwargs) == 0
+
+    write_image(str(data / 'data' / 'train' / 'men' / '1.jpg'), 255)
+    manifest.update(str(data / 'data'), splits=('train',))
+    assert refresh_image_cache(manifest, 'train', **kwargs) == 1
+    images, labels, index = load_cache('train', cache_dir)
+    assert len(images) == len(labels) == len(index['hashes']) == 6
+    row = index['paths'].index(str(data / 'data' / 'train' / 'men' / '1.jpg'))
+    assert images[row].min() > 240 and labels[row] == 0
+
+    # another size or decoding is a different cache: everything is decoded again
+    assert refresh_image_cache(manifest, 'train', **dict(kwargs, img_shape=12)) == 6
+    assert not any(name.endswith('.tmp') for name in os.listdir(cache_dir))
+
+
+def test_refresh_keeps_only_the_given_paths(data):
+    manifest = Manifest(str(data / 'manifest.sqlite'))
+    manifest.update(str(data / 'data'), splits=('train',))
+    cache_dir = str(data / 'cache')
+    refresh_image_cache(manifest, 'train', cache_dir=cache_dir, img_shape=16, draft=True)
+    keep = [str(data / 'data' / 'train' / 'men' / '2.jpg'), str(data / 'data' / 'train' / 'women' / '0.jpg')]
+    assert refresh_image_cache(manifest, 'train', cache_dir=cache_dir, img_shape=16, draft=True, keep=keep) == 0
+    _, labels, index = load_cache('train', cache_dir)
+    assert index['paths'] == keep and labels.tolist() == [0, 1]
+
+
+def test_update_of_one_split_leaves_the_others(data):
+    write_image(str(data / 'data' / 'validation' / 'women' / '0.jpg'), 90)
+    manifest = Manifest(str(data / 'manifest.sqlite'))
+    manifest.update(str(data / 'data'))
+    os.remove(str(data / 'data' / 'train' / 'men' / '0.jpg'))
+    changes = manifest.update(str(data / 'data'), splits=('train',))
+    assert changes['removed'] == [str(data / 'data' / 'train' / 'men' / '0.jpg')]
+    paths, _, _, _ = manifest.entries('validation')
+    assert paths == [str(data / 'data' / 'validation' / 'women' / '0.jpg')]
+    assert len(manifest.entries('train')[0]) == 5
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from progressive import schedule, transfer_weights  # noqa: E402
+
+
+def small_cnn(img_shape):
+    return tf.keras.Sequential([
+        tf.keras.Input(shape=(img_shape, img_shape, 3)),
+        tf.keras.layers.Conv2D(4, 3, activation='relu'),
+        tf.keras.layers.MaxPooling2D(2),
+        tf.keras.layers.Conv2D(8, 3, activation='relu'),
+        tf.keras.layers.Dropout(0.5),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(5, activation='relu'),
+        tf.keras.layers.Dense(1),
+    ])
+
+
+def test_transfer_resamples_the_flatten_dense_kernel():
+    tf.keras.utils.set_random_seed(0)
+    old, new = small_cnn(96), small_cnn(128)
+    assert transfer_weights(old, new) == []
+
+    for old_layer, new_layer in zip(old.layers, new.layers):
+        if isinstance(old_layer, tf.keras.layers.Conv2D) or old_layer is old.layers[-1]:
+            for a, b in zip(old_layer.get_weights(), new_layer.get_weights()):
+                np.testing.assert_array_equal(a, b)
+
+    (old_kernel, old_bias), (new_kernel, new_bias) = old.layers[-2].get_weights(), new.layers[-2].get_weights()
+    assert old_kernel.shape == (45 * 45 * 8, 5)
+    assert new_kernel.shape == (61 * 61 * 8, 5)
+    np.testing.assert_array_equal(old_bias, new_bias)
+
+
+def test_resampled_kernel_keeps_the_response_to_a_constant_map():
+    old, new = small_cnn(96), small_cnn(128)
+    dense = old.layers[-2]
+    kernel, bias = dense.get_weights()
+    dense.set_weights([np.full_like(kernel, 0.01) * np.arange(1, 6), bias])
+    transfer_weights(old, new)
+    np.testing.assert_allclose(new.layers[-2].get_weights()[0].sum(0), dense.get_weights()[0].sum(0), rtol=1e-4)
+
+
+def test_schedule_ends_at_full_size():
+    stages = schedule(10)
+    assert sum(epochs for _, epochs in stages) == 10
+    assert stages[-1][0] == 150 and [s for s, _ in stages] == sorted(s for s, _ in stages)
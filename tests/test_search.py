@@ -0,0 +1,54 @@
+import zlib
+
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from search import Hyperband, brackets  # noqa: E402
+
+
+def test_brackets():
+    assert brackets(27, 3) == [(27, 1), (12, 3), (6, 9), (4, 27)]
+    assert brackets(9, 3) == [(9, 1), (5, 3), (3, 9)]
+
+
+def fake_trainer(calls):
+    def train(trials, data_dir='data'):
+        for i, (config, epochs) in enumerate(trials):
+            calls.append((config['name'], epochs))
+            score = zlib.crc32(config['name'].encode()) % 1000 / 1000.
+            yield i, dict(epochs=epochs, val_accuracy=score, val_loss=1 - score, cpu_hours=0.5)
+    return train
+
+
+def test_successive_halving_schedule(tmp_path):
+    calls = []
+    search = Hyperband(max_epochs=9, eta=3, search_dir=str(tmp_path))
+    config, result = search.run(fake_trainer(calls))
+
+    first = search.state['brackets'][0]['trials']
+    assert [len(b['trials']) for b in search.state['brackets']] == [9, 5, 3]
+    assert sorted(len(t['rungs']) for t in first) == [1] * 6 + [2] * 2 + [3]
+    # the best third of every rung is promoted
+    by_score = sorted(first, key=lambda t: -t['rungs']['1']['val_accuracy'])
+    assert all('3' in t['rungs'] for t in by_score[:3]) and not any('3' in t['rungs'] for t in by_score[3:])
+    assert len(calls) == (9 + 3 + 1) + (5 + 1) + 3
+    assert len(set(t['config']['name'] for b in search.state['brackets'] for t in b['trials'])) == 17
+    assert result['epochs'] == 9 and search.state['cpu_hours'] == 0.5 * len(calls)
+
+
+def test_resumed_search_trains_nothing_again(tmp_path):
+    first = Hyperband(max_epochs=9, eta=3, search_dir=str(tmp_path)).run(fake_trainer([]))
+    calls = []
+    # settings of the stored search win over the arguments
+    resumed = Hyperband(max_epochs=27, eta=2, search_dir=str(tmp_path))
+    assert resumed.run(fake_trainer(calls)) == first and not calls
+    assert (resumed.max_epochs, resumed.eta) == (9, 3)
+
+
+def test_budget_stops_before_the_next_rung(tmp_path):
+    calls = []
+    search = Hyperband(max_epochs=9, eta=3, budget_hours=1., search_dir=str(tmp_path))
+    search.run(fake_trainer(calls))
+    # the first rung runs in full, then the budget is spent
+    assert len(calls) == 9 and search.over_budget()
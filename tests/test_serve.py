@@ -0,0 +1,108 @@
+import io
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+from PIL import Image  # noqa: E402
+
+from load_generator import run_load  # noqa: E402
+from serve import MicroBatcher, serve  # noqa: E402
+
+
+class MeanModel:
+    """Sigmoid-like output: the mean pixel of every image; records the batch sizes it sees."""
+
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.batch_sizes = []
+
+    def predict_on_batch(self, x):
+        self.batch_sizes.append(len(x))
+        time.sleep(self.delay)
+        return x.reshape(len(x), -1).mean(1, keepdims=True)
+
+
+class FailingModel:
+    def predict_on_batch(self, x):
+        raise RuntimeError('out of memory')
+
+
+def predict_concurrently(batcher, images):
+    results = [None] * len(images)
+
+    def client(i):
+        results[i] = batcher.predict(images[i])
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(len(images))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_concurrent_requests_are_grouped_up_to_the_batch_size():
+    model = MeanModel(delay=0.05)
+    batcher = MicroBatcher(model, max_batch_size=4, max_wait_ms=200.)
+    images = [np.full((4, 4, 3), 10 * i, dtype=np.uint8) for i in range(10)]
+    results = predict_concurrently(batcher, images)
+    np.testing.assert_allclose(results, [10 * i / 255. for i in range(10)], rtol=1e-6)
+    assert sum(model.batch_sizes) == 10 and max(model.batch_sizes) == 4 and len(model.batch_sizes) < 10
+
+
+def test_a_lone_request_is_flushed_after_max_wait():
+    model = MeanModel()
+    batcher = MicroBatcher(model, max_batch_size=32, max_wait_ms=20.)
+    start = time.perf_counter()
+    batcher.predict(np.zeros((4, 4, 3), dtype=np.uint8))
+    assert time.perf_counter() - start < 1. and model.batch_sizes == [1]
+
+
+def test_failed_prediction_raises_in_every_request_of_the_batch():
+    batcher = MicroBatcher(FailingModel(), max_batch_size=4, max_wait_ms=50.)
+    with pytest.raises(RuntimeError):
+        batcher.predict(np.zeros((4, 4, 3), dtype=np.uint8))
+
+
+def jpeg():
+    data = io.BytesIO()
+    Image.fromarray(np.full((32, 32, 3), 200, dtype=np.uint8)).save(data, 'JPEG')
+    return data.getvalue()
+
+
+def post(url, data):
+    request = urllib.request.Request(url, data=data)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_server_replies_200_400_and_500():
+    good = serve(MeanModel(), port=0, draft=True)
+    bad = serve(FailingModel(), port=0, draft=True)
+    try:
+        url = 'http://127.0.0.1:%d/predict'
+        status, body = post(url % good.server_address[1], jpeg())
+        assert status == 200 and body['label'] == 'women'
+        assert post(url % good.server_address[1], b'not an image')[0] == 400
+        status, body = post(url % bad.server_address[1], jpeg())
+        assert status == 500 and 'out of memory' in body['error']
+
+        client = run_load(url % bad.server_address[1], [jpeg()], concurrency=2, requests=4)
+        assert client['errors'] == 4 and client['requests'] == 0 and 'p50_ms' not in client
+    finally:
+        good.shutdown()
+        bad.shutdown()
+
+
+def test_load_needs_images():
+    with pytest.raises(ValueError):
+        run_load('http://127.0.0.1:1/predict', [])
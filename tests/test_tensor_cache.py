@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from tensor_cache import TensorSequence  # noqa: E402
+
+
+class Batches:
+    """A Sequence-like source of rescaled uint8 images, as the cached and zip sequences are."""
+
+    def __init__(self, n=10, batch_size=4):
+        rng = np.random.RandomState(0)
+        self.pixels = rng.randint(0, 256, (n, 6, 6, 3)).astype(np.uint8)
+        self.labels = (np.arange(n) % 2).astype(np.float32)
+        self.samples, self.batch_size = n, batch_size
+        self.class_indices = {'men': 0, 'women': 1}
+        self.index = {'hashes': ['h%d' % i for i in range(n)], 'draft': True}
+
+    def __len__(self):
+        return (self.samples + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        rows = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        return self.pixels[rows] / 255., self.labels[rows]
+
+
+def test_shared_round_trip_through_the_spec():
+    source = Batches()
+    shared = TensorSequence.from_source(source, shared=True)
+    try:
+        attached = TensorSequence.attach(shared.spec)
+        np.testing.assert_array_equal(attached.images, source.pixels)
+        np.testing.assert_array_equal(attached.labels, source.labels)
+        assert attached.index == source.index and attached.class_indices == source.class_indices
+        assert len(attached) == len(source)
+        x, y = attached[2]
+        np.testing.assert_allclose(x, source[2][0], atol=1e-6)
+        np.testing.assert_array_equal(y, source.labels[8:])
+        attached.close()
+    finally:
+        shared.close(unlink=True)
+
+
+def test_source_of_unknown_length():
+    source = Batches(n=7, batch_size=3)
+    tensors = TensorSequence.from_source(iter([source[i] for i in range(len(source))]), dtype=np.float16)
+    assert tensors.samples == 7 and tensors.batch_size == 3 and tensors.index is None
+    np.testing.assert_allclose(tensors.images, source.pixels / 255., atol=1e-3)
+
+
+def test_source_shorter_than_its_samples():
+    source = Batches()
+    source.samples = 12
+    with pytest.raises(ValueError):
+        TensorSequence.from_source(source, shared=True)
@@ -0,0 +1,51 @@
+import os
+import zipfile
+
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from zip_dataset import ZipIndex, ZipReader  # noqa: E402
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = str(tmp_path / 'images.zip')
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('train/men/b.jpg', b'men b', compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr('train/men/a.jpg', b'men a', compress_type=zipfile.ZIP_STORED)
+        z.writestr('train/women/c.png', b'women c' * 100, compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr('validation/women/d.JPG', b'women d')
+        # not <split>/<class>/<file> images
+        z.writestr('train/men/notes.txt', b'')
+        z.writestr('train/men/.hidden.jpg', b'')
+        z.writestr('__MACOSX/train/men/._a.jpg', b'')
+        z.writestr('data/train/men/e.jpg', b'')
+        z.writestr('train/f.jpg', b'')
+    return path
+
+
+def test_index_keeps_only_split_class_file_images(archive):
+    index = ZipIndex(archive)
+    assert sorted(index.splits) == ['train', 'validation']
+    assert index.class_counts('train') == {'men': 2, 'women': 1}
+    members, labels = index.members('train')
+    assert [m[0] for m in members] == ['train/men/a.jpg', 'train/men/b.jpg', 'train/women/c.png']
+    assert labels.tolist() == [0, 0, 1]
+
+
+def test_reader_returns_member_bytes(archive):
+    reader = ZipReader(archive)
+    members, _ = ZipIndex(archive).members('train')
+    assert [reader.read(m) for m in members] == [b'men a', b'men b', b'women c' * 100]
+
+
+def test_index_is_rebuilt_when_the_archive_changes(archive):
+    ZipIndex(archive)
+    assert os.path.exists(archive + '.index.json')
+    with zipfile.ZipFile(archive, 'a') as z:
+        z.writestr('validation/men/g.jpg', b'men g')
+    index = ZipIndex(archive)
+    assert index.class_counts('validation') == {'men': 1, 'women': 1}
+    members, _ = index.members('validation')
+    assert ZipReader(archive).read(members[0]) == b'men g'
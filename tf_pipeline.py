@@ -0,0 +1,97 @@
+"""tf.data replacement for the flow_from_directory generators.
+
+`model.fit(..., workers=4)` is ignored for generators by current Keras, so the
+ImageDataGenerator path decodes on a single thread. make_dataset lists the same
+class directories, decodes and resizes in parallel, caches the decoded uint8
+images, shuffles with a bounded buffer and prefetches, and yields the same
+(x / 255, float label) batches as class_mode='binary'.
+"""
+import itertools
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from image_cache import list_images
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def _decode_jpeg_draft(data, img_shape):
+    """Decode a JPEG at the largest DCT scale-down (2, 4 or 8) that keeps both sides >= img_shape."""
+    shape = tf.image.extract_jpeg_shape(data)
+    smallest = tf.minimum(shape[0], shape[1])
+    # the ratios that still fit form a prefix of (2, 4, 8), so counting them picks the branch
+    branch = tf.add_n([tf.cast(smallest // r >= img_shape, tf.int32) for r in (2, 4, 8)])
+    return tf.switch_case(branch, [lambda r=r: tf.io.decode_jpeg(data, channels=3, ratio=r) for r in (1, 2, 4, 8)])
+
+
+def decode_and_resize(path, img_shape=150, draft=False):
+    data = tf.io.read_file(path)
+    if draft:
+        img = tf.cond(tf.io.is_jpeg(data), lambda: _decode_jpeg_draft(data, img_shape),
+                      lambda: tf.io.decode_image(data, channels=3, expand_animations=False))
+    else:
+        img = tf.io.decode_image(data, channels=3, expand_animations=False)
+    # nearest keeps uint8, like load_img's default interpolation
+    img = tf.image.resize(img, (img_shape, img_shape), method='nearest')
+    img.set_shape((img_shape, img_shape, 3))
+    return img
+
+
+def make_dataset(directory, batch_size=32, img_shape=150, shuffle=True, shuffle_buffer=1024,
+                 cache='', augment=None, seed=None, draft=False):
+    """Batched (x, y) dataset over `directory`.
+
+    The file list is shuffled once up front (the classes are listed one after
+    the other, a bounded buffer alone would give one-class batches); after the
+    decode is cached the bounded buffer reshuffles every epoch. `cache` is ''
+    for an in-memory cache or a file prefix. `augment` is a BatchAugmenter,
+    applied to whole rescaled batches. draft=True decodes JPEGs at a reduced
+    DCT scale (see image_cache.decode_image).
+    """
+    paths, labels, _ = list_images(directory)
+    if shuffle:
+        order = np.random.RandomState(seed).permutation(len(paths))
+        paths = [paths[i] for i in order]
+        labels = labels[order]
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    ds = ds.map(lambda path, label: (decode_and_resize(path, img_shape, draft), label),
+                num_parallel_calls=AUTOTUNE)
+    if cache is not None:
+        ds = ds.cache(cache)
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = ds.map(lambda x, y: (tf.cast(x, tf.float32) * (1. / 255), y), num_parallel_calls=AUTOTUNE)
+    if augment is not None:
+        # sequential on purpose: the running batch counter keys the seeded transforms
+        keys = itertools.count()
+
+        def augment_batch(x):
+            return augment(x, (next(keys),)).astype(np.float32)
+
+        def apply(x, y):
+            out = tf.numpy_function(augment_batch, [x], tf.float32)
+            out.set_shape(x.shape)
+            return out, y
+
+        ds = ds.map(apply)
+    return ds.prefetch(AUTOTUNE)
+
+
+def images_per_second(source, steps=50, warmup=2):
+    """Images/sec pulling up to `steps` batches from a generator, Sequence or dataset."""
+    it = iter(source)
+    for _ in range(warmup):
+        next(it)
+    images = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        try:
+            x, _ = next(it)
+        except StopIteration:
+            break
+        images += len(x)
+    return images / (time.perf_counter() - start)
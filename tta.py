@@ -0,0 +1,89 @@
+"""Test-time augmentation in one forward pass.
+
+TTAModel wraps a model so that predict_on_batch(x) stacks K views of every
+image into one large batch, runs the model once and averages the K class
+probabilities. The views use the training transforms: view 0 is the image
+itself, view 1 its mirror image, and the others a random 10% width/height
+shift plus a random horizontal flip (BatchAugmenter with a fixed key, so the
+same batch always gets the same views).
+
+The wrapper returns (N, 1) probabilities, so it can be used wherever a model
+with a sigmoid head can (export_tflite.accuracy, batch_predict, serve).
+
+    python tta.py models/Xception.h5 --views 1 2 4 8
+"""
+import argparse
+import csv
+import os
+
+import numpy as np
+
+from batch_augment import BatchAugmenter
+from batch_predict import class_one_probability
+from export_tflite import REPORT_FIELDS, load_validation, report_row
+
+
+class TTAModel:
+    """`model` averaged over `views` augmented copies of each input."""
+
+    def __init__(self, model, views=4, width_shift_range=0.1, height_shift_range=0.1, horizontal_flip=True,
+                 max_batch=256, seed=0):
+        self.model = model
+        self.views = views
+        self.augmenter = BatchAugmenter(width_shift_range, height_shift_range, horizontal_flip, seed)
+        self.max_batch = max_batch
+
+    def augmented_views(self, x):
+        """(views * N, ...) array: all N images of view 0, then of view 1, and so on."""
+        views = [x]
+        if self.views > 1:
+            views.append(x[:, :, ::-1])
+        for view in range(2, self.views):
+            views.append(self.augmenter(x, (view,)))
+        return np.concatenate(views)
+
+    def predict_on_batch(self, x):
+        # bound the stacked batch: max_batch // views images per forward pass
+        step = max(1, self.max_batch // self.views)
+        probs = []
+        for i in range(0, len(x), step):
+            chunk = x[i:i + step]
+            p = class_one_probability(self.model.predict_on_batch(self.augmented_views(chunk)))
+            probs.append(p.reshape(self.views, len(chunk)).mean(axis=0))
+        return np.concatenate(probs)[:, None]
+
+
+def tta_report(model, name, size_bytes, images, labels, views=(1, 2, 4, 8)):
+    """export_tflite report rows for every number of views, plus the gain over a single view."""
+    rows = []
+    for k in views:
+        row = report_row(name, 'tta x%d' % k, TTAModel(model, k) if k > 1 else model, size_bytes, images, labels)
+        if rows:
+            row['accuracy_gain'] = round(row['val_accuracy'] - rows[0]['val_accuracy'], 4)
+            row['added_batch_ms'] = round(row['batch_ms'] - rows[0]['batch_ms'], 2)
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('models', nargs='+', help='saved Keras models')
+    parser.add_argument('--views', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--report', default='tta_report.csv')
+    args = parser.parse_args()
+
+    import tensorflow as tf
+
+    images, labels = load_validation()
+    rows = []
+    for path in args.models:
+        model = tf.keras.models.load_model(path, compile=False)
+        name = os.path.splitext(os.path.basename(path))[0]
+        rows += tta_report(model, name, os.path.getsize(path), images, labels, args.views)
+    fields = REPORT_FIELDS + ['accuracy_gain', 'added_batch_ms']
+    with open(args.report, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    for row in rows:
+        print(', '.join('%s=%s' % (k, row.get(k, '')) for k in fields))
@@ -0,0 +1,148 @@
+"""Read the training images straight out of images.zip, without extracting it.
+
+ZipIndex reads the archive's central directory once and keeps, for every
+image, its split, class, label and where its data sits in the file (saved next
+to the archive, rebuilt when the archive changes). ZipImageSequence then reads
+and decodes members with a pool of threads, each with its own file handle,
+so nothing is ever written to or stat'ed on the filesystem.
+"""
+import io
+import json
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from image_cache import IMAGE_EXTENSIONS, decode_image
+
+LOCAL_HEADER = struct.Struct('<4s22xHH')
+INDEX_VERSION = 2  # bump when _build changes which members it keeps
+
+
+class ZipIndex:
+    """Members of an image archive laid out as <split>/<class>/<file>."""
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        index_path = zip_path + '.index.json'
+        stat = os.stat(zip_path)
+        index = None
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            if (index.get('version') != INDEX_VERSION or index['size'] != stat.st_size
+                    or index['mtime'] != stat.st_mtime):
+                index = None
+        if index is None:
+            index = self._build(stat)
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.replace(index_path + '.tmp', index_path)
+        self.splits = index['splits']
+
+    def _build(self, stat):
+        splits = {}
+        with zipfile.ZipFile(self.zip_path) as archive:
+            for info in archive.infolist():
+                # exactly <split>/<class>/<file> from the archive root, as `unzip -d data/` lays it out;
+                # __MACOSX/ resource forks and other dot-files are not images
+                parts = info.filename.split('/')
+                if (info.is_dir() or len(parts) != 3 or any(p.startswith(('.', '__MACOSX')) for p in parts)
+                        or not parts[-1].lower().endswith(IMAGE_EXTENSIONS)):
+                    continue
+                split, class_name = parts[0], parts[1]
+                members = splits.setdefault(split, {}).setdefault(class_name, [])
+                members.append([info.filename, info.header_offset, info.compress_size, info.compress_type])
+        for classes in splits.values():
+            for members in classes.values():
+                members.sort()
+        return dict(version=INDEX_VERSION, size=stat.st_size, mtime=stat.st_mtime, splits=splits)
+
+    def class_names(self, split):
+        return sorted(self.splits[split])
+
+    def class_counts(self, split):
+        return {c: len(self.splits[split][c]) for c in self.class_names(split)}
+
+    def members(self, split):
+        """(members, labels) of a split, classes in sorted order as flow_from_directory labels them."""
+        members, labels = [], []
+        for label, name in enumerate(self.class_names(split)):
+            members += self.splits[split][name]
+            labels += [label] * len(self.splits[split][name])
+        return members, np.array(labels, dtype=np.float32)
+
+
+class ZipReader:
+    """Reads member bytes by offset; every thread gets its own file handle."""
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.local = threading.local()
+
+    def read(self, member):
+        name, offset, compress_size, compress_type = member
+        f = getattr(self.local, 'f', None)
+        if f is None:
+            f = self.local.f = open(self.zip_path, 'rb')
+        f.seek(offset)
+        signature, name_len, extra_len = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+        if signature != b'PK\x03\x04':
+            raise zipfile.BadZipFile('bad local header for %s' % name)
+        f.seek(offset + LOCAL_HEADER.size + name_len + extra_len)
+        data = f.read(compress_size)
+        if compress_type == zipfile.ZIP_STORED:
+            return data
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        with zipfile.ZipFile(self.zip_path) as archive:  # rarer compressions
+            return archive.read(name)
+
+
+class ZipImageSequence(tf.keras.utils.Sequence):
+    """(x, y) batches of one split of the archive, a drop-in for flow_from_directory."""
+
+    def __init__(self, index, split, batch_size=32, img_shape=150, shuffle=False, rescale=1./255,
+                 augment=None, workers=8, seed=None, draft=False):
+        super().__init__()
+        self.members, self.labels = index.members(split)
+        self.reader = ZipReader(index.zip_path)
+        self.pool = ThreadPoolExecutor(workers)
+        self.batch_size = batch_size
+        self.img_shape = img_shape
+        self.shuffle = shuffle
+        self.rescale = rescale
+        self.augment = augment
+        self.draft = draft
+        self.class_indices = {c: i for i, c in enumerate(index.class_names(split))}
+        self.samples = len(self.members)
+        self.rng = np.random.RandomState(seed)
+        self.order = np.arange(self.samples)
+        self.epoch = 0
+        if shuffle:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return (self.samples + self.batch_size - 1) // self.batch_size
+
+    def _load(self, i):
+        return decode_image(io.BytesIO(self.reader.read(self.members[i])), self.img_shape, self.draft)
+
+    def __getitem__(self, idx):
+        rows = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        x = np.stack(list(self.pool.map(self._load, rows))).astype(np.float32)
+        if self.rescale:
+            x *= self.rescale
+        if self.augment is not None:
+            x = self.augment(x, (self.epoch, int(idx)))
+        return x, self.labels[rows]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        if self.shuffle:
+            self.rng.shuffle(self.order)